@@ -0,0 +1,140 @@
+"""Measures per-worker memory usage of the index store, with and without
+loading it before workers are forked.
+
+Workers are forked from this process, mimicking uWSGI:
+    - ``lazy``: each worker loads its own copy of the store after the fork,
+      as with ``uwsgi --lazy-apps``.
+    - ``preload``: the store is memory-mapped and paged in once before the
+      fork, as with ``RUBRIX_PRELOAD=1`` and no ``--lazy-apps``.
+
+Each worker scores every image in the store against a random query, and
+then reports its RSS, PSS (RSS with shared pages divided among the processes
+sharing them) and USS (pages private to the worker) from
+``/proc/<pid>/smaps_rollup``. Only available on Linux.
+
+Usage:
+------
+    $ python benchmarks/memory.py --workers 4
+"""
+import os
+import sys
+import json
+import signal
+import argparse
+
+import numpy as np
+
+from rubrix.index import store as index_store
+
+
+def memory_usage(pid):
+    """Reads memory usage of process ``pid``.
+
+    Arguments:
+    ----------
+        pid (int):
+            Process identifier.
+
+    Returns:
+    --------
+        usage (dict):
+            RSS, PSS and USS (in MiB) of the process.
+    """
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup', 'r') as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+
+    return {
+        'rss': fields['Rss'],
+        'pss': fields['Pss'],
+        'uss': fields['Private_Clean'] + fields['Private_Dirty'],
+    }
+
+
+def worker(mode, pipe):
+    """Body of a forked worker. Reports memory usage over ``pipe``.
+    """
+    if mode == 'lazy':
+        store_path = index_store.default_paths()[-1]
+        store = index_store.IndexStore.load(store_path, mmap=False)
+    else:
+        store = index_store.get_store()
+
+    ids = np.arange(len(store))
+    rng = np.random.default_rng(0)
+    store.score_captions(rng.standard_normal(store.embeddings.shape[1],
+                                             dtype=np.float32), ids)
+    store.score_descriptors(rng.standard_normal(store.descriptors.shape[1],
+                                                dtype=np.float32), ids)
+
+    os.write(pipe, b'1')
+    # Idle until the parent has measured all workers and kills this one.
+    while True:
+        signal.pause()
+
+
+def measure(mode, n_workers):
+    """Forks ``n_workers`` workers and measures their memory usage.
+
+    Arguments:
+    ----------
+        mode (str):
+            Either 'lazy' or 'preload'.
+        n_workers (int):
+            Number of workers.
+
+    Returns:
+    --------
+        usages (list):
+            Memory usage of each worker.
+    """
+    if mode == 'preload':
+        index_store.preload()
+
+    read_end, write_end = os.pipe()
+    pids = []
+    for _ in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            worker(mode, write_end)
+            os._exit(0)
+        pids.append(pid)
+
+    for _ in pids:
+        os.read(read_end, 1)
+
+    usages = [memory_usage(pid) for pid in pids]
+
+    for pid in pids:
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+    return usages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark per-worker '
+                                                 'memory usage.')
+    parser.add_argument('--workers', dest='n_workers', type=int, default=4,
+                        help='Number of workers to fork.')
+    parser.add_argument('--mode', dest='mode', type=str, default=None,
+                        choices=['lazy', 'preload'],
+                        help='Measure a single mode.')
+    args = parser.parse_args()
+
+    if args.mode is None:
+        # Each mode is measured in a fresh process, so that the store loaded
+        # by one mode does not affect the other.
+        for mode in ['lazy', 'preload']:
+            subprocess_args = [sys.executable, __file__, '--mode', mode,
+                               '--workers', str(args.n_workers)]
+            os.spawnv(os.P_WAIT, sys.executable, subprocess_args)
+        sys.exit(0)
+
+    usages = measure(args.mode, args.n_workers)
+    summary = {key: round(float(np.mean([usage[key] for usage in usages])), 1)
+               for key in ['rss', 'pss', 'uss']}
+    print(f'{args.mode:>8}: mean per-worker MiB {json.dumps(summary)}, '
+          f'total PSS {sum(usage["pss"] for usage in usages):.1f} MiB')
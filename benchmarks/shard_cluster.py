@@ -0,0 +1,115 @@
+"""Runs several shard servers on this machine, and checks the shard router
+against a search over the whole (local) index store.
+
+The store is partitioned into ``--shards`` shards in a temporary directory,
+each served by a shard server in its own process. Queries are then routed
+to all shard servers, and their results compared with those of the local
+store. Finally, one shard server is stopped, to check that queries still
+return (partial) results within the shard timeout.
+
+Usage:
+------
+    $ python benchmarks/shard_cluster.py --shards 3 --queries 20
+"""
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+
+from rubrix.index import store as index_store
+from rubrix.router import ShardRouter
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_shard_servers(shard_paths):
+    """Starts a shard server for each of ``shard_paths``, and waits until
+    they accept requests.
+
+    Returns:
+    --------
+        processes, urls (tuple):
+            Shard server processes and their base URLs.
+    """
+    processes, urls = [], []
+    for shard_path in shard_paths:
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'rubrix.web.shard', '--store',
+             str(shard_path), '--port', str(port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append(f'http://127.0.0.1:{port}')
+
+    for url in urls:
+        while True:
+            try:
+                urllib.request.urlopen(f'{url}/shard/info', timeout=1)
+                break
+            except OSError:
+                time.sleep(0.1)
+    return processes, urls
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the shard router '
+                                                 'against local shards.')
+    parser.add_argument('--shards', dest='n_shards', type=int, default=3,
+                        help='Number of shard servers.')
+    parser.add_argument('--queries', dest='n_queries', type=int, default=20,
+                        help='Number of queries.')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=1.0,
+                        help='Shard timeout (in seconds).')
+    args = parser.parse_args()
+
+    store = index_store.get_store()
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((args.n_queries, store.embeddings.shape[1]),
+                                  dtype=np.float32)
+    labels = sorted(store.postings)[:3]
+
+    with tempfile.TemporaryDirectory() as partitions_path:
+        shard_paths = index_store.partition_store(
+            index_store.default_paths()[-1], Path(partitions_path),
+            args.n_shards)
+        processes, urls = start_shard_servers(shard_paths)
+        router = ShardRouter(urls, timeout=args.timeout)
+
+        try:
+            mismatches, latencies = 0, []
+            for query in queries:
+                for query_labels in [None, labels]:
+                    expected = [(store.relative_path(image_id), score)
+                                for image_id, score
+                                in store.search_captions(query, query_labels, 5)]
+                    start = time.perf_counter()
+                    results = router.search_captions(query, query_labels, 5)
+                    latencies.append(time.perf_counter() - start)
+                    if [path for path, _ in results] != \
+                            [path for path, _ in expected]:
+                        mismatches += 1
+            print(f'{2 * args.n_queries - mismatches}/{2 * args.n_queries} '
+                  f'routed queries match the local store, median latency '
+                  f'{statistics.median(latencies) * 1e3:.2f}ms')
+
+            # Stop one shard server, and check that queries still return.
+            processes[0].kill()
+            processes[0].wait()
+            start = time.perf_counter()
+            results = router.search_captions(queries[0], None, 5)
+            print(f'With one shard down: {len(results)} results in '
+                  f'{(time.perf_counter() - start) * 1e3:.2f}ms')
+        finally:
+            router.close()
+            for process in processes:
+                process.kill()
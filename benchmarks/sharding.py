@@ -0,0 +1,63 @@
+"""Measures single-query latency of the sharded scorer, for an increasing
+number of shards.
+
+Every query is a full scan, i.e., it scores all the images in the store, as
+this is the case the sharded scorer is meant to speed up.
+
+Usage:
+------
+    $ python benchmarks/sharding.py --shards 1 2 4 8 --queries 20
+"""
+import time
+import argparse
+import statistics
+
+import numpy as np
+
+from rubrix.index import store as index_store
+from rubrix.sharding import ShardedScorer
+
+
+def measure(search, queries, k):
+    """Measures latency of ``search`` over ``queries``.
+
+    Returns:
+    --------
+        latencies (list):
+            Latency (in seconds) of each query.
+    """
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query, None, k)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark sharded scoring.')
+    parser.add_argument('--shards', dest='shards', type=int, nargs='+',
+                        default=[1, 2, 4], help='Numbers of shards.')
+    parser.add_argument('--queries', dest='n_queries', type=int, default=20,
+                        help='Number of queries per measurement.')
+    parser.add_argument('--k', dest='k', type=int, default=5,
+                        help='Number of images to retrieve.')
+    args = parser.parse_args()
+
+    store_path = index_store.default_paths()[-1]
+    store = index_store.get_store()
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((args.n_queries, store.embeddings.shape[1]),
+                                  dtype=np.float32)
+
+    latencies = measure(store.search_captions, queries, args.k)
+    print(f'{"unsharded":>10}: median {statistics.median(latencies) * 1e3:.2f}ms')
+
+    for n_shards in args.shards:
+        scorer = ShardedScorer(store_path, n_shards)
+        # First query pages in each shard.
+        measure(scorer.search_captions, queries[:1], args.k)
+        latencies = measure(scorer.search_captions, queries, args.k)
+        scorer.close()
+        print(f'{n_shards:>3} shards: median '
+              f'{statistics.median(latencies) * 1e3:.2f}ms')
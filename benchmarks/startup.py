@@ -0,0 +1,89 @@
+"""Measures start-up latency of the web application.
+
+Each run imports ``rubrix.web.main`` in a fresh Python process and records:
+    - time taken to import the application,
+    - time-to-first-request, i.e., until ``/healthz`` is served,
+    - time until ``/readyz`` reports all models as loaded,
+    - time until the first text query is answered.
+
+Usage:
+------
+    $ python benchmarks/startup.py --runs 3 --prompt "a dog on the beach"
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+# Script run in a fresh interpreter for every measurement, so that import
+# costs of Tensorflow, SpaCy and OpenCV are part of the measurement.
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+from rubrix.web.main import app
+imported = time.perf_counter() - start
+client = app.test_client()
+client.get('/healthz')
+first_request = time.perf_counter() - start
+first_query = None
+if sys.argv[1]:
+    client.post('/', json={'prompt': sys.argv[1]})
+    first_query = time.perf_counter() - start
+ready = None
+while sys.argv[2] == '1' and client.get('/readyz').status_code != 200:
+    time.sleep(0.05)
+if sys.argv[2] == '1':
+    ready = time.perf_counter() - start
+print(json.dumps({'import': imported, 'first_request': first_request,
+                  'first_query': first_query, 'ready': ready}))
+"""
+
+
+def measure(prompt, warm_up=True):
+    """Starts the web application in a new process and measures its
+    start-up latency.
+
+    Arguments:
+    ----------
+        prompt (str):
+            Text query issued as the first search request. No query is
+            issued if empty.
+        warm_up (bool):
+            If True, models are loaded by the background warm-up thread.
+            Otherwise, models are loaded on first use and readiness is not
+            measured.
+
+    Returns:
+    --------
+        timings (dict):
+            Mapping from milestone to seconds since process start.
+    """
+    flag = '1' if warm_up else '0'
+    env = dict(os.environ, RUBRIX_WARM_UP=flag)
+    output = subprocess.run([sys.executable, '-c', CHILD, prompt, flag],
+                            env=env, check=True, capture_output=True,
+                            text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark web application '
+                                                 'start-up.')
+    parser.add_argument('--runs', dest='runs', type=int, default=3,
+                        help='Number of measurements.')
+    parser.add_argument('--prompt', dest='prompt', type=str, default='',
+                        help='Text query issued as the first search.')
+    parser.add_argument('--no-warm-up', dest='warm_up', action='store_false',
+                        help='Load models on first use instead.')
+    args = parser.parse_args()
+
+    runs = [measure(args.prompt, args.warm_up) for _ in range(args.runs)]
+
+    for milestone in ['import', 'first_request', 'first_query', 'ready']:
+        values = [run[milestone] for run in runs if run[milestone] is not None]
+        if values:
+            print(f'{milestone:>14}: median {statistics.median(values):.3f}s '
+                  f'(min {min(values):.3f}s, max {max(values):.3f}s)')
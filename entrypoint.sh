@@ -1,4 +1,10 @@
 #!/bin/bash
 service nginx start
 cd /var/www/rubrix/rubrix/web
-uwsgi --ini uwsgi.ini --lazy-apps
\ No newline at end of file
+# With RUBRIX_PRELOAD=1, the app (and its index store) is loaded once in the
+# uWSGI master and shared by the workers, instead of once per worker.
+if [ "$RUBRIX_PRELOAD" = "1" ]; then
+    uwsgi --ini uwsgi.ini
+else
+    uwsgi --ini uwsgi.ini --lazy-apps
+fi
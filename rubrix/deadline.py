@@ -0,0 +1,135 @@
+"""Latency budgets of queries.
+
+A query run with a :class: ``Deadline`` degrades, rather than running late,
+when its remaining time is short. Before a stage which can be skipped or
+cut short, the remaining time is compared with the typical (median)
+duration of that stage, as recorded in ``rubrix_stage_seconds``:
+    - ``exact_labels``: similar-word expansion is skipped, and query nouns
+      only match the object labels they are equal to.
+    - ``capped_candidates``: at most ``DEADLINE_BUDGET`` images are scored
+      per object label (see the ``budget`` of :method:
+      ``rubrix.index.store.IndexStore.candidates``).
+    - ``partial``: scoring stops once the deadline has passed, and the best
+      results among the images scored so far are returned. Delta segments
+      and shard servers not searched in time are left out as well.
+
+Degradations applied to a query are recorded in its deadline, so that they
+can be reported along with its results, and are counted in
+``rubrix_degradations_total``.
+
+The deadline of the query running in a thread is set by :method: ``scope``,
+and found by the stores with :method: ``current``, the same way as traces
+are (see :mod: ``rubrix.metrics``).
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from rubrix import metrics
+
+
+EXACT_LABELS, CAPPED_CANDIDATES, PARTIAL = ('exact_labels',
+                                            'capped_candidates', 'partial')
+
+# Maximum number of images scored per label, by queries short of time.
+DEADLINE_BUDGET = int(os.environ.get('RUBRIX_DEADLINE_BUDGET', 1000))
+
+# Number of queries to which each degradation was applied.
+DEGRADATIONS = metrics.register(metrics.Counter(
+    'rubrix_degradations_total',
+    'Number of queries degraded to meet their deadline, per degradation.'))
+
+_local = threading.local()
+
+
+class Deadline:
+    """Point in time by which a query should have completed.
+    """
+    def __init__(self, seconds):
+        """Initializes :class: ``Deadline``.
+
+        Arguments:
+        ----------
+            seconds (float):
+                Latency budget of the query, from now.
+        """
+        self.seconds = seconds
+        self.expires = time.perf_counter() + seconds
+        self.degradations = []
+
+    def remaining(self):
+        """Returns the time (in seconds) left until the deadline.
+        """
+        return self.expires - time.perf_counter()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, stage):
+        """Checks if stage ``stage`` typically completes within the time
+        left. Stages which were never timed are allowed.
+        """
+        typical = metrics.STAGE_SECONDS.quantile(0.5, stage=stage)
+        return typical is None or typical < self.remaining()
+
+    def degrade(self, degradation):
+        """Records that ``degradation`` was applied to the query.
+        """
+        if degradation not in self.degradations:
+            self.degradations.append(degradation)
+            DEGRADATIONS.inc(degradation=degradation)
+
+
+def current():
+    """Returns the deadline of the query running in this thread, if any.
+    """
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def scope(deadline):
+    """Sets ``deadline`` as the deadline of the enclosed query.
+
+    Arguments:
+    ----------
+        deadline (Deadline or float or None):
+            Deadline, or latency budget (in seconds) of the query. If None,
+            the query has no deadline.
+
+    Returns:
+    --------
+        deadline (Deadline or None):
+            Deadline of the query.
+    """
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)
+    previous = current()
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = previous
+
+
+def cap_budget(budget):
+    """Caps ``budget`` to ``DEADLINE_BUDGET`` if the query running in this
+    thread is not expected to be ranked in time.
+
+    Arguments:
+    ----------
+        budget (int or None):
+            Maximum number of images to score per label.
+
+    Returns:
+    --------
+        budget (int or None):
+            Budget of the query.
+    """
+    deadline = current()
+    if deadline is None or deadline.allows('rank'):
+        return budget
+    if budget is not None and budget <= DEADLINE_BUDGET:
+        return budget
+    deadline.degrade(CAPPED_CANDIDATES)
+    return DEADLINE_BUDGET
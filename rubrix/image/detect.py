@@ -9,6 +9,8 @@ import cv2
 
 import numpy as np
 
+from rubrix import metrics
+
 
 def get_yolo_net(cfg_path, weights_path):
     """Loads pretrained YOLOv4 model.
@@ -30,7 +32,8 @@ def get_yolo_net(cfg_path, weights_path):
         raise Exception('Missing inputs. See file.')
 
     print('[INFO] Loading YOLOv4 net from disk.')
-    net = cv2.dnn.readNetFromDarknet(str(cfg_path), str(weights_path))
+    with metrics.span('yolo_load'):
+        net = cv2.dnn.readNetFromDarknet(str(cfg_path), str(weights_path))
 
     return net
 
@@ -55,6 +58,61 @@ def get_labels(names_path):
     return labels
 
 
+def forward(net, image):
+    """Forwards ``image`` through the network.
+
+    Arguments:
+    ----------
+        net (cv2.dnn.Net):
+            Pretrained YOLOv4 model.
+        image (numpy.ndarray):
+            Image.
+
+    Returns:
+    --------
+        detections (numpy.ndarray):
+            One row per candidate box, i.e., box center, width and height
+            (relative to the image size), objectness, and class scores.
+    """
+    return forward_batch(net, [image])[0]
+
+
+def forward_batch(net, images):
+    """Forwards ``images`` through the network, as a single batch.
+
+    Arguments:
+    ----------
+        net (cv2.dnn.Net):
+            Pretrained YOLOv4 model.
+        images (list of numpy.ndarray):
+            Images, which may differ in size.
+
+    Returns:
+    --------
+        detections (list of numpy.ndarray):
+            Detections of each image, as returned by :method: ``forward``.
+    """
+    # Determine only the *output* layer names that we need from YOLOv4.
+    layer_names = net.getLayerNames()
+    layer_names = [layer_names[pos[0] - 1] for pos in net.getUnconnectedOutLayers()]
+
+    # Construct a blob from the input images.
+    blob = cv2.dnn.blobFromImages(images, 1 / 255.0, (416, 416),
+                                  swapRB=True, crop=False)
+
+    # Extract layer outputs from forward pass for the input images.
+    with metrics.span('yolo_forward'):
+        net.setInput(blob)
+        layer_outputs = net.forward(layer_names)
+
+    # Depending on the OpenCV version, the detections of a batch are
+    # either stacked along a first axis, or concatenated image by image.
+    layer_outputs = [output.reshape(len(images), -1, output.shape[-1])
+                     for output in layer_outputs]
+    return [np.concatenate([output[i] for output in layer_outputs])
+            for i in range(len(images))]
+
+
 def detect_objects(net, labels, image, confidence_threshold):
     """Detect objects in `image` by forwarding data through the network.
 
@@ -74,31 +132,116 @@ def detect_objects(net, labels, image, confidence_threshold):
         objects (set):
             Set of objects in the image.
     """
-    # Determine only the *output* layer names that we need from YOLOv4.
-    layer_names = net.getLayerNames()
-    layer_names = [layer_names[pos[0] - 1] for pos in net.getUnconnectedOutLayers()]
+    scores = detect_objects_with_scores(net, labels, image,
+                                        confidence_threshold)
+    return set(scores)
+
+
+def detect_objects_with_scores(net, labels, image, confidence_threshold):
+    """Detect objects in `image`, along with the confidence of the most
+    confident detection of each object, and the area of its largest box.
+
+    Arguments:
+    ----------
+        net (cv2.dnn.Net):
+            Pretrained YOLOv4 model.
+        labels (list):
+            Labels.
+        image (numpy.ndarray):
+            Image.
+        confidence_threshold (float):
+            Threshold for determining bounding box consideration.
 
-    # Construct a blob from the input image.
-    blob = cv2.dnn.blobFromImage(image, 1 / 255.0, (416, 416),
-                                 swapRB=True, crop=False)
+    Returns:
+    --------
+        objects (dict):
+            Mapping from object in the image to a tuple of maximum
+            confidence and maximum box area (as a fraction of the image).
+    """
+    class_ids, confidences, boxes = raw_detections(net, image,
+                                                   confidence_threshold)
+    return summarize_detections(labels, class_ids, confidences, boxes,
+                                confidence_threshold)
 
-    # Extract layer outputs from forward pass for the input image.
-    net.setInput(blob)
-    layer_outputs = net.forward(layer_names)
 
-    class_ids = []
-    for output in layer_outputs:
-        for detection in output:
-            # Extract the class ID and confidence (i.e., probability) of
-            # the current object detection
-            scores = detection[5:]
-            class_id = np.argmax(scores)
-            confidence = scores[class_id]
+def raw_detections(net, image, min_confidence):
+    """Detects objects in ``image``, keeping every candidate box whose class
+    confidence exceeds ``min_confidence``.
 
-            # Filter out weak predictions.
-            if confidence > confidence_threshold:
-                class_ids.append(class_id)
+    Arguments:
+    ----------
+        net (cv2.dnn.Net):
+            Pretrained YOLOv4 model.
+        image (numpy.ndarray):
+            Image.
+        min_confidence (float):
+            Boxes with a lower (or equal) confidence are dropped.
 
-    objects = set([labels[i] for i in class_ids])
-    return objects
+    Returns:
+    --------
+        class_ids, confidences, boxes (tuple of numpy.ndarray):
+            Class ID and confidence of each box, and the box center, width
+            and height, relative to the image size.
+    """
+    return filter_detections(forward(net, image), min_confidence)
+
+
+def filter_detections(detections, min_confidence):
+    """Keeps the boxes of ``detections`` whose class confidence exceeds
+    ``min_confidence``.
+
+    Arguments:
+    ----------
+        detections (numpy.ndarray):
+            Detections of an image, as returned by :method: ``forward``.
+        min_confidence (float):
+            Boxes with a lower (or equal) confidence are dropped.
+
+    Returns:
+    --------
+        class_ids, confidences, boxes (tuple of numpy.ndarray):
+            As returned by :method: ``raw_detections``.
+    """
+    # Extract the class ID and confidence (i.e., probability) of each
+    # object detection.
+    scores = detections[:, 5:]
+    class_ids = np.argmax(scores, axis=1)
+    confidences = scores[np.arange(len(scores)), class_ids]
 
+    # Filter out weak predictions.
+    keep = confidences > min_confidence
+    return (class_ids[keep].astype(np.uint16),
+            confidences[keep].astype(np.float32),
+            detections[keep, :4].astype(np.float32))
+
+
+def summarize_detections(labels, class_ids, confidences, boxes,
+                         confidence_threshold):
+    """Summarizes detections into the confidence of the most confident
+    detection of each object, and the area of its largest box.
+
+    Arguments:
+    ----------
+        labels (list):
+            Labels.
+        class_ids, confidences, boxes (numpy.ndarray):
+            Detections, as returned by :method: ``raw_detections``.
+        confidence_threshold (float):
+            Threshold for determining bounding box consideration.
+
+    Returns:
+    --------
+        objects (dict):
+            Mapping from object in the image to a tuple of maximum
+            confidence and maximum box area (as a fraction of the image).
+    """
+    objects = {}
+    for class_id, confidence, box in zip(class_ids, confidences, boxes):
+        if confidence > confidence_threshold:
+            label = labels[class_id]
+            area = float(box[2] * box[3])
+            best_confidence, best_area = objects.get(label, (0.0, 0.0))
+            objects[label] = (max(best_confidence, float(confidence)),
+                              max(best_area, area))
+
+    return objects
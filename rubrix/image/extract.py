@@ -12,6 +12,8 @@ from tensorflow.keras.applications.vgg19 import preprocess_input as vgg19_prepro
 from tensorflow.keras.applications.resnet50 import ResNet50
 from tensorflow.keras.applications.resnet50 import preprocess_input as resnet_preprocess_input
 
+from rubrix import metrics
+
 
 def extract_image_descriptors(path_to_image, model_name, target_size):
     """Encodes an image as a numpy array, based on the image descriptors
@@ -31,29 +33,110 @@ def extract_image_descriptors(path_to_image, model_name, target_size):
         id_array (numpy.ndarray):
             Image descriptor array.
     """
-    preprocess_input = None
+    with metrics.span('cnn_load'):
+        model, preprocess_input = get_cnn(model_name)
+
+    with metrics.span('decode_image'):
+        img = image.load_img(path_to_image, target_size=target_size)
+        array = image.img_to_array(img)
+        array = np.expand_dims(array, axis=0)
+        array = preprocess_input(array)
 
-    if model_name == 'inception':
-        # Keras seems to return mixed_10 layer output and not of
-        # pool_3 layer if ``pooling`` parameter is not set to 'avg'.
-        model = InceptionV3(include_top=False, pooling='avg')
-        preprocess_input = inception_preprocess_input
-    elif model_name == 'vgg16':
-        model = VGG19(include_top=False)
-        preprocess_input = vgg19_preprocess_input
-    elif model_name == 'resnet50':
-        model = ResNet50(include_top=False)
-        preprocess_input = resnet_preprocess_input
-
-    img = image.load_img(path_to_image, target_size=target_size)
-    array = image.img_to_array(img)
-    array = np.expand_dims(array, axis=0)
-    array = preprocess_input(array)
- 
     # Using model(x) instead of model.predict(x) here.
     # This ensures that excessive number of tracings (an expensive
     # operation) are avoided.
-    id_array = model(array).numpy()
+    with metrics.span('cnn_forward'):
+        id_array = model(array).numpy()
     id_array = id_array.reshape(-1)
 
     return id_array
+
+
+def get_cnn(model_name):
+    """Instantiates the CNN model architecture ``model_name``.
+
+    Arguments:
+    ----------
+        model_name (str):
+            Key for instantiating CNN model architecture, i.e., one of
+            'inception', 'vgg16' and 'resnet50'.
+
+    Returns:
+    --------
+        model, preprocess_input (tuple):
+            Pretrained model, and the function preprocessing its inputs.
+    """
+    if model_name == 'inception':
+        # Keras seems to return mixed_10 layer output and not of
+        # pool_3 layer if ``pooling`` parameter is not set to 'avg'.
+        return InceptionV3(include_top=False, pooling='avg'), \
+            inception_preprocess_input
+    elif model_name == 'vgg16':
+        return VGG19(include_top=False), vgg19_preprocess_input
+    elif model_name == 'resnet50':
+        return ResNet50(include_top=False), resnet_preprocess_input
+    raise ValueError(f'Unknown model: {model_name}')
+
+
+def extract_pixel_descriptors(model, preprocess_input, pixels):
+    """Encodes decoded and resized images as image descriptors, in a single
+    batch.
+
+    Arguments:
+    ----------
+        model (tensorflow.keras.Model):
+            CNN model, as returned by :method: ``get_cnn``.
+        preprocess_input (callable):
+            Function preprocessing the inputs of ``model``.
+        pixels (numpy.ndarray):
+            Images, as an array of shape (n, height, width, 3) in RGB
+            channel order.
+
+    Returns:
+    --------
+        id_arrays (numpy.ndarray):
+            Image descriptor array of each image, one per row.
+    """
+    array = preprocess_input(np.asarray(pixels, dtype=np.float32))
+
+    with metrics.span('cnn_forward'):
+        id_arrays = model(array).numpy()
+
+    return id_arrays.reshape(len(pixels), -1)
+
+
+def extract_batch_descriptors(model, images, target_size):
+    """Encodes images already decoded by OpenCV as image descriptors, with
+    InceptionV3, in a single batch.
+
+    Images are resized with nearest-neighbour interpolation, as
+    :method: ``tensorflow.keras.preprocessing.image.load_img`` does in
+    :method: ``extract_image_descriptors``, and with the same sampling as
+    PIL on OpenCV 4.5 and above.
+
+    Arguments:
+    ----------
+        model (tensorflow.keras.Model):
+            InceptionV3 model, with average pooling.
+        images (list of numpy.ndarray):
+            Images, in BGR channel order as returned by ``cv2.imread``.
+        target_size (tuple):
+            Tuple of integers, dimensions to resize input images to.
+
+    Returns:
+    --------
+        id_arrays (numpy.ndarray):
+            Image descriptor array of each image, one per row.
+    """
+    import cv2
+
+    with metrics.span('resize_image'):
+        array = np.stack([
+            cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2RGB),
+                       (target_size[1], target_size[0]),
+                       interpolation=getattr(cv2, 'INTER_NEAREST_EXACT',
+                                             cv2.INTER_NEAREST))
+            for img in images])
+
+    return extract_pixel_descriptors(model, inception_preprocess_input,
+                                     array)
@@ -0,0 +1,253 @@
+"""Aggregated caption embeddings, scoring one vector per image instead of
+every caption of the image.
+
+An image is normally scored by the best of its (about five) caption
+embeddings. A store built with aggregates instead keeps, for each image:
+    - ``mean``: the mean of its caption embeddings,
+    - ``normalized``: the mean of its caption embeddings, scaled to unit
+      norm,
+and, with ``n_prototypes > 1``, that many such vectors per image, one per
+cluster of its captions (images with fewer captions keep each caption). An
+image is then scored by its best prototype, which takes ``n_prototypes``
+dot products per image.
+
+Aggregated scores approximate the max over captions. Optionally, the best
+``rerank`` images by aggregated score are rescored against their individual
+captions, which recovers most of the accuracy for a small, fixed cost. When
+the aggregates are built, their accuracy against the max over captions is
+measured (see :method: ``evaluate_aggregates``) and reported.
+"""
+import json
+
+import numpy as np
+
+
+# Files making up the aggregates, within the store directory.
+AGGREGATES_FILE = 'aggregates.npy'
+AGGREGATES_INFO_FILE = 'aggregates.json'
+
+MEAN, NORMALIZED = 'mean', 'normalized'
+
+# Number of k-means iterations for clustering the captions of an image.
+PROTOTYPE_ITERATIONS = 5
+
+
+class CaptionAggregates:
+    """Aggregated caption embeddings of each image.
+    """
+    def __init__(self, vectors, method=MEAN, n_prototypes=1, rerank=0,
+                 report=None):
+        """Initializes :class: ``CaptionAggregates``.
+
+        Arguments:
+        ----------
+            vectors (numpy.ndarray):
+                Aggregated vectors, ``n_prototypes`` rows per image.
+            method (str):
+                Either ``MEAN`` or ``NORMALIZED``.
+            n_prototypes (int):
+                Number of vectors per image.
+            rerank (int):
+                Number of best images by aggregated score to rescore against
+                their individual captions. If 0, images are not rescored.
+            report (dict):
+                Accuracy against the max over captions, as returned by
+                :method: ``evaluate_aggregates``.
+        """
+        self.vectors = vectors
+        self.method = method
+        self.n_prototypes = n_prototypes
+        self.rerank = rerank
+        self.report = report
+
+    @classmethod
+    def load(cls, store_path, mmap=True):
+        """Loads the aggregates from ``store_path``, or returns None if the
+        store has none.
+        """
+        if not (store_path / AGGREGATES_INFO_FILE).is_file():
+            return None
+        with open(store_path / AGGREGATES_INFO_FILE, 'r') as info_file:
+            info = json.load(info_file)
+        return cls(np.load(store_path / AGGREGATES_FILE,
+                           mmap_mode='r' if mmap else None),
+                   info['method'], info['prototypes'], info['rerank'],
+                   info.get('report'))
+
+    def save(self, store_path):
+        np.save(store_path / AGGREGATES_FILE, self.vectors)
+        with open(store_path / AGGREGATES_INFO_FILE, 'w') as info_file:
+            json.dump({'method': self.method,
+                       'prototypes': self.n_prototypes,
+                       'rerank': self.rerank,
+                       'report': self.report}, info_file, indent=4)
+
+    def slice(self, start, stop):
+        return CaptionAggregates(
+            self.vectors[start * self.n_prototypes:stop * self.n_prototypes],
+            self.method, self.n_prototypes, self.rerank, self.report)
+
+    def score(self, array, ids):
+        """Scores images ``ids`` by their best aggregated vector.
+
+        Arguments:
+        ----------
+            array (numpy.ndarray):
+                Sentence embedding of the query.
+            ids (numpy.ndarray):
+                Sorted image IDs.
+
+        Returns:
+        --------
+            scores (numpy.ndarray):
+                Score of each image in ``ids``.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.float32)
+        n = self.n_prototypes
+        if ids[-1] - ids[0] == len(ids) - 1:
+            vectors = self.vectors[ids[0] * n:(ids[-1] + 1) * n]
+        else:
+            vectors = self.vectors[(ids[:, None] * n + np.arange(n)).ravel()]
+        return (vectors @ array).reshape(-1, n).max(axis=1)
+
+
+def build_aggregates(embeddings, offsets, method=MEAN, n_prototypes=1,
+                     rerank=0, seed=0):
+    """Aggregates the caption embeddings of each image.
+
+    Arguments:
+    ----------
+        embeddings (numpy.ndarray):
+            Caption embeddings, one row per caption.
+        offsets (numpy.ndarray):
+            Start row of the caption embeddings of each image, followed by
+            the total number of caption embeddings.
+        method (str):
+            Either ``MEAN`` or ``NORMALIZED``.
+        n_prototypes (int):
+            Number of vectors per image.
+        rerank (int):
+            Number of images to rescore against their captions at query
+            time.
+        seed (int):
+            Seed for clustering captions into prototypes.
+
+    Returns:
+    --------
+        aggregates (CaptionAggregates):
+            Aggregated caption embeddings.
+    """
+    if method not in (MEAN, NORMALIZED):
+        raise ValueError(f'Unknown aggregation method: {method}.')
+
+    rng = np.random.default_rng(seed)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    n_images, dim = len(counts), embeddings.shape[1]
+    vectors = np.zeros((n_images, n_prototypes, dim), dtype=np.float32)
+    if n_prototypes == 1:
+        captioned = np.flatnonzero(counts > 0)
+        if len(captioned):
+            vectors[captioned, 0] = np.add.reduceat(
+                np.asarray(embeddings, dtype=np.float32),
+                offsets[captioned]) / counts[captioned, None]
+    else:
+        for image_id in np.flatnonzero(counts > 0):
+            captions = np.asarray(
+                embeddings[offsets[image_id]:offsets[image_id + 1]],
+                dtype=np.float32)
+            vectors[image_id] = _prototypes(captions, n_prototypes, rng)
+
+    if method == NORMALIZED:
+        norms = np.linalg.norm(vectors, axis=2, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+    return CaptionAggregates(vectors.reshape(-1, dim), method, n_prototypes,
+                             rerank)
+
+
+def _prototypes(captions, n_prototypes, rng):
+    """Clusters ``captions`` into ``n_prototypes`` means. With no more
+    captions than prototypes, each caption is its own prototype, and the
+    remaining prototypes repeat the first caption.
+    """
+    if len(captions) <= n_prototypes:
+        return np.concatenate([captions, np.repeat(
+            captions[:1], n_prototypes - len(captions), axis=0)])
+    means = captions[rng.choice(len(captions), n_prototypes, replace=False)]
+    for _ in range(PROTOTYPE_ITERATIONS):
+        assignments = np.argmax(captions @ means.T, axis=1)
+        for cluster in range(n_prototypes):
+            members = captions[assignments == cluster]
+            if len(members):
+                means[cluster] = members.mean(axis=0)
+    return means
+
+
+def evaluate_aggregates(store, aggregates, n_queries=200, k=5, seed=0):
+    """Measures how well ``aggregates`` reproduce the top ``k`` images by
+    max over captions, over the whole store.
+
+    Queries are caption embeddings sampled from the store, slightly
+    perturbed so that they do not exactly match a caption.
+
+    Arguments:
+    ----------
+        store (rubrix.index.store.IndexStore):
+            Store the aggregates were built from.
+        aggregates (CaptionAggregates):
+            Aggregated caption embeddings.
+        n_queries (int):
+            Number of queries.
+        k (int):
+            Number of images retrieved per query.
+        seed (int):
+            Seed for sampling queries.
+
+    Returns:
+    --------
+        report (dict):
+            Mean recall of the top ``k`` by max over captions, without and
+            with reranking, and the fraction of dot products computed
+            (relative to scoring every caption). Without reranking in the
+            aggregates, reranking is evaluated for ``10 * k`` images.
+    """
+    from rubrix.index.store import top_k
+
+    rng = np.random.default_rng(seed)
+    n_rows = int(store.offsets[-1])
+    ids = np.arange(len(store), dtype=np.int32)
+    captioned = np.diff(store.offsets) > 0
+    rerank = max(aggregates.rerank or 10 * k, k)
+
+    recall, recall_reranked = 0.0, 0.0
+    for row in rng.choice(n_rows, min(n_queries, n_rows), replace=False):
+        array = np.asarray(store.embeddings[row], dtype=np.float32)
+        array = array + rng.normal(0, 0.01, array.shape).astype(np.float32)
+        exact = {_id for _id, _ in top_k(ids, store.score_captions(array,
+                                                                   ids), k)}
+
+        scores = aggregates.score(array, ids)
+        scores[~captioned] = -np.inf
+        approximate = [_id for _id, _ in top_k(ids, scores, rerank)]
+        recall += len(exact & set(approximate[:k])) / k
+
+        candidates = np.sort(np.asarray(approximate, dtype=np.int32))
+        reranked = top_k(candidates,
+                         store.score_captions(array, candidates), k)
+        recall_reranked += len(exact & {_id for _id, _ in reranked}) / k
+
+    n_queries = min(n_queries, n_rows)
+    mean_captions = n_rows / max(1, len(store))
+    rows_scored = len(store) * aggregates.n_prototypes
+    return {
+        'queries': int(n_queries),
+        'k': k,
+        'recall': round(recall / n_queries, 4),
+        'recall_reranked': round(recall_reranked / n_queries, 4),
+        'rerank': rerank,
+        'work_fraction': round(rows_scored / max(1, n_rows), 4),
+        'work_fraction_reranked': round(
+            (rows_scored + rerank * mean_captions) / max(1, n_rows), 4),
+    }
@@ -0,0 +1,140 @@
+"""Inverted-file (IVF) index over the caption embeddings, for approximate
+nearest neighbour search.
+
+Caption embeddings are clustered with k-means, and each cluster keeps the
+rows of the embeddings assigned to it. A query is only scored against the
+embeddings of the ``n_probe`` clusters whose centroids best match it, which
+touches a fraction ``n_probe / n_lists`` of the embeddings, at the cost of
+missing captions assigned to other clusters.
+"""
+import numpy as np
+
+
+# Files making up the IVF index, within the store directory.
+CENTROIDS_FILE = 'ivf_centroids.npy'
+ROWS_FILE = 'ivf_rows.npy'
+LISTS_FILE = 'ivf_lists.npy'
+
+# Number of clusters to probe per query, by default.
+N_PROBE = 8
+
+# k-means is trained on a sample of the embeddings, as centroids barely
+# change beyond a few hundred embeddings per cluster.
+TRAINING_SAMPLE = 65536
+
+
+class IVFIndex:
+    """Clusters of caption embedding rows.
+    """
+    def __init__(self, centroids, rows, lists):
+        """Initializes :class: ``IVFIndex``.
+
+        Arguments:
+        ----------
+            centroids (numpy.ndarray):
+                Cluster centroids, one row per cluster.
+            rows (numpy.ndarray):
+                Caption embedding rows, grouped by cluster, and sorted
+                within each cluster.
+            lists (numpy.ndarray):
+                Start position in ``rows`` of each cluster, followed by the
+                number of rows.
+        """
+        self.centroids = centroids
+        self.rows = rows
+        self.lists = lists
+
+    def __len__(self):
+        return len(self.centroids)
+
+    @classmethod
+    def load(cls, store_path, mmap=True):
+        """Loads the IVF index from ``store_path``, or returns None if the
+        store has none.
+        """
+        if not (store_path / CENTROIDS_FILE).is_file():
+            return None
+        mmap_mode = 'r' if mmap else None
+        return cls(np.load(store_path / CENTROIDS_FILE),
+                   np.load(store_path / ROWS_FILE, mmap_mode=mmap_mode),
+                   np.load(store_path / LISTS_FILE))
+
+    def save(self, store_path):
+        np.save(store_path / CENTROIDS_FILE, self.centroids)
+        np.save(store_path / ROWS_FILE, self.rows)
+        np.save(store_path / LISTS_FILE, self.lists)
+
+    def probe(self, array, n_probe=N_PROBE):
+        """Returns the caption embedding rows in the ``n_probe`` clusters
+        whose centroids best match ``array``.
+
+        Arguments:
+        ----------
+            array (numpy.ndarray):
+                Sentence embedding of the query.
+            n_probe (int):
+                Number of clusters to probe.
+
+        Returns:
+        --------
+            rows (numpy.ndarray):
+                Sorted caption embedding rows.
+        """
+        n_probe = min(n_probe, len(self))
+        scores = self.centroids @ array
+        clusters = np.argpartition(-scores, n_probe - 1)[:n_probe]
+        rows = np.concatenate([self.rows[self.lists[c]:self.lists[c + 1]]
+                               for c in clusters])
+        return np.sort(rows)
+
+
+def build_ivf(embeddings, n_lists=None, n_iter=10, seed=0):
+    """Clusters ``embeddings`` with spherical k-means.
+
+    Arguments:
+    ----------
+        embeddings (numpy.ndarray):
+            Caption embeddings, one row per caption.
+        n_lists (int):
+            Number of clusters. Defaults to the square root of the number of
+            embeddings.
+        n_iter (int):
+            Number of k-means iterations.
+        seed (int):
+            Seed for choosing the initial centroids and the training sample.
+
+    Returns:
+    --------
+        index (IVFIndex):
+            IVF index over ``embeddings``.
+    """
+    rng = np.random.default_rng(seed)
+    n_lists = n_lists or max(1, int(np.sqrt(len(embeddings))))
+    n_lists = min(n_lists, len(embeddings))
+
+    sample = embeddings
+    if len(embeddings) > TRAINING_SAMPLE:
+        sample = embeddings[np.sort(rng.choice(len(embeddings),
+                                               TRAINING_SAMPLE,
+                                               replace=False))]
+    sample = np.asarray(sample, dtype=np.float32)
+
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(n_iter):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty clusters keep their previous centroid.
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12),
+                             centroids)
+
+    # Embeddings are assigned in chunks, to bound memory use.
+    assignments = np.concatenate([
+        np.argmax(np.asarray(embeddings[start:start + TRAINING_SAMPLE],
+                             dtype=np.float32) @ centroids.T, axis=1)
+        for start in range(0, len(embeddings), TRAINING_SAMPLE)])
+    rows = np.argsort(assignments, kind='stable').astype(np.int64)
+    lists = np.zeros(n_lists + 1, dtype=np.int64)
+    lists[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+    return IVFIndex(centroids.astype(np.float32), rows, lists)
@@ -0,0 +1,165 @@
+"""Bitmaps over image IDs, used as posting lists of the inverse-image index.
+
+Bit ``i`` of the bitmap of an object is set if image ``i`` contains the
+object. Unions and intersections of posting lists are then bitwise ORs and
+ANDs over packed bytes, which take time proportional to the number of images
+divided by 8, instead of building and merging sets of paths.
+
+In the catalog, each posting list is stored either as a packed bitmap or,
+when the object is rare enough for it to take less space, as a sorted array
+of image IDs (similar to the containers of Roaring bitmaps).
+"""
+import numpy as np
+
+
+# Posting list encodings in the catalog.
+ARRAY, BITMAP = 0, 1
+
+# Number of set bits in each byte value.
+_POPCOUNT = np.array([bin(value).count('1') for value in range(256)],
+                     dtype=np.uint8)
+
+
+class Bitmap:
+    """Fixed-size set of image IDs, stored as packed bits.
+    """
+    def __init__(self, data, size):
+        """Initializes :class: ``Bitmap``.
+
+        Arguments:
+        ----------
+            data (numpy.ndarray):
+                Packed bits (uint8), with bit ``i`` of the set at bit
+                ``i % 8`` of byte ``i // 8``.
+            size (int):
+                Number of image IDs in the universe.
+        """
+        self.data = data
+        self.size = size
+
+    @classmethod
+    def from_ids(cls, ids, size):
+        """Creates bitmap from image IDs ``ids`` among ``size`` images.
+        """
+        bits = np.zeros(size, dtype=bool)
+        bits[np.asarray(ids, dtype=np.int64)] = True
+        return cls(np.packbits(bits, bitorder='little'), size)
+
+    @classmethod
+    def empty(cls, size):
+        return cls(np.zeros((size + 7) // 8, dtype=np.uint8), size)
+
+    @classmethod
+    def full(cls, size):
+        return cls.from_ids(np.arange(size), size)
+
+    def __or__(self, other):
+        return Bitmap(self.data | other.data, self.size)
+
+    def __and__(self, other):
+        return Bitmap(self.data & other.data, self.size)
+
+    def __len__(self):
+        return self.cardinality()
+
+    def cardinality(self):
+        """Returns the number of image IDs in the set.
+        """
+        return int(_POPCOUNT[self.data].sum(dtype=np.int64))
+
+    def to_ids(self, start=0, stop=None):
+        """Returns sorted image IDs in the set, within ``[start, stop)``.
+
+        Arguments:
+        ----------
+            start (int):
+                Smallest image ID to return.
+            stop (int):
+                Image IDs returned are smaller than this. Defaults to size
+                of the universe.
+
+        Returns:
+        --------
+            ids (numpy.ndarray):
+                Sorted array of image IDs.
+        """
+        stop = self.size if stop is None else stop
+        first_byte = start // 8
+        bits = np.unpackbits(self.data[first_byte:(stop + 7) // 8],
+                             bitorder='little')
+        ids = np.flatnonzero(bits).astype(np.int32) + first_byte * 8
+        return ids[(ids >= start) & (ids < stop)]
+
+    def to_mask(self, start=0, stop=None):
+        """Returns a boolean mask over image IDs in ``[start, stop)``, which
+        is True for image IDs in the set.
+        """
+        stop = self.size if stop is None else stop
+        first_byte = start // 8
+        bits = np.unpackbits(self.data[first_byte:(stop + 7) // 8],
+                             bitorder='little').view(bool)
+        return bits[start - first_byte * 8:stop - first_byte * 8]
+
+
+def union(bitmaps, size):
+    """Returns the union of ``bitmaps``, or an empty set if there are none.
+    """
+    if not bitmaps:
+        return Bitmap.empty(size)
+    return Bitmap(np.bitwise_or.reduce([bitmap.data for bitmap in bitmaps]),
+                  size)
+
+
+def intersection(bitmaps, size):
+    """Returns the intersection of ``bitmaps``, or the set of all images if
+    there are none.
+    """
+    if not bitmaps:
+        return Bitmap.full(size)
+    return Bitmap(np.bitwise_and.reduce([bitmap.data for bitmap in bitmaps]),
+                  size)
+
+
+def encode(ids, size):
+    """Encodes posting list ``ids`` in the smaller of the two encodings.
+
+    Arguments:
+    ----------
+        ids (array_like):
+            Sorted image IDs.
+        size (int):
+            Number of image IDs in the universe.
+
+    Returns:
+    --------
+        kind, data (tuple):
+            Encoding (``ARRAY`` or ``BITMAP``), and encoded bytes (uint8).
+    """
+    ids = np.asarray(ids, dtype='<i4')
+    if ids.nbytes <= (size + 7) // 8:
+        return ARRAY, ids.view(np.uint8)
+    return BITMAP, Bitmap.from_ids(ids, size).data
+
+
+def decode(kind, data, size, cardinality):
+    """Decodes a posting list encoded by :method: ``encode`` as a bitmap.
+
+    Arguments:
+    ----------
+        kind (int):
+            Encoding (``ARRAY`` or ``BITMAP``).
+        data (numpy.ndarray):
+            Encoded bytes (uint8), possibly followed by padding.
+        size (int):
+            Number of image IDs in the universe.
+        cardinality (int):
+            Number of image IDs in the posting list.
+
+    Returns:
+    --------
+        (Bitmap):
+            Decoded posting list.
+    """
+    if kind == BITMAP:
+        return Bitmap(data[:(size + 7) // 8], size)
+    return Bitmap.from_ids(data[:4 * cardinality].view('<i4'), size)
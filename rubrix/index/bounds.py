@@ -0,0 +1,200 @@
+"""Upper bounds on the caption scores of each image, for early termination.
+
+An image is scored by the maximum dot product of the query with the
+embeddings of its captions. For the captions ``e_j`` of an image, with
+centroid ``c`` and radius ``r = max_j ||e_j - c||``, and a query ``q``:
+
+    q . e_j = q . c + q . (e_j - c) <= q . c + ||q|| * r
+    q . e_j <= ||q|| * max_j ||e_j||
+
+so the score of the image is at most the smaller of the two bounds, which
+takes a single dot product to compute. Candidate images are visited in
+decreasing order of their bounds, and scoring stops once the k-th best
+score found exceeds the bound of the next image: no image left can enter the
+top-k, hence the results are identical to scoring every candidate.
+"""
+import numpy as np
+
+from rubrix import deadline
+
+
+# Files making up the bounds, within the store directory.
+CENTROIDS_FILE = 'centroids.npy'
+BOUNDS_FILE = 'bounds.npy'
+
+# Bounds are loosened by this much (relative to the norm of the query), so
+# that rounding errors never make a bound smaller than the score it bounds.
+TOLERANCE = 1e-4
+
+# Number of images scored in the first batch, as a multiple of ``k``. Each
+# following batch is twice as large as the previous one.
+FIRST_BATCH = 4
+
+
+class CaptionBounds:
+    """Centroid, radius and maximum norm of the caption embeddings of each
+    image.
+    """
+    def __init__(self, centroids, radii, norms):
+        """Initializes :class: ``CaptionBounds``.
+
+        Arguments:
+        ----------
+            centroids (numpy.ndarray):
+                Mean of the caption embeddings of each image (one row per
+                image).
+            radii (numpy.ndarray):
+                Largest distance from a caption embedding of each image to
+                its centroid, or -inf for images without captions.
+            norms (numpy.ndarray):
+                Largest norm of a caption embedding of each image, or -inf
+                for images without captions.
+        """
+        self.centroids = centroids
+        self.radii = radii
+        self.norms = norms
+
+    @classmethod
+    def load(cls, store_path, mmap=True):
+        """Loads the bounds from ``store_path``, or returns None if the store
+        has none.
+        """
+        if not (store_path / BOUNDS_FILE).is_file():
+            return None
+        bounds = np.load(store_path / BOUNDS_FILE)
+        return cls(np.load(store_path / CENTROIDS_FILE,
+                           mmap_mode='r' if mmap else None),
+                   bounds[:, 0], bounds[:, 1])
+
+    def save(self, store_path):
+        np.save(store_path / CENTROIDS_FILE, self.centroids)
+        np.save(store_path / BOUNDS_FILE,
+                np.stack([self.radii, self.norms], axis=1))
+
+    def slice(self, start, stop):
+        return CaptionBounds(self.centroids[start:stop],
+                             self.radii[start:stop], self.norms[start:stop])
+
+    def upper_bounds(self, array, ids):
+        """Returns an upper bound on the caption score of images ``ids``.
+
+        Arguments:
+        ----------
+            array (numpy.ndarray):
+                Sentence embedding of the query.
+            ids (numpy.ndarray):
+                Sorted image IDs.
+
+        Returns:
+        --------
+            bounds (numpy.ndarray):
+                Upper bound of each image in ``ids``.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) and ids[-1] - ids[0] == len(ids) - 1:
+            centroids = self.centroids[ids[0]:ids[-1] + 1]
+        else:
+            centroids = self.centroids[ids]
+        norm = np.linalg.norm(array)
+        return np.minimum(centroids @ array + norm * self.radii[ids],
+                          norm * self.norms[ids]) + TOLERANCE * norm
+
+
+def build_bounds(embeddings, offsets):
+    """Computes the bounds of the caption embeddings of each image.
+
+    Arguments:
+    ----------
+        embeddings (numpy.ndarray):
+            Caption embeddings, one row per caption.
+        offsets (numpy.ndarray):
+            Start row of the caption embeddings of each image, followed by
+            the total number of caption embeddings.
+
+    Returns:
+    --------
+        bounds (CaptionBounds):
+            Bounds of each image.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    n_images, dim = len(counts), embeddings.shape[1]
+    centroids = np.zeros((n_images, dim), dtype=np.float32)
+    radii = np.full(n_images, -np.inf, dtype=np.float32)
+    norms = np.full(n_images, -np.inf, dtype=np.float32)
+
+    captioned = np.flatnonzero(counts > 0)
+    if len(captioned) == 0:
+        return CaptionBounds(centroids, radii, norms)
+
+    starts = offsets[captioned]
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    centroids[captioned] = np.add.reduceat(embeddings, starts) / \
+        counts[captioned, None]
+
+    # Image of each caption embedding row.
+    owners = np.repeat(np.arange(n_images), counts)
+    distances = np.linalg.norm(embeddings - centroids[owners], axis=1)
+    radii[captioned] = np.maximum.reduceat(distances, starts)
+    norms[captioned] = np.maximum.reduceat(
+        np.linalg.norm(embeddings, axis=1), starts)
+    return CaptionBounds(centroids, radii, norms)
+
+
+def bounded_search(store, array, ids, k):
+    """Scores images ``ids`` in decreasing order of their upper bounds, until
+    no image left can enter the top ``k``.
+
+    Arguments:
+    ----------
+        store (rubrix.index.store.IndexStore):
+            Store, with caption bounds.
+        array (numpy.ndarray):
+            Sentence embedding of the query.
+        ids (numpy.ndarray):
+            Sorted IDs of candidate images.
+        k (int):
+            Number of images to retrieve.
+
+    Returns:
+    --------
+        ids, scores, n_rows (tuple):
+            IDs of the images scored, their scores, and the number of
+            caption embeddings scored. The top ``k`` of the images scored
+            are the top ``k`` of all candidates, unless the deadline of the
+            query passed before the search completed.
+    """
+    active = deadline.current()
+    bounds = store.bounds.upper_bounds(array, ids)
+    order = np.argsort(-bounds, kind='stable')
+
+    visited_ids, visited_scores = [], []
+    best = np.empty(0, dtype=np.float32)
+    n_rows, position, size = 0, 0, FIRST_BATCH * k
+    while position < len(order):
+        # The k-th best score so far beats every image left.
+        if len(best) >= k and best[k - 1] > bounds[order[position]]:
+            break
+        # Images left are the least promising ones, and are dropped once
+        # the deadline has passed.
+        if visited_ids and active is not None and active.expired():
+            active.degrade(deadline.PARTIAL)
+            break
+        batch = np.sort(ids[order[position:position + size]])
+        scores = store.score_captions(array, batch)
+        n_rows += int((store.offsets[batch + 1] - store.offsets[batch]).sum())
+        visited_ids.append(batch)
+        visited_scores.append(scores)
+        best = -np.sort(-np.concatenate([best, scores]))[:k]
+        position += size
+        size *= 2
+
+    if not visited_ids:
+        return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32),
+                n_rows)
+    # Images are returned by ID, so that ties are broken as they are when
+    # scoring every candidate.
+    visited_ids = np.concatenate(visited_ids)
+    order = np.argsort(visited_ids, kind='stable')
+    return (visited_ids[order], np.concatenate(visited_scores)[order],
+            n_rows)
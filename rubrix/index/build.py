@@ -0,0 +1,594 @@
+"""Builds the index as a graph of stages, replacing ``setup.sh``.
+
+Each stage declares the stages it depends on, the files it reads and the
+files it writes:
+
+    download ──> split ──> captions ──> encodings ──┐
+                   │                                │
+    darknet ──┐    ├─────> descriptors ─────────────┼──> store
+    weights ──┴────┴─────> objects ─────────────────┘
+
+With ``--fused``, the ``objects`` and ``descriptors`` stages are replaced by a
+single ``images`` stage, which decodes each image once for both models.
+
+Stages whose dependencies are complete run concurrently, each in its own
+process, pinned to its own CPU cores and with its own memory limit. A stage
+is only started while its cores and memory fit within those of the build,
+and is stopped if its resident memory exceeds its limit.
+
+A stage is skipped when its outputs exist and the fingerprint of its inputs
+is that of its last successful run. The fingerprint is a SHA-256 hash of the
+contents of all input files, together with the parameters of the stage, so
+touching a file does not rerun a stage, but editing one does. File hashes
+are cached in ``assets/build.json`` by size and modification time, so that
+unchanged images are not read again on every build.
+
+Usage:
+    $ rubrix-build
+    $ rubrix-build --stages objects --force --cpus objects=8
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import resource
+import traceback
+import subprocess
+import urllib.request
+import multiprocessing
+from pathlib import Path
+
+from rubrix import pathfinder
+from rubrix.index.catalog import relative_path
+from rubrix.index.checkpoint import file_hash
+
+
+# File holding the fingerprints and timings of the last build.
+STATE_FILE = 'build.json'
+
+# Environment variables limiting the threads of numerical libraries, set to
+# the number of cores of each stage.
+THREAD_LIMITS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'TF_NUM_INTRAOP_THREADS']
+
+# Seconds between checks of running stages.
+POLL_INTERVAL = 0.5
+
+DARKNET_URL = 'https://github.com/AlexeyAB/darknet.git'
+WEIGHTS_URL = ('https://github.com/AlexeyAB/darknet/releases/download/'
+               'darknet_yolo_v3_optimal/yolov4.weights')
+
+GB = 1 << 30
+
+
+class Stage:
+    """Step of the index build.
+    """
+    def __init__(self, name, function, deps=(), inputs=(), outputs=(),
+                 params=None, cpus=1, memory=1):
+        """Initializes :class: ``Stage``.
+
+        Arguments:
+        ----------
+            name (str):
+                Name of the stage.
+            function (callable):
+                Module-level function running the stage, called with
+                ``params`` as keyword arguments in a child process.
+            deps (list):
+                Names of the stages which must complete first.
+            inputs (list):
+                Paths, relative to the main directory, to the files and
+                directories read by the stage.
+            outputs (list):
+                Paths, relative to the main directory, to the files and
+                directories written by the stage.
+            params (dict):
+                Parameters of the stage, as JSON-serializable values.
+            cpus (int):
+                Number of CPU cores of the stage.
+            memory (float):
+                Memory limit of the stage, in GB.
+        """
+        self.name = name
+        self.function = function
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.cpus = cpus
+        self.memory = memory
+
+
+def download_data():
+    from rubrix.index.download import (DATASET_DIR, DATASET_ID,
+                                       download_and_extract)
+
+    credentials_path = Path.home() / '.kaggle' / 'kaggle.json'
+    if not credentials_path.is_file():
+        raise FileNotFoundError(
+            f'Kaggle API credentials not found at {credentials_path}. Create '
+            f'an API token at https://www.kaggle.com/account.')
+    download_and_extract(DATASET_ID, DATASET_DIR)
+
+
+def split_images(train_size):
+    from rubrix.index.download import move_images, split_data
+
+    data_path = pathfinder.get('assets', 'data')
+    # Images of an earlier split would otherwise remain in both sets.
+    for name in ['train', 'val']:
+        if (data_path / name).is_dir():
+            shutil.rmtree(data_path / name)
+    train_images, val_images = split_data(data_path / 'images', train_size)
+    move_images(data_path / 'images', train_images, val_images)
+
+
+def split_captions():
+    from rubrix.index.download import txt_to_json
+
+    data_path = pathfinder.get('assets', 'data')
+    txt_to_json(data_path / 'captions.txt',
+                sorted((data_path / 'val').iterdir()))
+
+
+def build_darknet(gpu):
+    index_path = pathfinder.get('rubrix', 'index')
+    darknet_path = index_path / 'darknet'
+    if not darknet_path.is_dir():
+        subprocess.run(['git', 'clone', DARKNET_URL, str(darknet_path)],
+                       check=True)
+    if gpu:
+        shutil.copyfile(str(pathfinder.get('assets', 'yolo', 'Makefile-gpu')),
+                        str(darknet_path / 'Makefile'))
+    subprocess.run(['make'], cwd=str(darknet_path), check=True)
+
+
+def download_weights():
+    weights_path = pathfinder.get('assets', 'models', 'yolov4.weights')
+    weights_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = weights_path.with_suffix('.tmp')
+    urllib.request.urlretrieve(WEIGHTS_URL, str(temporary_path))
+    temporary_path.replace(weights_path)
+
+
+def index_objects(thresh):
+    from rubrix.index.objects import create_index
+
+    create_index(_image_paths(),
+                 pathfinder.get('assets', 'models', 'yolov4.weights'),
+                 pathfinder.get('rubrix', 'index', 'darknet', 'cfg',
+                                'yolov4.cfg'),
+                 pathfinder.get('rubrix', 'index', 'darknet', 'data',
+                                'coco.names'),
+                 thresh)
+
+
+def save_descriptors():
+    from rubrix.index.descriptors import save_image_descriptors
+
+    save_image_descriptors(_image_paths())
+
+
+def encode_captions():
+    from rubrix.index.encodings import embedd_captions
+    from rubrix.models import load_sentence_encoder
+
+    embeddings_folder = pathfinder.get('assets', 'data', 'embeddings')
+    embeddings_folder.mkdir(exist_ok=True)
+    ids_to_paths = embedd_captions(load_sentence_encoder(), _captions_paths(),
+                                   embeddings_folder)
+    with open(pathfinder.get('assets', 'imageEmbeddingLocations.json'),
+              'w') as embedding_file:
+        json.dump(ids_to_paths, embedding_file, indent=4)
+
+
+def index_images(thresh):
+    from rubrix.index.fused import index_images
+
+    index_images(_image_paths(),
+                 pathfinder.get('assets', 'models', 'yolov4.weights'),
+                 pathfinder.get('rubrix', 'index', 'darknet', 'cfg',
+                                'yolov4.cfg'),
+                 pathfinder.get('rubrix', 'index', 'darknet', 'data',
+                                'coco.names'),
+                 thresh)
+
+
+def consolidate_store():
+    from rubrix.index.store import build_store, default_paths
+
+    build_store(*default_paths())
+
+
+def _image_paths():
+    return [pathfinder.get('assets', 'data', 'train'),
+            pathfinder.get('assets', 'data', 'val')]
+
+
+def _captions_paths():
+    return [pathfinder.get('assets', 'data', 'train_captions.json'),
+            pathfinder.get('assets', 'data', 'val_captions.json')]
+
+
+def default_stages(train_size=0.8, thresh=0.5, gpu=False, fused=False):
+    """Returns the stages of the index build.
+
+    Arguments:
+    ----------
+        train_size (float):
+            Percentage of images in train set.
+        thresh (float):
+            Confidence threshold of object detections.
+        gpu (bool):
+            If True, darknet is built with the GPU Makefile.
+        fused (bool):
+            If True, the object index and descriptors are built by a single
+            ``images`` stage, which decodes each image once (see :mod:
+            ``rubrix.index.fused``), rather than by two concurrent stages.
+
+    Returns:
+    --------
+        stages (list of Stage):
+            Stages, in an order compatible with their dependencies.
+    """
+    images = ['assets/data/train', 'assets/data/val']
+    captions = ['assets/data/train_captions.json',
+                'assets/data/val_captions.json']
+    darknet = ['rubrix/index/darknet/cfg/yolov4.cfg',
+               'rubrix/index/darknet/data/coco.names']
+    weights = ['assets/models/yolov4.weights']
+    if fused:
+        image_stages = [
+            Stage('images', index_images,
+                  deps=['split', 'darknet', 'weights'],
+                  inputs=images + darknet + weights,
+                  outputs=['assets/index.json', 'assets/objectScores.json',
+                           'assets/data/descriptors'],
+                  params={'thresh': thresh}, cpus=8, memory=8),
+        ]
+    else:
+        image_stages = [
+            Stage('objects', index_objects,
+                  deps=['split', 'darknet', 'weights'],
+                  inputs=images + darknet + weights,
+                  outputs=['assets/index.json', 'assets/objectScores.json'],
+                  params={'thresh': thresh}, cpus=4, memory=4),
+            Stage('descriptors', save_descriptors, deps=['split'],
+                  inputs=images, outputs=['assets/data/descriptors'],
+                  cpus=4, memory=6),
+        ]
+    return [
+        Stage('download', download_data,
+              outputs=['assets/data/images', 'assets/data/captions.txt']),
+        Stage('split', split_images, deps=['download'],
+              inputs=['assets/data/images'], outputs=images,
+              params={'train_size': train_size}),
+        Stage('captions', split_captions, deps=['download', 'split'],
+              inputs=['assets/data/captions.txt', 'assets/data/val'],
+              outputs=captions),
+        Stage('darknet', build_darknet, outputs=darknet,
+              params={'gpu': gpu}, cpus=4),
+        Stage('weights', download_weights, outputs=weights),
+        *image_stages,
+        Stage('encodings', encode_captions, deps=['captions'],
+              inputs=captions,
+              outputs=['assets/imageEmbeddingLocations.json',
+                       'assets/data/embeddings'],
+              cpus=4, memory=6),
+        Stage('store', consolidate_store,
+              deps=[stage.name for stage in image_stages] + ['encodings'],
+              inputs=['assets/index.json', 'assets/objectScores.json',
+                      'assets/imageEmbeddingLocations.json',
+                      'assets/data/descriptors', 'assets/data/embeddings']
+              + captions,
+              outputs=['assets/store/CURRENT'], cpus=2, memory=4),
+    ]
+
+
+class Fingerprints:
+    """Content hashes of stage inputs, with file hashes cached by size and
+    modification time.
+    """
+    def __init__(self, root, cache=None):
+        """Initializes :class: ``Fingerprints``.
+
+        Arguments:
+        ----------
+            root (pathlib.Path):
+                Main directory.
+            cache (dict):
+                Mapping from file path, relative to ``root``, to its size,
+                modification time and SHA-256 hash.
+        """
+        self.root = Path(root)
+        self.cache = cache or {}
+
+    def file(self, path):
+        """Returns the SHA-256 hash of the contents of ``path``.
+        """
+        stat = path.stat()
+        key = relative_path(path, self.root)
+        cached = self.cache.get(key)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = file_hash(path)
+        self.cache[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def stage(self, stage):
+        """Returns the fingerprint of the inputs and parameters of
+        ``stage``.
+        """
+        digest = hashlib.sha256(json.dumps(
+            [stage.name, stage.params], sort_keys=True).encode())
+        for name in stage.inputs:
+            path = self.root / name
+            files = sorted(p for p in path.rglob('*') if p.is_file()) \
+                if path.is_dir() else [path]
+            for file in files:
+                digest.update(relative_path(file, self.root).encode())
+                digest.update(self.file(file).encode() if file.is_file()
+                              else b'missing')
+        return digest.hexdigest()
+
+
+def run_build(stages, names=None, force=False, cpus=None, memory=None,
+              root=None):
+    """Runs ``stages``, concurrently where their dependencies allow.
+
+    Arguments:
+    ----------
+        stages (list of Stage):
+            Stages of the build.
+        names (list):
+            Names of the stages to run, along with the stages they depend
+            on. Defaults to all stages.
+        force (bool):
+            If True, the selected stages run even if their inputs are
+            unchanged.
+        cpus (int):
+            Number of CPU cores of the build. Defaults to those available
+            to this process.
+        memory (float):
+            Memory of the build, in GB. Defaults to the physical memory.
+        root (pathlib.Path):
+            Main directory. Defaults to :method:
+            ``rubrix.pathfinder.get_root``.
+
+    Returns:
+    --------
+        report (dict):
+            Mapping from stage name to its status ('ran', 'skipped',
+            'failed' or 'blocked') and wall time in seconds.
+    """
+    root = pathfinder.get_root() if root is None else Path(root)
+    by_name = {stage.name: stage for stage in stages}
+    selected = _closure(by_name, names or list(by_name))
+    forced = set(names or by_name) if force else set()
+    cores = sorted(os.sched_getaffinity(0))
+    if cpus:
+        cores = cores[:cpus]
+    memory = memory or _physical_memory()
+
+    state_path = root / 'assets' / STATE_FILE
+    state = _read_state(state_path)
+    fingerprints = Fingerprints(root, state.get('hashes'))
+
+    pending = [stage for stage in stages if stage.name in selected]
+    running, report = {}, {}
+    context = multiprocessing.get_context('spawn')
+    while pending or running:
+        for stage in list(pending):
+            statuses = [report.get(dep, {}).get('status')
+                        for dep in stage.deps if dep in selected]
+            if any(status in ('failed', 'blocked') for status in statuses):
+                pending.remove(stage)
+                report[stage.name] = {'status': 'blocked', 'seconds': 0.0}
+                print(f'[WARNING] Stage {stage.name} blocked by a failed '
+                      f'dependency.')
+                continue
+            if not all(status in ('ran', 'skipped') for status in statuses):
+                continue
+
+            fingerprint = fingerprints.stage(stage)
+            previous = state['stages'].get(stage.name, {})
+            if stage.name not in forced and \
+               previous.get('fingerprint') == fingerprint and \
+               all((root / output).exists() for output in stage.outputs):
+                pending.remove(stage)
+                report[stage.name] = {'status': 'skipped', 'seconds': 0.0}
+                print(f'[INFO] Stage {stage.name} is up to date, skipping.')
+                continue
+
+            n_cpus = min(stage.cpus, len(cores))
+            used = [core for run in running.values() for core in run['cores']]
+            free = [core for core in cores if core not in used]
+            used_memory = sum(by_name[name].memory for name in running)
+            # A stage larger than the whole build still runs, on its own.
+            if running and (len(free) < n_cpus or
+                            used_memory + stage.memory > memory):
+                continue
+
+            pending.remove(stage)
+            process = context.Process(
+                target=_run_stage, name=f'rubrix-build-{stage.name}',
+                args=(stage.function, stage.params, free[:n_cpus],
+                      int(stage.memory * GB), str(root)))
+            process.start()
+            running[stage.name] = {'process': process,
+                                   'cores': free[:n_cpus],
+                                   'fingerprint': fingerprint,
+                                   'started': time.perf_counter()}
+            print(f'[INFO] Stage {stage.name} started on cores '
+                  f'{free[:n_cpus]}.')
+
+        time.sleep(POLL_INTERVAL if running else 0)
+        for name, run in list(running.items()):
+            process, stage = run['process'], by_name[name]
+            if process.is_alive():
+                if _resident_memory(process.pid) > stage.memory * GB:
+                    print(f'[WARNING] Stage {name} exceeded its memory limit '
+                          f'of {stage.memory} GB, stopping it.')
+                    process.terminate()
+                    process.join()
+                else:
+                    continue
+            process.join()
+            del running[name]
+            seconds = time.perf_counter() - run['started']
+            if process.exitcode == 0:
+                report[name] = {'status': 'ran', 'seconds': seconds}
+                state['stages'][name] = {'fingerprint': run['fingerprint'],
+                                         'seconds': round(seconds, 3)}
+                print(f'[INFO] Stage {name} completed in {seconds:.1f}s.')
+            else:
+                report[name] = {'status': 'failed', 'seconds': seconds}
+                state['stages'].pop(name, None)
+                print(f'[ERROR] Stage {name} failed after {seconds:.1f}s.')
+            state['hashes'] = fingerprints.cache
+            _write_state(state_path, state)
+
+    state['hashes'] = fingerprints.cache
+    _write_state(state_path, state)
+    return report
+
+
+def _run_stage(function, params, cores, memory, root):
+    """Runs a stage in a child process, within its cores and memory.
+    """
+    os.environ.update({name: str(len(cores)) for name in THREAD_LIMITS})
+    os.sched_setaffinity(0, cores)
+    # Limits the heap of the stage. Address space is not limited, as
+    # Tensorflow reserves far more of it than it uses.
+    resource.setrlimit(resource.RLIMIT_DATA, (memory, memory))
+    # Paths are resolved relative to the working directory, as for the
+    # scripts run by ``setup.sh``.
+    os.chdir(Path(root) / 'rubrix' / 'index')
+    try:
+        function(**params)
+    except BaseException:
+        traceback.print_exc()
+        sys.exit(1)
+
+
+def _closure(by_name, names):
+    """Returns ``names`` along with all the stages they depend on.
+    """
+    selected, stack = set(), list(names)
+    while stack:
+        name = stack.pop()
+        if name not in by_name:
+            raise ValueError(f'Unknown stage: {name}')
+        if name not in selected:
+            selected.add(name)
+            stack += by_name[name].deps
+    return selected
+
+
+def _resident_memory(pid):
+    """Returns the resident memory of process ``pid``, in bytes.
+    """
+    try:
+        with open(f'/proc/{pid}/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / GB
+
+
+def _read_state(state_path):
+    if state_path.is_file():
+        with open(state_path, 'r') as state_file:
+            state = json.load(state_file)
+    else:
+        state = {}
+    state.setdefault('stages', {})
+    state.setdefault('hashes', {})
+    return state
+
+
+def _write_state(state_path, state):
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = state_path.with_suffix('.tmp')
+    with open(temporary_path, 'w') as state_file:
+        json.dump(state, state_file, indent=4)
+    temporary_path.replace(state_path)
+
+
+def print_report(report, seconds):
+    """Prints the status and wall time of each stage, and the wall time of
+    the build.
+    """
+    print(f'{"stage":<14}{"status":<10}{"seconds":>10}')
+    for name, entry in report.items():
+        print(f'{name:<14}{entry["status"]:<10}{entry["seconds"]:>10.1f}')
+    print(f'{"total":<14}{"":<10}{seconds:>10.1f}')
+
+
+def _parse_limits(values, cast):
+    limits = {}
+    for value in values:
+        name, _, limit = value.partition('=')
+        limits[name] = cast(limit)
+    return limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the index, running '
+                                                 'independent stages '
+                                                 'concurrently.')
+    parser.add_argument('--stages', dest='stages', type=str, nargs='+',
+                        help='Stages to run, along with their dependencies. '
+                             'Defaults to all stages.')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='Run the given stages even if their inputs are '
+                             'unchanged.')
+    parser.add_argument('--jobs', dest='cpus', type=int,
+                        help='Number of CPU cores of the build.')
+    parser.add_argument('--memory', dest='memory', type=float,
+                        help='Memory of the build, in GB.')
+    parser.add_argument('--cpus', dest='stage_cpus', type=str, nargs='*',
+                        default=[], help='Cores of stages, as STAGE=N.')
+    parser.add_argument('--stage-memory', dest='stage_memory', type=str,
+                        nargs='*', default=[],
+                        help='Memory limits of stages, as STAGE=GB.')
+    parser.add_argument('--train_size', dest='train_size', type=float,
+                        default=0.8, help='Percentage of files in train-set')
+    parser.add_argument('--thresh', dest='confidence_threshold', type=float,
+                        default=0.5, help='Confidence threshold.')
+    parser.add_argument('--gpu', dest='gpu', action='store_true',
+                        help='Build darknet with the GPU Makefile.')
+    parser.add_argument('--fused', dest='fused', action='store_true',
+                        help='Build the object index and descriptors in a '
+                             'single pass, decoding each image once.')
+    args = parser.parse_args()
+
+    stages = default_stages(args.train_size, args.confidence_threshold,
+                            args.gpu, args.fused)
+    stage_cpus = _parse_limits(args.stage_cpus, int)
+    stage_memory = _parse_limits(args.stage_memory, float)
+    for stage in stages:
+        stage.cpus = stage_cpus.get(stage.name, stage.cpus)
+        stage.memory = stage_memory.get(stage.name, stage.memory)
+
+    start = time.perf_counter()
+    report = run_build(stages, args.stages, args.force, args.cpus,
+                       args.memory)
+    print_report(report, time.perf_counter() - start)
+    if any(entry['status'] in ('failed', 'blocked')
+           for entry in report.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
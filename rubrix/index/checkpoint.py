@@ -0,0 +1,195 @@
+"""Checkpoints of long-running index builds, so that an interrupted build
+resumes where it stopped instead of starting over.
+
+A build stage (e.g. extracting image descriptors) processes items (e.g.
+images) one by one, and records them in chunks of ``CHUNK_SIZE`` items. For
+each chunk, the manifest of the stage, ``assets/checkpoints/<stage>/
+manifest.json``, lists the items of the chunk, and the size and SHA-256 hash
+of each file written for them. The manifest is replaced atomically after the
+files of a chunk are written, so it only ever lists complete chunks.
+
+When the stage is restarted, every chunk is verified against its files, and
+the items of chunks whose files are missing or were cut short are processed
+again. The manifest also holds the parameters of the stage (e.g. the
+confidence threshold, or a hash of the captions), and checkpoints made with
+other parameters are discarded. Once a stage completes, its checkpoints are
+removed.
+"""
+import json
+import shutil
+import hashlib
+from pathlib import Path
+
+from rubrix import pathfinder
+from rubrix.index.catalog import relative_path
+
+
+MANIFEST_FILE = 'manifest.json'
+
+# Number of items recorded per chunk. Smaller chunks lose less work when a
+# build is interrupted, at the cost of rewriting the manifest more often.
+CHUNK_SIZE = 500
+
+
+class Checkpoint:
+    """Completed chunks of a build stage.
+    """
+    def __init__(self, path, params, chunks=None, root=None):
+        """Initializes :class: ``Checkpoint``.
+
+        Arguments:
+        ----------
+            path (pathlib.Path):
+                Path to the checkpoint directory of the stage.
+            params (dict):
+                Parameters of the stage, as JSON-serializable values.
+            chunks (list):
+                Completed chunks, each a dict with the ``items`` of the
+                chunk, and the ``files`` written for them (path relative to
+                the main directory, size and SHA-256 hash of each file).
+            root (pathlib.Path):
+                Main directory. Defaults to :method:
+                ``rubrix.pathfinder.get_root``.
+        """
+        self.path = Path(path)
+        self.params = params
+        self.chunks = chunks or []
+        self.root = pathfinder.get_root() if root is None else Path(root)
+        self._items, self._files = [], []
+
+    @classmethod
+    def open(cls, stage, params, resume=True, root=None):
+        """Opens the checkpoint of ``stage``, keeping only the chunks whose
+        files are intact.
+
+        Arguments:
+        ----------
+            stage (str):
+                Name of the build stage.
+            params (dict):
+                Parameters of the stage. Checkpoints made with other
+                parameters are discarded.
+            resume (bool):
+                If False, existing checkpoints are discarded.
+            root (pathlib.Path):
+                Main directory. Defaults to :method:
+                ``rubrix.pathfinder.get_root``.
+
+        Returns:
+        --------
+            checkpoint (Checkpoint):
+                Checkpoint of the stage.
+        """
+        root = pathfinder.get_root() if root is None else Path(root)
+        path = root / 'assets' / 'checkpoints' / stage
+        manifest_path = path / MANIFEST_FILE
+        params = json.loads(json.dumps(params))
+
+        chunks = []
+        if resume and manifest_path.is_file():
+            with open(manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest['params'] == params:
+                for chunk in manifest['chunks']:
+                    if all(_is_intact(root / file['path'], file)
+                           for file in chunk['files']):
+                        chunks.append(chunk)
+                    else:
+                        print(f'[WARNING] Checkpoint of {len(chunk["items"])} '
+                              f'{stage} items is damaged, redoing them.')
+            else:
+                print(f'[INFO] Parameters of {stage} changed, discarding '
+                      f'checkpoints.')
+
+        checkpoint = cls(path, params, chunks, root)
+        if chunks:
+            print(f'[INFO] Resuming {stage}, {len(checkpoint.completed())} '
+                  f'items already done.')
+        elif path.is_dir():
+            shutil.rmtree(path)
+        return checkpoint
+
+    def completed(self):
+        """Returns the set of items of all completed chunks.
+        """
+        return {item for chunk in self.chunks for item in chunk['items']}
+
+    def files(self):
+        """Returns the paths to the files written for completed chunks.
+        """
+        return [self.root / file['path'] for chunk in self.chunks
+                for file in chunk['files']]
+
+    def chunk_path(self, suffix):
+        """Returns a path, within the checkpoint directory, for a file
+        holding the results of the next chunk.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Files of damaged chunks may be left over, and are never reused.
+        numbers = [int(path.name.split('.')[0].split('-')[1])
+                   for path in self.path.glob('chunk-*')]
+        return self.path / f'chunk-{max(numbers, default=-1) + 1:06d}{suffix}'
+
+    def record(self, item, files=()):
+        """Records ``item`` as processed, with the ``files`` written for it.
+        Once ``CHUNK_SIZE`` items are recorded, they are committed as a
+        chunk.
+        """
+        self._items.append(item)
+        self._files += list(files)
+        if len(self._items) >= CHUNK_SIZE:
+            self.flush()
+
+    def commit(self, items, files=()):
+        """Commits ``items`` as a chunk, with the ``files`` written for them.
+        """
+        self._items += list(items)
+        self._files += list(files)
+        self.flush()
+
+    def flush(self):
+        """Commits the items recorded since the last chunk.
+        """
+        if not self._items:
+            return
+        self.chunks.append({
+            'items': self._items,
+            'files': [_describe(Path(path), self.root)
+                      for path in self._files],
+        })
+        self._items, self._files = [], []
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        temporary_path = self.path / (MANIFEST_FILE + '.tmp')
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump({'params': self.params, 'chunks': self.chunks},
+                      manifest_file)
+        temporary_path.replace(self.path / MANIFEST_FILE)
+
+    def clear(self):
+        """Removes the checkpoints, once the stage is complete.
+        """
+        self._items, self._files, self.chunks = [], [], []
+        if self.path.is_dir():
+            shutil.rmtree(self.path)
+
+
+def file_hash(path):
+    """Returns the SHA-256 hash of the contents of ``path``.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _describe(path, root):
+    return {'path': relative_path(path, root), 'size': path.stat().st_size,
+            'sha256': file_hash(path)}
+
+
+def _is_intact(path, description):
+    return path.is_file() and \
+        path.stat().st_size == description['size'] and \
+        file_hash(path) == description['sha256']
@@ -1,6 +1,15 @@
 """2048-dimension feature vectors describing the images are extracted using
 :method: ``rubrix.images.extract_image_descriptors`` for all the images in
 the image database. These are saved in assets/data/descriptors directory.
+
+Extracted descriptors are checkpointed in chunks (see
+:mod: ``rubrix.index.checkpoint``), so an interrupted run only extracts the
+descriptors of the images it had not reached.
+
+With ``--pixels``, images are read from the cache of decoded images (see
+:mod: ``rubrix.index.pixels``), which is only decoded once for all
+backbones, and fed to the model in batches. Descriptors of backbones other
+than InceptionV3 are saved to ``assets/data/descriptors-<backbone>``.
 """
 import argparse
 from pathlib import Path
@@ -10,13 +19,18 @@ from tqdm import tqdm
 import numpy as np
 
 from rubrix import pathfinder
-from rubrix.image.extract import extract_image_descriptors
+from rubrix.index.catalog import image_key
+from rubrix.index.checkpoint import Checkpoint
 
 
 TARGET_SIZE = (299, 299)
 
+# Number of cached images fed to the model at once.
+BATCH_SIZE = 32
+
 
-def save_image_descriptors(images_path):
+def save_image_descriptors(images_path, resume=True, model_name='inception',
+                           pixels=False, batch_size=BATCH_SIZE):
     """Creates an index mapping cluster labels to corresponding image keys
     and 512 dimension image descriptor .npy arrays.
 
@@ -25,7 +39,22 @@ def save_image_descriptors(images_path):
         images_path (pathlib.Path or list of pathlib.Path):
             Path to images directory / List of paths to multiple image
             directories.
+        resume (bool):
+            If True, descriptors checkpointed by an interrupted run are
+            reused.
+        model_name (str):
+            Backbone, i.e., one of 'inception', 'vgg16' and 'resnet50'.
+        pixels (bool):
+            If True, images are read from the cache of decoded images,
+            which is updated first.
+        batch_size (int):
+            Number of cached images fed to the model at once.
     """
+    # Importing Tensorflow is slow, and only necessary for building
+    # descriptors, not for importing ``TARGET_SIZE``.
+    from rubrix.image.extract import (extract_image_descriptors,
+                                      extract_pixel_descriptors, get_cnn)
+
     image_paths = []
     if isinstance(images_path, Path):
         image_paths = list(images_path.iterdir())
@@ -34,19 +63,72 @@ def save_image_descriptors(images_path):
         for paths in images_path:
             image_paths += list(paths.iterdir())
     X = []
-    descriptors_path = pathfinder.get('assets', 'data', 'descriptors')
+    descriptors_path = get_descriptors_path(model_name)
     descriptors_path.mkdir(exist_ok=True)
 
+    checkpoint = Checkpoint.open(_stage(model_name), {
+        'model': model_name, 'target_size': list(TARGET_SIZE)}, resume)
+    completed = checkpoint.completed()
+
     print("[INFO] Extracting and saving image descriptors.")
+    if pixels:
+        # Importing the cache is deferred, as modules importing
+        # ``TARGET_SIZE`` (e.g. ``rubrix.query``) do not need it.
+        from rubrix.index.pixels import build_pixel_cache
+
+        cache = build_pixel_cache(image_paths, TARGET_SIZE)
+        model, preprocess_input = get_cnn(model_name)
+        rows = [row for row, path in enumerate(image_paths)
+                if image_key(path) not in completed]
+        for start in tqdm(range(0, len(rows), batch_size)):
+            batch = rows[start:start + batch_size]
+            arrays = extract_pixel_descriptors(model, preprocess_input,
+                                               cache.pixels[batch])
+            for row, array in zip(batch, arrays):
+                path = image_paths[row]
+                np.save(descriptors_path / f'{path.stem}.npy', array)
+                checkpoint.record(image_key(path),
+                                  [descriptors_path / f'{path.stem}.npy'])
+        checkpoint.clear()
+        return
+
     for path in tqdm(image_paths):
-        array = extract_image_descriptors(path, 'inception', TARGET_SIZE)
+        if image_key(path) in completed:
+            continue
+        array = extract_image_descriptors(path, model_name, TARGET_SIZE)
         np.save(descriptors_path / f'{path.stem}.npy', array)
+        checkpoint.record(image_key(path),
+                          [descriptors_path / f'{path.stem}.npy'])
+    checkpoint.clear()
+
+
+def get_descriptors_path(model_name='inception'):
+    """Returns the directory holding the descriptors of backbone
+    ``model_name``.
+    """
+    if model_name == 'inception':
+        return pathfinder.get('assets', 'data', 'descriptors')
+    return pathfinder.get('assets', 'data', f'descriptors-{model_name}')
+
+
+def _stage(model_name):
+    # Checkpoints of each backbone are kept apart.
+    return 'descriptors' if model_name == 'inception' else \
+        f'descriptors-{model_name}'
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Create inverse image index.')
     parser.add_argument('--images', dest='images_path', type=str,
                         help='Path to images directory.')
+    parser.add_argument('--fresh', dest='fresh', action='store_true',
+                        help='Discard checkpoints of an interrupted run.')
+    parser.add_argument('--backbone', dest='model_name', type=str,
+                        default='inception',
+                        choices=['inception', 'vgg16', 'resnet50'],
+                        help='CNN model extracting the descriptors.')
+    parser.add_argument('--pixels', dest='pixels', action='store_true',
+                        help='Read images from the cache of decoded images.')
     args = parser.parse_args()
 
     if args.images_path is None:
@@ -57,4 +139,5 @@ if __name__ == '__main__':
     else:
         images_path = Path(args.images_path)
 
-    save_image_descriptors(images_path)
+    save_image_descriptors(images_path, resume=not args.fresh,
+                           model_name=args.model_name, pixels=args.pixels)
@@ -0,0 +1,288 @@
+"""Cache of the raw YOLOv4 detections of every image in the data directory.
+
+Running YOLOv4 over the whole data directory takes hours, while deriving the
+inverse-image index from its detections takes seconds. The cache keeps, for
+each image, every candidate box whose confidence exceeds
+``MIN_CONFIDENCE``, so that the index can be re-derived at any confidence
+threshold above it without running the detector again. When images are added
+or modified, only those images go back through the detector.
+
+Detections are stored column by column in a single .npz file:
+    - ``pathdata``, ``pathoff``: string table of image paths, relative to
+      the main directory (absolute for images outside of it, see :method:
+      ``rubrix.index.catalog.image_key``),
+    - ``sizes``, ``mtimes``: size and modification time (in nanoseconds) of
+      each image file when it was detected, to find modified images,
+    - ``rows``: start row of the detections of each image, followed by the
+      total number of detections,
+    - ``classes`` (uint16), ``confidences`` (float32), ``boxes`` (float32,
+      box center, width and height relative to the image size): one row per
+      detection.
+"""
+from pathlib import Path
+
+import numpy as np
+
+from rubrix import pathfinder
+from rubrix.index.catalog import (decode_strings, encode_strings, file_stamp,
+                                  image_key)
+from rubrix.index.checkpoint import CHUNK_SIZE
+from rubrix.image.detect import summarize_detections
+
+
+# Detections with a lower (or equal) confidence are not cached. The index can
+# only be re-derived from the cache at confidence thresholds above this.
+MIN_CONFIDENCE = 0.1
+
+
+class DetectionCache:
+    """Raw detections of a set of images, in columnar form.
+    """
+    def __init__(self, paths, sizes, mtimes, rows, classes, confidences,
+                 boxes, min_confidence=MIN_CONFIDENCE):
+        """Initializes :class: ``DetectionCache``.
+
+        Arguments:
+        ----------
+            paths (list):
+                Keys of images (see :method:
+                ``rubrix.index.catalog.image_key``).
+            sizes, mtimes (numpy.ndarray):
+                Size and modification time (in nanoseconds) of each image
+                file when it was detected.
+            rows (numpy.ndarray):
+                Start row of the detections of each image, followed by the
+                total number of detections.
+            classes, confidences, boxes (numpy.ndarray):
+                Class ID, confidence and box of each detection.
+            min_confidence (float):
+                Confidence above which detections were cached.
+        """
+        self.paths = paths
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.rows = rows
+        self.classes = classes
+        self.confidences = confidences
+        self.boxes = boxes
+        self.min_confidence = min_confidence
+        self._positions = {path: position
+                           for position, path in enumerate(paths)}
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def empty(cls, min_confidence=MIN_CONFIDENCE):
+        return cls([], np.empty(0, dtype=np.int64),
+                   np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                   np.empty(0, dtype=np.uint16),
+                   np.empty(0, dtype=np.float32),
+                   np.empty((0, 4), dtype=np.float32), min_confidence)
+
+    @classmethod
+    def load(cls, path):
+        """Loads the cache at ``path``.
+
+        Arguments:
+        ----------
+            path (pathlib.Path):
+                Path to cache file.
+
+        Returns:
+        --------
+            cache (DetectionCache):
+                Loaded cache.
+        """
+        with np.load(path) as columns:
+            return cls(decode_strings(columns['pathdata'], columns['pathoff']),
+                       columns['sizes'], columns['mtimes'], columns['rows'],
+                       columns['classes'], columns['confidences'],
+                       columns['boxes'], float(columns['minconf']))
+
+    def save(self, path):
+        """Writes the cache to ``path``, through a temporary file so that an
+        interrupted write does not corrupt an existing cache.
+
+        Arguments:
+        ----------
+            path (pathlib.Path):
+                Path to cache file.
+        """
+        path = Path(path)
+        path_data, path_offsets = encode_strings(self.paths)
+        temporary_path = path.with_suffix('.tmp.npz')
+        np.savez(temporary_path, pathdata=path_data, pathoff=path_offsets,
+                 sizes=self.sizes, mtimes=self.mtimes, rows=self.rows,
+                 classes=self.classes, confidences=self.confidences,
+                 boxes=self.boxes, minconf=np.float64(self.min_confidence))
+        temporary_path.replace(path)
+
+    def detections(self, position):
+        """Returns the class IDs, confidences and boxes of the detections of
+        the image at ``position``.
+        """
+        start, stop = self.rows[position], self.rows[position + 1]
+        return (self.classes[start:stop], self.confidences[start:stop],
+                self.boxes[start:stop])
+
+    def is_current(self, path, root=None):
+        """Checks if the image at ``path`` is cached, and has not been
+        modified since it was detected.
+
+        Arguments:
+        ----------
+            path (pathlib.Path):
+                Path to image file.
+            root (pathlib.Path):
+                Main directory. Defaults to :method:
+                ``rubrix.pathfinder.get_root``.
+
+        Returns:
+        --------
+            (bool):
+                True, if the cached detections are up to date.
+                False, otherwise.
+        """
+        position = self._positions.get(image_key(path, root))
+        if position is None:
+            return False
+        size, mtime = file_stamp(path)
+        return size == self.sizes[position] and mtime == self.mtimes[position]
+
+    def update(self, image_paths, detect, root=None, checkpoint=None):
+        """Returns a cache of the images at ``image_paths``, reusing the
+        cached detections of images which have not been modified, and
+        running ``detect`` over the others. Images no longer in
+        ``image_paths`` are dropped.
+
+        Arguments:
+        ----------
+            image_paths (list):
+                Paths to image files.
+            detect (callable):
+                Takes the path to an image file, and returns its class IDs,
+                confidences and boxes, as :method:
+                ``rubrix.image.detect.raw_detections`` does.
+            root (pathlib.Path):
+                Main directory. Defaults to :method:
+                ``rubrix.pathfinder.get_root``.
+            checkpoint (rubrix.index.checkpoint.Checkpoint):
+                If given, the detections of new or modified images are
+                written to the checkpoint in chunks, so that an interrupted
+                update does not detect them again (see :method:
+                ``merge``).
+
+        Returns:
+        --------
+            cache (DetectionCache):
+                Updated cache.
+        """
+        entries, detected = [], []
+        n_detected = 0
+        for image_path in image_paths:
+            path = image_key(image_path, root)
+            if self.is_current(image_path, root):
+                detections = self.detections(self._positions[path])
+            else:
+                detections = detect(image_path)
+                detected.append(len(entries))
+                n_detected += 1
+
+            entries.append((path, *file_stamp(image_path), *detections))
+            if checkpoint is not None and len(detected) == CHUNK_SIZE:
+                self._checkpoint([entries[i] for i in detected], checkpoint)
+                detected = []
+        if checkpoint is not None and detected:
+            self._checkpoint([entries[i] for i in detected], checkpoint)
+
+        print(f'[INFO] Detected objects in {n_detected} new or modified '
+              f'images, reused {len(entries) - n_detected} cached images.')
+        return DetectionCache.from_entries(entries, self.min_confidence)
+
+    def merge(self, other):
+        """Returns a cache of the images of both caches, with the detections
+        of ``other`` replacing those of the same images in this cache.
+        """
+        entries = {path: self._entry(position)
+                   for position, path in enumerate(self.paths)}
+        entries.update({path: other._entry(position)
+                        for position, path in enumerate(other.paths)})
+        return DetectionCache.from_entries(list(entries.values()),
+                                           self.min_confidence)
+
+    @classmethod
+    def from_entries(cls, entries, min_confidence=MIN_CONFIDENCE):
+        """Creates a cache from ``entries``, each a tuple of the key, size
+        and modification time of an image, and the class IDs,
+        confidences and boxes of its detections.
+        """
+        if not entries:
+            return cls.empty(min_confidence)
+        paths, sizes, mtimes, classes, confidences, boxes = zip(*entries)
+        rows = np.zeros(len(paths) + 1, dtype=np.int64)
+        rows[1:] = np.cumsum([len(ids) for ids in classes])
+        return cls(list(paths), np.asarray(sizes, dtype=np.int64),
+                   np.asarray(mtimes, dtype=np.int64), rows,
+                   np.concatenate([np.asarray(ids, dtype=np.uint16)
+                                   for ids in classes]),
+                   np.concatenate([np.asarray(values, dtype=np.float32)
+                                   for values in confidences]),
+                   np.concatenate([np.asarray(values, dtype=np.float32)
+                                   .reshape(-1, 4) for values in boxes]),
+                   min_confidence)
+
+    def _entry(self, position):
+        return (self.paths[position], int(self.sizes[position]),
+                int(self.mtimes[position]), *self.detections(position))
+
+    def _checkpoint(self, entries, checkpoint):
+        chunk_path = checkpoint.chunk_path('.npz')
+        DetectionCache.from_entries(entries, self.min_confidence).save(
+            chunk_path)
+        checkpoint.commit([entry[0] for entry in entries], [chunk_path])
+
+
+def derive_index(cache, labels, thresh, root=None):
+    """Derives the inverse-image index from cached detections.
+
+    Arguments:
+    ----------
+        cache (DetectionCache):
+            Cached detections.
+        labels (list):
+            Labels, indexed by class ID.
+        thresh (float):
+            Confidence level threshold.
+        root (pathlib.Path):
+            Main directory. Defaults to :method:
+            ``rubrix.pathfinder.get_root``.
+
+    Returns:
+    --------
+        index, scores (tuple of dict):
+            Mapping from object label to paths to images containing the
+            object, in decreasing order of confidence (and then of area),
+            and mapping from object label to the (confidence, area) pair of
+            each of those images.
+    """
+    if thresh < cache.min_confidence:
+        raise ValueError(f'Detections are cached above confidence '
+                         f'{cache.min_confidence}, cannot derive index at '
+                         f'threshold {thresh}.')
+    root = pathfinder.get_root() if root is None else Path(root)
+
+    entries = {label: [] for label in labels}
+    for position, path in enumerate(cache.paths):
+        objects = summarize_detections(labels, *cache.detections(position),
+                                       thresh)
+        for object, (confidence, area) in objects.items():
+            entries[object].append((confidence, area, str(root / path)))
+
+    index, scores = {}, {}
+    for object, object_entries in entries.items():
+        object_entries.sort(key=lambda entry: (-entry[0], -entry[1]))
+        index[object] = [path for _, _, path in object_entries]
+        scores[object] = [[round(confidence, 4), round(area, 4)]
+                          for confidence, area, _ in object_entries]
+    return index, scores
@@ -1,13 +1,24 @@
 """Downloads Flickr8k dataset using the Kaggle API and sets up /assets
 directory by creating train and val splits of the dataset.
+
+With ``--stream``, the images are extracted from the downloaded zip file
+straight into the train and val directories, in parallel, rather than
+extracted, copied to ``assets/data/images`` and copied again into the
+splits. Captions are streamed from the zip file as well, and written as
+line-delimited records to ``train_captions.jsonl`` and
+``val_captions.jsonl``.
 """
+import io
+import os
 import sys
 import json
 import shutil
 import argparse
 import zipfile
+import threading
 import subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from rubrix import pathfinder
 
@@ -15,6 +26,9 @@ from rubrix import pathfinder
 DATASET_ID = "adityajn105/flickr8k"
 DATASET_DIR = "flickr8k.zip"
 
+# Number of threads extracting images from the zip file.
+WORKERS = 8
+
 
 def validate_api_credentials():
     """Validate Kaggle API user credentials.
@@ -60,9 +74,7 @@ def download_and_extract(dataset_id, dataset_dir):
         dataset_dir (str):
             Name of downloaded data zip file from Kaggle.
     """
-    # Download flickr8k data from Kaggle using Kaggle API.
-    subprocess.run(f"kaggle datasets download -d {dataset_id}".split(),
-        check=True)
+    download_dataset(dataset_id)
 
     source = pathfinder.get('rubrix', 'index')
     dest_dir = pathfinder.get('assets', 'data')
@@ -81,6 +93,15 @@ def download_and_extract(dataset_id, dataset_dir):
     remove(source / 'Images', Path(dataset_dir))
 
 
+def download_dataset(dataset_id):
+    """Downloads the zip file of Kaggle dataset with identifier
+    `dataset_id` to the working directory.
+    """
+    # Download flickr8k data from Kaggle using Kaggle API.
+    subprocess.run(f"kaggle datasets download -d {dataset_id}".split(),
+        check=True)
+
+
 def split_data(dir, train_size):
     """Splits data into train and validation sets.
 
@@ -123,10 +144,21 @@ def move_images(dir, train_images, val_images):
     val_dir.mkdir(exist_ok=True)
 
     for img in train_images:
-        shutil.copy(img, train_dir / img.name)
+        _link_or_copy(img, train_dir / img.name)
 
     for img in val_images:
-        shutil.copy(img, val_dir / img.name)
+        _link_or_copy(img, val_dir / img.name)
+
+
+def _link_or_copy(source, destination):
+    # Hard links share the data of the original file, which is deleted
+    # afterwards, so nothing is copied.
+    if destination.exists():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy(source, destination)
 
 
 def txt_to_json(file, val_images):
@@ -147,16 +179,11 @@ def txt_to_json(file, val_images):
         lines = fileobj.readlines()
 
     for line in lines[1:]:
-        items = line.split(',')
-        filename, caption = items[0], ','.join(items[1:])
+        _item = _caption_record(line)
 
         # Considering valiation set is much smaller than the train-set,
         # it is optimal to check membership with this.
-        _item = {
-            "image_id": items[0],
-        	"caption": caption
-        }
-        if filename in val_images:
+        if _item["image_id"] in val_images:
             val_captions.append(_item)
         else:
             train_captions.append(_item)
@@ -176,6 +203,125 @@ def txt_to_json(file, val_images):
         json.dump(json_contents, fileobj, indent=4)
 
 
+def _caption_record(line):
+    """Parses a line of the captions file into a caption record.
+    """
+    items = line.split(',')
+    return {
+        "image_id": items[0],
+        "caption": ','.join(items[1:])
+    }
+
+
+def prepare_streaming(zip_path, data_path, train_size, workers=WORKERS):
+    """Extracts the images in the zip file at `zip_path` straight into the
+    train and validation directories, and streams the captions into
+    line-delimited train and validation captions files.
+
+    The split is the same as that of :method: ``split_data``, and images
+    already extracted with the right size are not extracted again.
+
+    Arguments:
+    ----------
+        zip_path (pathlib.Path):
+            Path to downloaded data zip file.
+        data_path (pathlib.Path):
+            Path to data directory, i.e., ``assets/data``.
+        train_size (float):
+            Percentage of files in train set.
+        workers (int):
+            Number of threads extracting images.
+
+    Returns:
+    --------
+        train_images, val_images (tuple):
+            File names of the images in the train and validation sets.
+    """
+    data_path = Path(data_path)
+    with zipfile.ZipFile(zip_path) as _zip:
+        members = sorted((member for member in _zip.infolist()
+                          if member.filename.startswith('Images/') and
+                          not member.is_dir()),
+                         key=lambda member: member.filename)
+    n_train = int(train_size * len(members))
+    train_dir, val_dir = data_path / 'train', data_path / 'val'
+    train_dir.mkdir(parents=True, exist_ok=True)
+    val_dir.mkdir(parents=True, exist_ok=True)
+    destinations = [
+        (train_dir if position < n_train else val_dir) /
+        Path(member.filename).name
+        for position, member in enumerate(members)]
+
+    # Zip files cannot be read by several threads at once, so each thread
+    # opens its own.
+    local = threading.local()
+
+    def extract(member, destination):
+        if destination.is_file() and \
+           destination.stat().st_size == member.file_size:
+            return False
+        if not hasattr(local, 'zip'):
+            local.zip = zipfile.ZipFile(zip_path)
+        temporary_path = destination.with_name(destination.name + '.tmp')
+        with local.zip.open(member) as source, \
+                open(temporary_path, 'wb') as target:
+            shutil.copyfileobj(source, target, 1 << 20)
+        temporary_path.replace(destination)
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        extracted = sum(executor.map(extract, members, destinations))
+    print(f'[INFO] Extracted {extracted} images, '
+          f'{len(members) - extracted} already extracted.')
+
+    val_images = {destination.name for destination in destinations
+                  if destination.parent == val_dir}
+    with zipfile.ZipFile(zip_path) as _zip, \
+            _zip.open('captions.txt') as captions_file, \
+            open(data_path / 'train_captions.jsonl', 'w') as train_file, \
+            open(data_path / 'val_captions.jsonl', 'w') as val_file:
+        lines = io.TextIOWrapper(captions_file, encoding='utf-8')
+        next(lines)
+        for line in lines:
+            _item = _caption_record(line)
+            target = val_file if _item["image_id"] in val_images \
+                else train_file
+            target.write(json.dumps(_item) + '\n')
+
+    train_images = [destination.name for destination in destinations
+                    if destination.parent == train_dir]
+    return train_images, sorted(val_images)
+
+
+def captions_paths(data_path=None):
+    """Returns the paths to the train and validation captions files, i.e.,
+    the line-delimited files written by :method: ``prepare_streaming`` if
+    they exist, and those written by :method: ``txt_to_json`` otherwise.
+    """
+    data_path = Path(data_path or pathfinder.get('assets', 'data'))
+    streamed = [data_path / 'train_captions.jsonl',
+                data_path / 'val_captions.jsonl']
+    if all(path.is_file() for path in streamed):
+        return streamed
+    return [data_path / 'train_captions.json',
+            data_path / 'val_captions.json']
+
+
+def iter_captions(path):
+    """Yields the caption records, with the ``image_id`` and ``caption`` of
+    each caption, of the captions file at ``path``. Files with a ``.jsonl``
+    suffix hold one record per line, and are read line by line.
+    """
+    path = Path(path)
+    with open(path, 'r') as fileobj:
+        if path.suffix == '.jsonl':
+            for line in fileobj:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(fileobj)['contents']
+
+
 def remove(dir, file):
     """Remove redundant files/dirs.
 
@@ -197,6 +343,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Download and organize data directory.')
     parser.add_argument('--train_size', dest='train_size', type=float,
                         default=0.8, help='Percentage of files in train-set')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='Extract images straight into the train and '
+                             'val directories, and write line-delimited '
+                             'captions.')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=WORKERS,
+                        help='Number of threads extracting images.')
     args = parser.parse_args()
 
     imgs_dir = pathfinder.get('assets', 'data', 'images')
@@ -205,6 +358,13 @@ if __name__ == '__main__':
     # Validate Kaggle API Credentials
     validate_api_credentials()
 
+    if args.stream:
+        download_dataset(DATASET_ID)
+        prepare_streaming(Path(DATASET_DIR), pathfinder.get('assets', 'data'),
+                          args.train_size, args.workers)
+        remove(None, Path(DATASET_DIR))
+        sys.exit()
+
     # Download Kaggle dataset and place in /assets/data.
     download_and_extract(DATASET_ID, DATASET_DIR)
 
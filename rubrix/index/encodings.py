@@ -3,6 +3,9 @@ directory to the paths to .npy files that represent the sentence-level
 embeddings for the corresponding text captions in the dataset.
 
 Universal Sentence Encoder is used to extract the sentence-level embeddings.
+Encoded captions are checkpointed in chunks (see
+:mod: ``rubrix.index.checkpoint``), so an interrupted run only encodes the
+captions it had not reached.
 """
 import json
 import argparse
@@ -10,18 +13,19 @@ from pathlib import Path
 
 import numpy as np
 
-import tensorflow_hub as hub
-
 from tqdm import tqdm
 
 from rubrix import pathfinder
+from rubrix.index.checkpoint import Checkpoint, file_hash
+from rubrix.index.download import captions_paths, iter_captions
 
 
 # Tensorflow hub link for Universal Sentence Encoder (large).
 MODULE_URL = "https://tfhub.dev/google/universal-sentence-encoder-large/5"
 
 
-def embedd_captions(model, captions_path, this_embeddings_folder):
+def embedd_captions(model, captions_path, this_embeddings_folder,
+                    resume=True):
     """
     Encodes all the captions in a JSON file at `captions_path` into separate
     .npy files and returns a dictionary mapping image identifiers to
@@ -37,6 +41,9 @@ def embedd_captions(model, captions_path, this_embeddings_folder):
         this_embeddings_folder (string):
             Path to the folder to store .npy files corresponding to the
             sentence embeddings.
+        resume (bool):
+            If True, embeddings checkpointed by an interrupted run are
+            reused.
 
     Returns:
     --------
@@ -51,12 +58,17 @@ def embedd_captions(model, captions_path, this_embeddings_folder):
     ids_captions = []
 
     if isinstance(captions_path, Path):
-        with open(captions_path, "r") as captions_file:
-            ids_captions = json.load(captions_file)["contents"]
-    elif isinstance(captions_path, list):
-        for path in captions_path:
-            with open(path, "r") as captions_file:
-                ids_captions += json.load(captions_file)["contents"]
+        captions_path = [captions_path]
+    for path in captions_path:
+        ids_captions += list(iter_captions(path))
+
+    # Captions are identified by their position, hence checkpoints are only
+    # valid for the same captions files.
+    checkpoint = Checkpoint.open('encodings', {
+        'captions': [file_hash(path) for path in captions_path],
+        'folder': Path(this_embeddings_folder).name,
+    }, resume)
+    completed = checkpoint.completed()
 
     for _id in tqdm(range(len(ids_captions))):
         caption_pair = ids_captions[_id]
@@ -75,11 +87,15 @@ def embedd_captions(model, captions_path, this_embeddings_folder):
             numpy_path = Path(this_embeddings_folder) / f"{image_id[:-4]}_1.npy"
             ids_to_numpy_paths[image_id] = [str(numpy_path)]
 
+        if _id in completed:
+            continue
         # Do the embedding
         embedd_tensor = model([caption]) # (1, 512) tensor
         embedd_numpy = embedd_tensor.numpy()[0] # (512, ) numpy array
         np.save(numpy_path, embedd_numpy)
+        checkpoint.record(_id, [numpy_path])
 
+    checkpoint.clear()
     return ids_to_numpy_paths
 
 
@@ -87,14 +103,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Generate sentence embeddings.")
     parser.add_argument('--captions', dest='captions_path', type=str,
                         help='Path to image captions.')
+    parser.add_argument('--fresh', dest='fresh', action='store_true',
+                        help='Discard checkpoints of an interrupted run.')
 
     args = parser.parse_args()
 
     if args.captions_path is None:
-        captions_path = [
-            pathfinder.get('assets', 'data', 'train_captions.json'),
-            pathfinder.get('assets', 'data', 'val_captions.json'),
-        ]
+        captions_path = captions_paths()
     else:
         captions_path = Path(args.captions_path)
 
@@ -106,9 +121,11 @@ if __name__ == '__main__':
     # MODEL( list_of_strings ) will embedd the strings in a (numstrings,512)
     # tensor.
     # TODO: Maybe change this part to load from locally stored model.
+    import tensorflow_hub as hub
     model = hub.load(MODULE_URL)
 
-    ids_to_paths = embedd_captions(model, captions_path, embeddings_folder)
+    ids_to_paths = embedd_captions(model, captions_path, embeddings_folder,
+                                   resume=not args.fresh)
 
     json_embedding_location = pathfinder.get('assets', 'imageEmbeddingLocations.json')
 
@@ -0,0 +1,211 @@
+"""Creates the inverse-image index and the image descriptors in a single pass
+over the images.
+
+:method: ``rubrix.index.objects.create_index`` and :method:
+``rubrix.index.descriptors.save_image_descriptors`` each read and decode
+every image of the data directory. Here, each image is decoded once with
+OpenCV, and both the 416x416 YOLOv4 blob and the 299x299 InceptionV3 tensor
+are derived from the same pixels. Images are fed to both models in batches
+of ``BATCH_SIZE``.
+
+Outputs are those of both modules, i.e., the detection cache, the index and
+object scores, and the descriptor .npy files. Detections are checkpointed
+as :mod: ``rubrix.index.objects`` does, and descriptors under a stage of
+their own, so an interrupted fused run resumes where it stopped. Images whose
+detections are cached and current are only decoded for their descriptors.
+
+Usage:
+    $ python rubrix/index/fused.py --batch 32
+"""
+import argparse
+from pathlib import Path
+
+import cv2
+
+import numpy as np
+
+from tqdm import tqdm
+
+from rubrix import pathfinder
+from rubrix.image.detect import (filter_detections, forward_batch,
+                                 get_labels, get_yolo_net)
+from rubrix.index.catalog import image_key
+from rubrix.index.checkpoint import Checkpoint
+from rubrix.index.descriptors import TARGET_SIZE
+from rubrix.index.detections import DetectionCache
+from rubrix.index.objects import load_cache, open_checkpoint, write_index
+
+
+# Number of images decoded and fed to both models at once.
+BATCH_SIZE = 16
+
+
+def index_images(images_path, weights_path, cfg_path, names_path, thresh,
+                 cache_path=None, batch_size=BATCH_SIZE, resume=True):
+    """Detects objects and extracts descriptors of all images, decoding
+    each image once.
+
+    Arguments:
+    ----------
+        images_path (pathlib.Path or list of pathlib.Path):
+            Path to images directory / List of paths to multiple image
+            directories.
+        weights_path (pathlib.Path):
+            Path to YOLOv4 pretrained weights file.
+        cfg_path (pathlib.Path):
+            Path to darknet configuration file.
+        names_path (pathlib.Path):
+            Path to darknet names file.
+        thresh (float):
+            Confidence level threshold.
+        cache_path (pathlib.Path):
+            Path to raw detections cache file. Defaults to
+            ``assets/detections.npz``.
+        batch_size (int):
+            Number of images fed to both models at once.
+        resume (bool):
+            If True, detections and descriptors checkpointed by an
+            interrupted run are reused.
+    """
+    labels = get_labels(names_path)
+
+    image_paths = []
+    if isinstance(images_path, Path):
+        image_paths = list(images_path.iterdir())
+    elif isinstance(images_path, list):
+        for paths in images_path:
+            image_paths += list(paths.iterdir())
+
+    if cache_path is None:
+        cache_path = pathfinder.get('assets', 'detections.npz')
+    cache = load_cache(cache_path, thresh)
+    objects_checkpoint = open_checkpoint(cache, weights_path, cfg_path, resume)
+    for chunk_path in objects_checkpoint.files():
+        cache = cache.merge(DetectionCache.load(chunk_path))
+
+    descriptors_path = pathfinder.get('assets', 'data', 'descriptors')
+    descriptors_path.mkdir(exist_ok=True)
+    # Descriptors decoded by OpenCV are checkpointed apart from those of
+    # ``rubrix.index.descriptors``, whose checkpoint has other parameters.
+    descriptors_checkpoint = Checkpoint.open('descriptors-fused', {
+        'model': 'inception', 'target_size': list(TARGET_SIZE),
+        'decoder': 'opencv'}, resume)
+    described = descriptors_checkpoint.completed()
+
+    to_detect = {path for path in image_paths if not cache.is_current(path)}
+    to_describe = {path for path in image_paths
+                   if image_key(path) not in described}
+    print(f'[INFO] Decoding {len(to_detect | to_describe)} images, for '
+          f'{len(to_detect)} detections and {len(to_describe)} descriptors.')
+
+    results = _fused_pass(
+        [path for path in image_paths
+         if path in to_detect or path in to_describe],
+        to_detect, to_describe, weights_path, cfg_path,
+        cache.min_confidence, descriptors_path, descriptors_checkpoint,
+        batch_size)
+
+    def detect(image_path):
+        # Images are detected in the order of ``image_paths``, which is
+        # the order in which the cache asks for them.
+        path, detections = next(results)
+        assert path == image_path
+        return detections
+
+    cache = cache.update(image_paths, detect, checkpoint=objects_checkpoint)
+    # Remaining images only needed their descriptors.
+    for _ in results:
+        pass
+    cache.save(cache_path)
+    objects_checkpoint.clear()
+    descriptors_checkpoint.clear()
+
+    write_index(cache, labels, thresh)
+
+
+def _fused_pass(image_paths, to_detect, to_describe, weights_path, cfg_path,
+                min_confidence, descriptors_path, checkpoint, batch_size):
+    """Decodes ``image_paths`` in batches, saves the descriptors of the
+    images in ``to_describe``, and yields the path and raw detections of
+    the images in ``to_detect``, in order.
+    """
+    # Tensorflow is only imported when images are indexed.
+    from rubrix.image.extract import extract_batch_descriptors
+    from rubrix.models import load_inception
+
+    # Each model is only loaded if some image needs it.
+    net = get_yolo_net(cfg_path, weights_path) if to_detect else None
+    model = load_inception() if to_describe else None
+
+    progress = tqdm(total=len(image_paths))
+    for start in range(0, len(image_paths), batch_size):
+        batch = image_paths[start:start + batch_size]
+        images = []
+        for path in batch:
+            image = cv2.imread(str(path))
+            if image is None:
+                raise ValueError(f'Unable to decode image {path}.')
+            images.append(image)
+
+        described = [i for i, path in enumerate(batch) if path in to_describe]
+        if described:
+            arrays = extract_batch_descriptors(
+                model, [images[i] for i in described], TARGET_SIZE)
+            for i, array in zip(described, arrays):
+                npy_path = descriptors_path / f'{batch[i].stem}.npy'
+                np.save(npy_path, array)
+                checkpoint.record(image_key(batch[i]), [npy_path])
+
+        detected = [i for i, path in enumerate(batch) if path in to_detect]
+        if detected:
+            outputs = forward_batch(net, [images[i] for i in detected])
+        else:
+            outputs = []
+        progress.update(len(batch))
+        for i, detections in zip(detected, outputs):
+            yield batch[i], filter_detections(detections, min_confidence)
+    progress.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create inverse image index '
+                                                 'and image descriptors in a '
+                                                 'single pass.')
+    parser.add_argument('--images', dest='images_path', type=str,
+                        help='Path to images directory.')
+    parser.add_argument('--weights', dest='weights_path', type=str,
+                        help='Path to YOLOv4 weights.')
+    parser.add_argument('--cfg', dest='cfg_path', type=str,
+                        help='Path to darknet configuration file.')
+    parser.add_argument('--names', dest='names_path', type=str,
+                        help='Path to darknet names file.')
+    parser.add_argument('--thresh', dest='confidence_threshold', type=float,
+                        default=0.5, help='Confidence threshold.')
+    parser.add_argument('--cache', dest='cache_path', type=str,
+                        help='Path to raw detections cache file.')
+    parser.add_argument('--batch', dest='batch_size', type=int,
+                        default=BATCH_SIZE,
+                        help='Number of images fed to both models at once.')
+    parser.add_argument('--fresh', dest='fresh', action='store_true',
+                        help='Discard checkpoints of an interrupted run.')
+    args = parser.parse_args()
+
+    if args.images_path is None:
+        images_path = [
+            pathfinder.get('assets', 'data', 'train'),
+            pathfinder.get('assets', 'data', 'val'),
+        ]
+    else:
+        images_path = Path(args.images_path)
+
+    weights_path = Path(args.weights_path) if args.weights_path else \
+        pathfinder.get('assets', 'models', 'yolov4.weights')
+    cfg_path = Path(args.cfg_path) if args.cfg_path else \
+        pathfinder.get('rubrix', 'index', 'darknet', 'cfg', 'yolov4.cfg')
+    names_path = Path(args.names_path) if args.names_path else \
+        pathfinder.get('rubrix', 'index', 'darknet', 'data', 'coco.names')
+    cache_path = None if args.cache_path is None else Path(args.cache_path)
+
+    index_images(images_path, weights_path, cfg_path, names_path,
+                 args.confidence_threshold, cache_path, args.batch_size,
+                 resume=not args.fresh)
@@ -0,0 +1,204 @@
+"""Adds images to the index without rebuilding it.
+
+Object detection, image descriptor extraction and caption encoding are run
+for the new images only, which are then written to a delta segment of the
+store (see :mod: ``rubrix.index.segments``). Running web servers search the
+new segment from their next query on.
+
+Images from outside the main directory are copied to
+``assets/data/ingested``, under a name no other image has, as image paths
+are stored relative to the main directory.
+
+Usage:
+    $ python rubrix/index/ingest.py --images a.jpg b.jpg --captions c.json
+
+where ``c.json`` holds captions in the format written by :method:
+``rubrix.index.download.txt_to_json``, i.e., ``{"contents": [{"image_id":
+"a.jpg", "caption": "..."}, ...]}``.
+"""
+import shutil
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from rubrix import metrics, pathfinder
+from rubrix.index import segments
+from rubrix.index.catalog import relative_path
+from rubrix.index.descriptors import TARGET_SIZE
+from rubrix.index.detections import MIN_CONFIDENCE
+from rubrix.index.lexical import read_captions
+from rubrix.index.store import EMBEDDINGS_FILE, snapshot_path
+
+
+# Number of images ingested.
+INGESTED = metrics.register(metrics.Counter(
+    'rubrix_ingested_images_total', 'Number of images ingested.'))
+
+
+def ingest(image_paths, captions, weights_path, cfg_path, names_path,
+           thresh=0.5, model=None, net=None, cnn=None, segments_path=None,
+           store_path=None, images=None):
+    """Detects objects, extracts image descriptors and encodes captions for
+    ``image_paths``, and writes them to a new segment.
+
+    Arguments:
+    ----------
+        image_paths (list of pathlib.Path):
+            Paths to new images.
+        captions (dict):
+            Mapping from image file name to its list of captions. Images
+            without captions can only be found by reverse-image search.
+        weights_path (pathlib.Path):
+            Path to YOLOv4 pretrained weights file.
+        cfg_path (pathlib.Path):
+            Path to darknet configuration file.
+        names_path (pathlib.Path):
+            Path to darknet names file.
+        thresh (float):
+            Confidence threshold of object detections, as in :method:
+            ``rubrix.index.objects.create_index``.
+        model (tensorflow.saved_model):
+            Universal sentence encoder (large). Loaded if not given.
+        net (cv2.dnn.Net):
+            YOLOv4 model. Loaded if not given.
+        cnn (tensorflow.keras.Model):
+            InceptionV3 model, with average pooling. Loaded if not given.
+        segments_path (pathlib.Path):
+            Path to segments directory. Defaults to :method:
+            ``rubrix.index.segments.default_path``.
+        store_path (pathlib.Path):
+            Path to the main store directory, whose caption embeddings have
+            the dimension of those of the new images.
+        images (list of numpy.ndarray):
+            Images already decoded by OpenCV, in the order of
+            ``image_paths``. Decoded from ``image_paths`` if not given.
+
+    Returns:
+    --------
+        name (str):
+            Name of the new segment.
+    """
+    # OpenCV and Tensorflow are only imported when images are ingested.
+    import cv2
+    from rubrix.image.detect import (get_labels, get_yolo_net,
+                                     raw_detections, summarize_detections)
+    from rubrix.image.extract import extract_batch_descriptors
+
+    if not image_paths:
+        raise ValueError('No images to ingest.')
+    if images is None:
+        images = []
+        for path in image_paths:
+            image = cv2.imread(str(path))
+            if image is None:
+                raise ValueError(f'Unable to decode image {path}.')
+            images.append(image)
+    if net is None:
+        net = get_yolo_net(cfg_path, weights_path)
+    if cnn is None:
+        from rubrix.models import load_inception
+        cnn = load_inception()
+    if model is None:
+        from rubrix.models import load_sentence_encoder
+        model = load_sentence_encoder()
+    labels = get_labels(names_path)
+
+    print(f'[INFO] Ingesting {len(image_paths)} images.')
+    stored_paths = [relative_path(_store_image(Path(path)))
+                    for path in image_paths]
+
+    # Each image is decoded once, for both models.
+    objects = [summarize_detections(
+                   labels, *raw_detections(net, image, MIN_CONFIDENCE), thresh)
+               for image in images]
+    descriptors = extract_batch_descriptors(cnn, images, TARGET_SIZE)
+
+    # Captions are looked up by the original file names, and stored by the
+    # paths of the copies.
+    image_captions = {stored: list(captions.get(Path(path).name, []))
+                      for path, stored in zip(image_paths, stored_paths)}
+    texts = [caption for stored in stored_paths
+             for caption in image_captions[stored]]
+    offsets = np.zeros(len(stored_paths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(image_captions[stored])
+                             for stored in stored_paths])
+    if texts:
+        embeddings = model(texts).numpy()
+    else:
+        store_path = snapshot_path(store_path or
+                                   pathfinder.get('assets', 'store'))
+        dim = np.load(store_path / EMBEDDINGS_FILE, mmap_mode='r').shape[1]
+        embeddings = np.zeros((0, dim), dtype=np.float32)
+
+    name = segments.add_segment(
+        segments_path or segments.default_path(),
+        lambda segment_path: segments.write_segment(
+            segment_path, stored_paths, offsets, embeddings,
+            descriptors.reshape(len(stored_paths), -1),
+            objects, image_captions, labels))
+    INGESTED.inc(len(stored_paths))
+    print(f'[INFO] Ingested {len(stored_paths)} images into {name}.')
+    return name
+
+
+def _store_image(path):
+    """Copies image ``path`` to ``assets/data/ingested``, unless it is within
+    the main directory already, and returns the path to the stored image.
+    """
+    root = pathfinder.get_root()
+    try:
+        path.resolve().relative_to(root.resolve())
+        return path.resolve()
+    except ValueError:
+        pass
+
+    ingested_path = pathfinder.get('assets', 'data', 'ingested')
+    ingested_path.mkdir(parents=True, exist_ok=True)
+    destination = ingested_path / path.name
+    copy = 1
+    while destination.exists():
+        destination = ingested_path / f'{path.stem}-{copy}{path.suffix}'
+        copy += 1
+    shutil.copyfile(str(path), str(destination))
+    return destination
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add images to the index '
+                                                 'without rebuilding it.')
+    parser.add_argument('--images', dest='image_paths', type=str, nargs='+',
+                        required=True, help='Paths to new images.')
+    parser.add_argument('--captions', dest='captions_paths', type=str,
+                        nargs='*', default=[],
+                        help='Paths to captions JSON files of new images.')
+    parser.add_argument('--weights', dest='weights_path', type=str,
+                        help='Path to YOLOv4 weights.')
+    parser.add_argument('--cfg', dest='cfg_path', type=str,
+                        help='Path to YOLOv4 configuration file.')
+    parser.add_argument('--names', dest='names_path', type=str,
+                        help='Path to YOLOv4 names file.')
+    parser.add_argument('--thresh', dest='confidence_threshold', type=float,
+                        default=0.5, help='Confidence threshold.')
+    parser.add_argument('--segments', dest='segments_path', type=str,
+                        help='Path to segments directory.')
+    parser.add_argument('--merge', dest='merge', action='store_true',
+                        help='Merge all segments afterwards, however few.')
+    args = parser.parse_args()
+
+    weights_path = Path(args.weights_path) if args.weights_path else \
+        pathfinder.get('assets', 'models', 'yolov4.weights')
+    cfg_path = Path(args.cfg_path) if args.cfg_path else \
+        pathfinder.get('rubrix', 'index', 'darknet', 'cfg', 'yolov4.cfg')
+    names_path = Path(args.names_path) if args.names_path else \
+        pathfinder.get('rubrix', 'index', 'darknet', 'data', 'coco.names')
+    segments_path = Path(args.segments_path) if args.segments_path else \
+        segments.default_path()
+
+    ingest([Path(path) for path in args.image_paths],
+           read_captions([Path(path) for path in args.captions_paths]),
+           weights_path, cfg_path, names_path, args.confidence_threshold,
+           segments_path=segments_path)
+    segments.merge_segments(segments_path,
+                            threshold=2 if args.merge else
+                            segments.MERGE_THRESHOLD)
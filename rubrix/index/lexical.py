@@ -0,0 +1,270 @@
+"""BM25 inverted index over the caption text of each image.
+
+Object-based filtering finds candidate images through the 80 COCO labels,
+which misses concepts such as "beach", "snow" or "skateboard trick". The
+lexical index instead maps every caption token to the images whose captions
+contain it, so such queries get a small set of relevant candidates from a
+few array lookups, without spaCy or the sentence encoder.
+
+Each image is a document made of all of its captions. The index is written
+in the catalog format (see :mod: ``rubrix.index.catalog``) to
+``lexicon.bin``, with sections:
+    - ``tokstr``, ``tokoff``: string table of the vocabulary, sorted,
+    - ``lexoff``: start of the posting list of each token, followed by the
+      total number of postings,
+    - ``lexids`` (int32): image IDs of the postings, sorted within each
+      posting list,
+    - ``lextf`` (uint16): number of occurrences of the token in the
+      captions of the image,
+    - ``doclen`` (uint32): number of tokens in the captions of each image.
+"""
+import re
+from pathlib import Path
+
+import numpy as np
+
+from rubrix.index.catalog import (decode_strings, encode_strings,
+                                  read_sections, write_catalog)
+from rubrix.index.download import iter_captions
+
+
+# File holding the lexical index, within the store directory.
+LEXICON_FILE = 'lexicon.bin'
+
+# BM25 parameters: term frequency saturation, and document length
+# normalization.
+K1, B = 1.2, 0.75
+
+# Number of best images by BM25 score which are candidates of a query.
+CANDIDATES = 500
+
+# Tokens too common in captions to tell images apart.
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'by', 'for', 'from', 'has', 'in',
+    'is', 'it', 'its', 'of', 'on', 'or', 'the', 'their', 'there', 'to',
+    'two', 'while', 'with',
+])
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """Splits ``text`` into lowercase tokens, dropping stop words, and
+    reducing plurals to their singular form (e.g. 'dogs' to 'dog').
+
+    Arguments:
+    ----------
+        text (str):
+            Caption or query.
+
+    Returns:
+    --------
+        tokens (list):
+            Tokens of ``text``, in order.
+    """
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        if token in STOP_WORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and \
+           not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class LexicalIndex:
+    """Read-only, memory-mapped BM25 index over image captions.
+    """
+    def __init__(self, sections):
+        """Initializes :class: ``LexicalIndex``.
+
+        Arguments:
+        ----------
+            sections (dict):
+                Mapping from section tag to 1-D numpy array.
+        """
+        self.sections = sections
+        self.vocabulary = {token: token_id for token_id, token in enumerate(
+            decode_strings(sections['tokstr'], sections['tokoff']))}
+        self.lengths = sections['doclen']
+        self.average_length = max(1.0, float(self.lengths.mean())) \
+            if len(self.lengths) else 1.0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def load(cls, store_path):
+        """Loads the lexical index from ``store_path``, or returns None if
+        the store has none.
+        """
+        if not (store_path / LEXICON_FILE).is_file():
+            return None
+        _, sections = read_sections(store_path / LEXICON_FILE)
+        return cls(sections)
+
+    def save(self, store_path):
+        write_catalog(Path(store_path) / LEXICON_FILE, self.sections)
+
+    def slice(self, start, stop):
+        """Returns the lexical index of images ``[start, stop)``, with IDs
+        relative to ``start``. Document frequencies, hence BM25 scores, are
+        those of the slice.
+        """
+        ids = self.sections['lexids']
+        inside = (ids >= start) & (ids < stop)
+        # Number of postings kept before each position, so that the new
+        # offsets are the counts at the old offsets.
+        kept = np.zeros(len(ids) + 1, dtype=np.uint64)
+        kept[1:] = np.cumsum(inside)
+        sections = dict(self.sections)
+        sections['lexoff'] = kept[self.sections['lexoff'].astype(np.int64)]
+        sections['lexids'] = (ids[inside] - start).astype(np.int32)
+        sections['lextf'] = self.sections['lextf'][inside]
+        sections['doclen'] = self.sections['doclen'][start:stop]
+        return LexicalIndex(sections)
+
+    def postings(self, token):
+        """Returns the image IDs whose captions contain ``token``, and the
+        number of occurrences of the token in each.
+        """
+        token_id = self.vocabulary.get(token)
+        if token_id is None:
+            return (np.empty(0, dtype=np.int32),
+                    np.empty(0, dtype=np.uint16))
+        offsets = self.sections['lexoff']
+        start, stop = offsets[token_id], offsets[token_id + 1]
+        return self.sections['lexids'][start:stop], \
+            self.sections['lextf'][start:stop]
+
+    def document_frequency(self, token):
+        token_id = self.vocabulary.get(token)
+        if token_id is None:
+            return 0
+        offsets = self.sections['lexoff']
+        return int(offsets[token_id + 1] - offsets[token_id])
+
+    def estimate_candidates(self, tokens, n=CANDIDATES):
+        """Returns an upper bound on the number of candidates of ``tokens``.
+        """
+        return min(n, sum(self.document_frequency(token)
+                          for token in set(tokens)))
+
+    def scores(self, tokens):
+        """Scores the images containing any of ``tokens`` with BM25.
+
+        Arguments:
+        ----------
+            tokens (list):
+                Query tokens, as returned by :method: ``tokenize``.
+
+        Returns:
+        --------
+            ids, scores (tuple of numpy.ndarray):
+                Sorted IDs of the images containing any of the tokens, and
+                their BM25 scores.
+        """
+        all_ids, all_weights = [], []
+        for token in set(tokens):
+            ids, frequencies = self.postings(token)
+            if len(ids) == 0:
+                continue
+            idf = np.log(1 + (len(self) - len(ids) + 0.5) / (len(ids) + 0.5))
+            frequencies = frequencies.astype(np.float32)
+            norms = K1 * (1 - B + B * self.lengths[ids] / self.average_length)
+            all_ids.append(ids)
+            all_weights.append(idf * frequencies * (K1 + 1) /
+                               (frequencies + norms))
+        if not all_ids:
+            return (np.empty(0, dtype=np.int32),
+                    np.empty(0, dtype=np.float32))
+
+        ids, positions = np.unique(np.concatenate(all_ids),
+                                   return_inverse=True)
+        scores = np.bincount(positions, weights=np.concatenate(all_weights))
+        return ids.astype(np.int32), scores.astype(np.float32)
+
+    def candidates(self, tokens, n=CANDIDATES):
+        """Returns the ``n`` best images for ``tokens`` by BM25 score.
+
+        Arguments:
+        ----------
+            tokens (list):
+                Query tokens, as returned by :method: ``tokenize``.
+            n (int):
+                Number of images.
+
+        Returns:
+        --------
+            ids (numpy.ndarray):
+                Sorted image IDs.
+        """
+        ids, scores = self.scores(tokens)
+        if len(ids) > n:
+            ids = ids[np.argpartition(-scores, n - 1)[:n]]
+        return np.sort(ids)
+
+
+def read_captions(captions_paths):
+    """Reads captions from the files written by :method:
+    ``rubrix.index.download.txt_to_json`` or :method:
+    ``rubrix.index.download.prepare_streaming``.
+
+    Arguments:
+    ----------
+        captions_paths (list of pathlib.Path):
+            Paths to captions files. Missing files are skipped.
+
+    Returns:
+    --------
+        captions (dict):
+            Mapping from image file name to its list of captions.
+    """
+    captions = {}
+    for path in captions_paths:
+        if not Path(path).is_file():
+            continue
+        for item in iter_captions(path):
+            captions.setdefault(item['image_id'], []).append(item['caption'])
+    return captions
+
+
+def build_lexicon(images, captions):
+    """Builds the lexical index of ``images``.
+
+    Arguments:
+    ----------
+        images (list):
+            File names of images, indexed by image ID.
+        captions (dict):
+            Mapping from image file name to its list of captions.
+
+    Returns:
+    --------
+        lexicon (LexicalIndex):
+            BM25 index over the captions of ``images``.
+    """
+    postings = {}
+    lengths = np.zeros(len(images), dtype=np.uint32)
+    for image_id, name in enumerate(images):
+        tokens = [token for caption in captions.get(name, [])
+                  for token in tokenize(caption)]
+        lengths[image_id] = len(tokens)
+        for token, count in zip(*np.unique(tokens, return_counts=True)):
+            postings.setdefault(str(token), []).append((image_id, count))
+
+    vocabulary = sorted(postings)
+    token_data, token_offsets = encode_strings(vocabulary)
+    offsets = np.zeros(len(vocabulary) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(postings[token]) for token in vocabulary])
+    pairs = [pair for token in vocabulary for pair in postings[token]]
+    return LexicalIndex({
+        'tokstr': token_data,
+        'tokoff': token_offsets,
+        'lexoff': offsets,
+        'lexids': np.asarray([_id for _id, _ in pairs], dtype=np.int32),
+        'lextf': np.asarray([min(count, 65535) for _, count in pairs],
+                            dtype=np.uint16),
+        'doclen': lengths,
+    })
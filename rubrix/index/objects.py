@@ -3,7 +3,18 @@ file in darknet/data directory to the images in the data directory that
 contain each of these objects.
 
 The inverse-image index file facilitates an object-based image filtering
-for keyword/phrase based image retrieval.
+for keyword/phrase based image retrieval. The images of each object are
+listed in decreasing order of detection confidence, and the confidence and
+area of each detection are written to a parallel file, so that queries can
+be limited to the images in which an object was most confidently detected.
+
+Raw detections are cached in ``assets/detections.npz`` (see
+:mod: ``rubrix.index.detections``), so the index can be re-created at another
+confidence threshold without running YOLOv4 again, and only new or modified
+images are run through YOLOv4 when the data directory changes. Detections
+are also checkpointed in chunks while YOLOv4 runs (see
+:mod: ``rubrix.index.checkpoint``), so an interrupted run resumes where it
+stopped.
 """
 import json
 import argparse
@@ -14,13 +25,23 @@ import cv2
 from tqdm import tqdm
 
 from rubrix import pathfinder
-from rubrix.image.detect import get_yolo_net, get_labels, detect_objects
+from rubrix.image.detect import get_yolo_net, get_labels, raw_detections
+from rubrix.index.checkpoint import Checkpoint
+from rubrix.index.detections import (MIN_CONFIDENCE, DetectionCache,
+                                     derive_index)
 
 
-def create_index(images_path, weights_path, cfg_path, names_path, thresh):
+def create_index(images_path, weights_path, cfg_path, names_path, thresh,
+                 cache_path=None, resume=True):
     """Creates an image index mapping objects in ``names_path`` to image
     files containing the object. JSON file is written to /assets directory.
 
+    Images of each object are sorted by decreasing confidence of the object's
+    most confident detection, and then by decreasing area of its largest
+    bounding box. The confidence and area of the object in each image are
+    written to ``objectScores.json``, as a list parallel to the object's
+    images in ``index.json``.
+
     Arguments:
     ----------
         images_path (pathlib.Path or list of pathlib.Path):
@@ -34,9 +55,13 @@ def create_index(images_path, weights_path, cfg_path, names_path, thresh):
             Path to darknet names file.
         thresh (float):
             Confidence level threshold.
+        cache_path (pathlib.Path):
+            Path to raw detections cache file. Defaults to
+            ``assets/detections.npz``.
+        resume (bool):
+            If True, detections checkpointed by an interrupted run are
+            reused.
     """
-    # Retrieve YOLOv4 model related variables to detect objects in an image.
-    net = get_yolo_net(cfg_path, weights_path)
     labels = get_labels(names_path)
 
     image_paths = []
@@ -47,23 +72,73 @@ def create_index(images_path, weights_path, cfg_path, names_path, thresh):
         for paths in images_path:
             image_paths += list(paths.iterdir())
 
-    index = dict(zip(labels, [[] for _ in range(len(labels))]))
+    if cache_path is None:
+        cache_path = pathfinder.get('assets', 'detections.npz')
+    cache = load_cache(cache_path, thresh)
+
+    # YOLOv4 is only loaded if some image is not in the cache yet.
+    net = None
+    min_confidence = cache.min_confidence
 
-    for _id in tqdm(range(len(image_paths))):
-        image_path = image_paths[_id]
+    def detect(image_path):
+        nonlocal net
+        if net is None:
+            net = get_yolo_net(cfg_path, weights_path)
         image = cv2.imread(str(image_path))
-        objects = detect_objects(net, labels, image, thresh)
+        return raw_detections(net, image, min_confidence)
+
+    checkpoint = open_checkpoint(cache, weights_path, cfg_path, resume)
+    for chunk_path in checkpoint.files():
+        cache = cache.merge(DetectionCache.load(chunk_path))
+    cache = cache.update(tqdm(image_paths), detect, checkpoint=checkpoint)
+    cache.save(cache_path)
+    checkpoint.clear()
+
+    write_index(cache, labels, thresh)
+
+
+def load_cache(cache_path, thresh):
+    """Loads the detection cache at ``cache_path``, or returns an empty
+    cache if it does not exist, or if detections at ``thresh`` were not
+    cached.
+    """
+    if Path(cache_path).is_file():
+        cache = DetectionCache.load(cache_path)
+    else:
+        cache = DetectionCache.empty()
+    if thresh < cache.min_confidence:
+        # Detections at lower confidences were not cached.
+        print(f'[INFO] Threshold {thresh} is below cached confidence '
+              f'{cache.min_confidence}, re-detecting all images.')
+        cache = DetectionCache.empty(min(MIN_CONFIDENCE, thresh))
+    return cache
 
-        for object in objects:
-            _paths = index[object]
-            _paths.append(str(image_path))
-            index[object] = _paths
+
+def open_checkpoint(cache, weights_path, cfg_path, resume=True):
+    """Opens the checkpoint of the detections of new or modified images.
+    """
+    return Checkpoint.open('objects', {
+        'min_confidence': cache.min_confidence,
+        'weights': Path(weights_path).name,
+        'cfg': Path(cfg_path).name,
+    }, resume)
+
+
+def write_index(cache, labels, thresh):
+    """Derives the index from the detections in ``cache``, and writes it to
+    ``assets/index.json`` and ``assets/objectScores.json``.
+    """
+    index, scores = derive_index(cache, labels, thresh)
 
     index_path = pathfinder.get('assets', 'index.json')
+    scores_path = pathfinder.get('assets', 'objectScores.json')
 
     with open(index_path, 'w') as index_file:
         json.dump(index, index_file, indent=4)
 
+    with open(scores_path, 'w') as scores_file:
+        json.dump(scores, scores_file)
+
     print('[INFO] Index creation successful.')
 
 
@@ -79,6 +154,10 @@ if __name__ == "__main__":
                         help='Path to darknet names file.')
     parser.add_argument('--thresh', dest='confidence_threshold', type=float,
                         default=0.5, help='Confidence threshold.')
+    parser.add_argument('--cache', dest='cache_path', type=str,
+                        help='Path to raw detections cache file.')
+    parser.add_argument('--fresh', dest='fresh', action='store_true',
+                        help='Discard checkpoints of an interrupted run.')
 
     args = parser.parse_args()
 
@@ -107,5 +186,8 @@ if __name__ == "__main__":
     else:
         names_path = Path(args.names_path)
 
+    cache_path = None if args.cache_path is None else Path(args.cache_path)
+
     create_index(images_path, weights_path, cfg_path, names_path,
-                 args.confidence_threshold)
+                 args.confidence_threshold, cache_path,
+                 resume=not args.fresh)
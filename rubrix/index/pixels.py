@@ -0,0 +1,211 @@
+"""Cache of decoded and resized images, so that image descriptors can be
+extracted again, e.g. with another backbone, without decoding every JPEG.
+
+Images are decoded and resized as :method:
+``tensorflow.keras.preprocessing.image.load_img`` does (RGB, nearest-
+neighbour resizing), so descriptors extracted from the cache are those
+extracted from the image files. The cache of each target size is a
+directory ``assets/pixels/<height>x<width>``, holding:
+    - ``pixels.npy``: uint8 array of shape (n, height, width, 3), memory-
+      mapped when read,
+    - ``images.json``: key (see :method: ``rubrix.index.catalog.image_key``),
+      size and modification time of the image of each row, to find modified
+      images.
+
+Updating the cache only decodes new or modified images, and copies the rows
+of the others.
+
+Usage:
+    $ python rubrix/index/pixels.py --size 224 224
+"""
+import json
+import argparse
+from pathlib import Path
+from collections import Counter
+
+import numpy as np
+
+from tqdm import tqdm
+
+from rubrix import pathfinder
+from rubrix.index.catalog import file_stamp, image_key
+
+
+PIXELS_FILE = 'pixels.npy'
+IMAGES_FILE = 'images.json'
+
+
+class PixelCache:
+    """Decoded images of one target size, one per row.
+    """
+    def __init__(self, paths, sizes, mtimes, pixels):
+        """Initializes :class: ``PixelCache``.
+
+        Arguments:
+        ----------
+            paths (list):
+                Keys of images (see :method:
+                ``rubrix.index.catalog.image_key``).
+            sizes, mtimes (list):
+                Size and modification time (in nanoseconds) of each image
+                file when it was decoded.
+            pixels (numpy.ndarray):
+                uint8 array of shape (n, height, width, 3).
+        """
+        self.paths = paths
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.pixels = pixels
+        self._positions = {path: position
+                           for position, path in enumerate(paths)}
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def load(cls, cache_path):
+        """Loads the cache at ``cache_path``, or returns None if there is
+        none.
+        """
+        cache_path = Path(cache_path)
+        if not (cache_path / IMAGES_FILE).is_file():
+            return None
+        with open(cache_path / IMAGES_FILE, 'r') as images_file:
+            images = json.load(images_file)
+        pixels = np.load(cache_path / PIXELS_FILE, mmap_mode='r')
+        return cls(images['paths'], images['sizes'], images['mtimes'],
+                   pixels)
+
+    def position(self, path, root=None):
+        """Returns the row of the image at ``path``, or None if it is not
+        cached, or was modified since it was decoded.
+        """
+        position = self._positions.get(image_key(path, root))
+        if position is None:
+            return None
+        size, mtime = file_stamp(path)
+        if size != self.sizes[position] or mtime != self.mtimes[position]:
+            return None
+        return position
+
+
+def default_path(target_size):
+    """Returns the default location of the cache of ``target_size``.
+    """
+    return pathfinder.get('assets', 'pixels',
+                          f'{target_size[0]}x{target_size[1]}')
+
+
+def decode(path, target_size):
+    """Decodes and resizes the image at ``path``.
+
+    Arguments:
+    ----------
+        path (pathlib.Path):
+            Path to image file.
+        target_size (tuple):
+            Height and width to resize the image to.
+
+    Returns:
+    --------
+        pixels (numpy.ndarray):
+            uint8 array of shape (height, width, 3), in RGB channel order.
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        size = (target_size[1], target_size[0])
+        if img.size != size:
+            img = img.resize(size, Image.NEAREST)
+        return np.asarray(img, dtype=np.uint8)
+
+
+def build_pixel_cache(image_paths, target_size, cache_path=None):
+    """Updates the cache of ``target_size`` to hold ``image_paths``, in
+    order. Only new or modified images are decoded.
+
+    Arguments:
+    ----------
+        image_paths (list of pathlib.Path):
+            Paths to image files.
+        target_size (tuple):
+            Height and width to resize images to.
+        cache_path (pathlib.Path):
+            Path to cache directory. Defaults to :method: ``default_path``.
+
+    Returns:
+    --------
+        cache (PixelCache):
+            Updated cache, memory-mapped.
+
+    Raises:
+    -------
+        ValueError:
+            If two paths in ``image_paths`` are to the same image.
+    """
+    keys = [image_key(path) for path in image_paths]
+    duplicates = sorted(key for key, count in Counter(keys).items()
+                        if count > 1)
+    if duplicates:
+        raise ValueError(f'Images are listed more than once: {duplicates}.')
+
+    cache_path = Path(cache_path or default_path(target_size))
+    cache_path.mkdir(parents=True, exist_ok=True)
+    previous = PixelCache.load(cache_path)
+
+    temporary_path = cache_path / (PIXELS_FILE + '.tmp')
+    pixels = np.lib.format.open_memmap(
+        temporary_path, mode='w+', dtype=np.uint8,
+        shape=(len(image_paths), target_size[0], target_size[1], 3))
+    stamps, n_decoded = [], 0
+    for row, path in enumerate(tqdm(image_paths)):
+        stamps.append(file_stamp(path))
+        position = None if previous is None else previous.position(path)
+        if position is None:
+            pixels[row] = decode(path, target_size)
+            n_decoded += 1
+        else:
+            pixels[row] = previous.pixels[position]
+    pixels.flush()
+    del pixels, previous
+
+    # The image list is removed while the pixels are replaced, so that a
+    # failure in between leaves no cache rather than mismatched rows.
+    if (cache_path / IMAGES_FILE).is_file():
+        (cache_path / IMAGES_FILE).unlink()
+    temporary_path.replace(cache_path / PIXELS_FILE)
+    images_path = cache_path / (IMAGES_FILE + '.tmp')
+    with open(images_path, 'w') as images_file:
+        json.dump({'paths': keys,
+                   'sizes': [size for size, _ in stamps],
+                   'mtimes': [mtime for _, mtime in stamps]}, images_file)
+    images_path.replace(cache_path / IMAGES_FILE)
+
+    print(f'[INFO] Decoded {n_decoded} new or modified images, reused '
+          f'{len(image_paths) - n_decoded} cached images.')
+    return PixelCache.load(cache_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cache decoded and resized '
+                                                 'images.')
+    parser.add_argument('--images', dest='images_path', type=str,
+                        help='Path to images directory.')
+    parser.add_argument('--size', dest='target_size', type=int, nargs=2,
+                        default=[299, 299], help='Height and width to resize '
+                                                 'images to.')
+    args = parser.parse_args()
+
+    if args.images_path is None:
+        images_path = [
+            pathfinder.get('assets', 'data', 'train'),
+            pathfinder.get('assets', 'data', 'val'),
+        ]
+    else:
+        images_path = [Path(args.images_path)]
+
+    build_pixel_cache([path for paths in images_path
+                       for path in sorted(paths.iterdir())],
+                      tuple(args.target_size))
@@ -0,0 +1,371 @@
+"""Cost-based planning of searches over the index store.
+
+A search can be executed with one of five strategies:
+    - ``prefilter``: combine the posting lists of the query labels, and
+      score only the candidate images. Rows of the candidates are gathered
+      from all over the embeddings matrix, which costs about ``GATHER_COST``
+      times more per row than reading contiguous rows.
+    - ``scan``: score every image in a single pass over contiguous rows,
+      and drop images which are not candidates afterwards.
+    - ``bounded``: visit the candidates in decreasing order of an upper
+      bound on their scores, and stop once no candidate left can enter the
+      top-k (see :mod: ``rubrix.index.bounds``). Results are identical to
+      scoring every candidate.
+    - ``aggregate``: score one aggregated vector per image rather than each
+      of its captions, and optionally rescore the best images against their
+      captions (see :mod: ``rubrix.index.aggregate``). This is the only
+      strategy for caption searches over stores built with aggregates.
+    - ``ann``: score only the caption embeddings in the clusters of the IVF
+      index which best match the query (see :mod: ``rubrix.index.ann``).
+      Results are approximate, hence this is only planned when enabled with
+      ``RUBRIX_APPROXIMATE=1``, and when the probed clusters are expected to
+      hold plenty of candidates.
+
+The planner estimates the number of candidates from the cardinalities of the
+posting lists (and the document frequencies of query terms, see :mod:
+``rubrix.index.lexical``), estimates the cost of each strategy in units of
+contiguous rows scored, and picks the cheapest. Each plan is logged to the
+``rubrix.planner`` logger along with its actual cost, so that the choices of
+the planner can be audited.
+"""
+import os
+import json
+import time
+import logging
+
+import numpy as np
+
+from rubrix import deadline, metrics
+from rubrix.index import ann, bounds
+
+
+logger = logging.getLogger('rubrix.planner')
+
+PREFILTER, SCAN, BOUNDED, AGGREGATE, ANN = ('prefilter', 'scan', 'bounded',
+                                            'aggregate', 'ann')
+
+# Cost of scoring a row gathered by fancy indexing, relative to scoring a
+# row within a contiguous slice (measured with 512-dimensional embeddings).
+GATHER_COST = 4.0
+
+# Cost of combining posting lists, per label and per image of the store.
+# Bitmaps hold 8 images per byte, and are combined 8 bytes at a time.
+BITMAP_COST = 1 / 64
+
+# Expected number of images visited by bounded searches, as a multiple of
+# ``k``. The actual number visited depends on how tight the bounds are for
+# the query, and is reflected in the actual cost logged for each plan.
+BOUNDED_VISITS = 20
+
+# With ``RUBRIX_APPROXIMATE=1``, searches may be planned as approximate
+# searches over the IVF index.
+APPROXIMATE = os.environ.get('RUBRIX_APPROXIMATE', '0') == '1'
+
+# ANN is only planned if the probed clusters are expected to hold at least
+# this many times ``k`` candidates.
+ANN_MIN_HITS = 10
+
+# Queries with a deadline score candidates in chunks of this many images,
+# and stop once the deadline has passed (see :mod: ``rubrix.deadline``).
+DEADLINE_CHUNK = 16384
+
+# Number of searches executed with each strategy.
+PLANS = metrics.register(metrics.Counter(
+    'rubrix_query_plans_total',
+    'Number of searches executed with each strategy.'))
+
+
+class Plan:
+    """Strategy chosen for a search, with its estimated cost.
+    """
+    def __init__(self, kind, strategy, labels, k, start, stop, mode, budget,
+                 estimated_candidates, costs, terms=None):
+        """Initializes :class: ``Plan``.
+
+        Arguments:
+        ----------
+            kind (str):
+                Either 'captions' or 'descriptors'.
+            strategy (str):
+                One of ``PREFILTER``, ``SCAN``, ``BOUNDED``, ``AGGREGATE``
+                or ``ANN``.
+            labels, k, start, stop, mode, budget:
+                Search arguments (see :method:
+                ``rubrix.index.store.IndexStore.candidates``).
+            estimated_candidates (int):
+                Estimated number of candidate images.
+            costs (dict):
+                Estimated cost of each strategy considered.
+            terms (list or None):
+                Query terms (see :method:
+                ``rubrix.index.store.IndexStore.candidates``).
+        """
+        self.kind = kind
+        self.strategy = strategy
+        self.labels = labels
+        self.k = k
+        self.start = start
+        self.stop = stop
+        self.mode = mode
+        self.budget = budget
+        self.estimated_candidates = estimated_candidates
+        self.costs = costs
+        self.terms = terms
+
+    @property
+    def estimated_cost(self):
+        return self.costs[self.strategy]
+
+
+def plan_search(store, kind, labels, k, start=0, stop=None, mode='or',
+                budget=None, terms=None, approximate=APPROXIMATE):
+    """Chooses the cheapest strategy to search ``store``.
+
+    Arguments:
+    ----------
+        store (rubrix.index.store.IndexStore):
+            Store to search.
+        kind (str):
+            Either 'captions' or 'descriptors'.
+        labels (list or None):
+            Object labels, or groups of labels. If None, all images are
+            candidates.
+        k (int):
+            Number of images to retrieve.
+        start, stop (int):
+            Range of image IDs to search.
+        mode (str):
+            Either 'or' or 'and'.
+        budget (int or None):
+            Maximum number of images per label.
+        terms (list or None):
+            Query terms, whose best matching images by BM25 score are
+            candidates too.
+        approximate (bool):
+            If False, ANN is never planned. Defaults to ``APPROXIMATE``.
+
+    Returns:
+    --------
+        plan (Plan):
+            Chosen plan.
+    """
+    stop = len(store) if stop is None else stop
+    n_images = stop - start
+    if kind == 'captions':
+        n_rows = int(store.offsets[stop] - store.offsets[start])
+    else:
+        n_rows = n_images
+
+    filter_cost = _filter_cost(store, labels, terms)
+    unfiltered = store.is_unfiltered(labels, terms)
+    if unfiltered:
+        candidates = n_images
+    else:
+        # Cardinalities are over the whole store, and candidates are assumed
+        # to be spread evenly over it.
+        candidates = store.estimate_candidates(labels, mode, budget, terms) \
+            * n_images // max(1, len(store))
+
+    rows_per_image = n_rows / max(1, n_images)
+    aggregates = store.aggregates if kind == 'captions' else None
+    if aggregates is not None:
+        # Aggregated vectors are gathered unless all images are candidates.
+        gather_cost = 1.0 if unfiltered else GATHER_COST
+        costs = {AGGREGATE: filter_cost + candidates *
+                 aggregates.n_prototypes * gather_cost +
+                 min(candidates, aggregates.rerank) * rows_per_image *
+                 GATHER_COST}
+        return Plan(kind, AGGREGATE, labels, k, start, stop, mode, budget,
+                    candidates, costs, terms)
+
+    costs = {SCAN: filter_cost + n_rows}
+    if not unfiltered:
+        costs[PREFILTER] = filter_cost + \
+            candidates * rows_per_image * GATHER_COST
+
+    if kind == 'captions' and store.bounds is not None:
+        # Bounds take one dot product per candidate, gathered unless all
+        # images are candidates.
+        bound_cost = 1.0 if unfiltered else GATHER_COST
+        visits = min(candidates, BOUNDED_VISITS * k)
+        costs[BOUNDED] = filter_cost + candidates * bound_cost + \
+            visits * rows_per_image * GATHER_COST
+
+    ivf = store.ivf if kind == 'captions' else None
+    if approximate and ivf is not None:
+        fraction = min(1.0, ann.N_PROBE / len(ivf))
+        if fraction < 1.0 and candidates * fraction >= ANN_MIN_HITS * k:
+            costs[ANN] = filter_cost + len(ivf) + \
+                n_rows * fraction * GATHER_COST
+
+    strategy = min(costs, key=costs.get)
+    return Plan(kind, strategy, labels, k, start, stop, mode, budget,
+                candidates, costs, terms)
+
+
+def execute(store, plan, array):
+    """Executes ``plan``, and logs its estimated and actual costs.
+
+    Arguments:
+    ----------
+        store (rubrix.index.store.IndexStore):
+            Store to search.
+        plan (Plan):
+            Plan returned by :method: ``plan_search``.
+        array (numpy.ndarray):
+            Sentence embedding or image descriptor of the query.
+
+    Returns:
+    --------
+        ids, scores (tuple of numpy.ndarray):
+            IDs of the candidate images scored, and their scores.
+    """
+    started = time.perf_counter()
+    if plan.strategy == ANN:
+        ids, scores, cost = _ann(store, plan, array)
+    elif plan.strategy == AGGREGATE:
+        ids, scores, cost = _aggregate(store, plan, array)
+    elif plan.strategy == BOUNDED:
+        ids, scores, cost = _bounded(store, plan, array)
+    elif plan.strategy == SCAN:
+        ids, scores, cost = _scan(store, plan, array)
+    else:
+        ids, scores, cost = _prefilter(store, plan, array)
+    cost += _filter_cost(store, plan.labels, plan.terms)
+    seconds = time.perf_counter() - started
+
+    PLANS.inc(kind=plan.kind, strategy=plan.strategy)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({
+            'kind': plan.kind,
+            'strategy': plan.strategy,
+            'labels': plan.labels,
+            'terms': plan.terms,
+            'mode': plan.mode,
+            'budget': plan.budget,
+            'range': [plan.start, plan.stop],
+            'estimated_candidates': int(plan.estimated_candidates),
+            'actual_candidates': int(len(ids)),
+            'estimated_cost': round(plan.estimated_cost, 1),
+            'actual_cost': round(cost, 1),
+            'costs': {strategy: round(value, 1)
+                      for strategy, value in plan.costs.items()},
+            'seconds': round(seconds, 6),
+        }))
+    return ids, scores
+
+
+def _filter_cost(store, labels, terms=None):
+    cost = 0.0
+    if labels is not None:
+        n_labels = sum(len(group) if isinstance(group, list) else 1
+                       for group in labels)
+        cost += n_labels * len(store) * BITMAP_COST
+    if store.lexicon is not None and terms:
+        # Postings of query terms are scored one by one, and the lexical
+        # candidates are combined as one more bitmap.
+        cost += sum(store.lexicon.document_frequency(term)
+                    for term in set(terms)) + len(store) * BITMAP_COST
+    return cost
+
+
+def _score(store, kind, array, ids):
+    if kind == 'captions':
+        return store.score_captions(array, ids)
+    return store.score_descriptors(array, ids)
+
+
+def _score_until(store, kind, array, ids):
+    # Returns the IDs scored before the deadline of the query passed, and
+    # their scores. At least one chunk is scored.
+    active = deadline.current()
+    if active is None or len(ids) <= DEADLINE_CHUNK:
+        return ids, _score(store, kind, array, ids)
+    scores = []
+    for start in range(0, len(ids), DEADLINE_CHUNK):
+        if scores and active.expired():
+            active.degrade(deadline.PARTIAL)
+            break
+        scores.append(_score(store, kind, array,
+                             ids[start:start + DEADLINE_CHUNK]))
+    scores = np.concatenate(scores)
+    return ids[:len(scores)], scores
+
+
+def _rows(store, kind, ids):
+    if kind == 'captions':
+        return int((store.offsets[ids + 1] - store.offsets[ids]).sum())
+    return len(ids)
+
+
+def _prefilter(store, plan, array):
+    ids = store.candidates(plan.labels, plan.start, plan.stop, plan.mode,
+                           plan.budget, plan.terms)
+    ids, scores = _score_until(store, plan.kind, array, ids)
+    return ids, scores, _rows(store, plan.kind, ids) * GATHER_COST
+
+
+def _scan(store, plan, array):
+    ids = np.arange(plan.start, plan.stop, dtype=np.int32)
+    ids, scores = _score_until(store, plan.kind, array, ids)
+    cost = _rows(store, plan.kind, ids)
+    if not store.is_unfiltered(plan.labels, plan.terms):
+        mask = store.candidate_mask(plan.labels, plan.start, plan.stop,
+                                    plan.mode, plan.budget, plan.terms)
+        mask = mask[:len(ids)]
+        ids, scores = ids[mask], scores[mask]
+    return ids, scores, cost
+
+
+def _bounded(store, plan, array):
+    ids = store.candidates(plan.labels, plan.start, plan.stop, plan.mode,
+                           plan.budget, plan.terms)
+    scored_ids, scores, n_rows = bounds.bounded_search(store, array, ids,
+                                                       plan.k)
+    bound_cost = 1.0 if store.is_unfiltered(plan.labels, plan.terms) \
+        else GATHER_COST
+    return scored_ids, scores, len(ids) * bound_cost + n_rows * GATHER_COST
+
+
+def _aggregate(store, plan, array):
+    aggregates = store.aggregates
+    ids = store.candidates(plan.labels, plan.start, plan.stop, plan.mode,
+                           plan.budget, plan.terms)
+    scores = aggregates.score(array, ids)
+    # Images without captions can never be retrieved by text.
+    scores[store.offsets[ids + 1] == store.offsets[ids]] = -np.inf
+    gather_cost = 1.0 if store.is_unfiltered(plan.labels, plan.terms) \
+        else GATHER_COST
+    cost = len(ids) * aggregates.n_prototypes * gather_cost
+    if not aggregates.rerank:
+        return ids, scores, cost
+
+    # The best images by aggregated score are rescored by their captions.
+    n_best = max(aggregates.rerank, plan.k)
+    if len(ids) > n_best:
+        ids = np.sort(ids[np.argpartition(-scores, n_best - 1)[:n_best]])
+    best = ids
+    cost += _rows(store, 'captions', best) * GATHER_COST
+    return best, store.score_captions(array, best), cost
+
+
+def _ann(store, plan, array):
+    rows = store.ivf.probe(array)
+    low, high = store.offsets[plan.start], store.offsets[plan.stop]
+    rows = rows[(rows >= low) & (rows < high)]
+    images = np.searchsorted(store.offsets, rows, side='right') - 1
+    if not store.is_unfiltered(plan.labels, plan.terms):
+        mask = store.candidate_mask(plan.labels, plan.start, plan.stop,
+                                    plan.mode, plan.budget, plan.terms)
+        keep = mask[images - plan.start]
+        rows, images = rows[keep], images[keep]
+    cost = len(store.ivf) + len(rows) * GATHER_COST
+    if len(rows) == 0:
+        return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32),
+                cost)
+
+    # Rows are sorted, hence the rows of each image are adjacent, and an
+    # image is scored by its best caption among the probed ones.
+    row_scores = store.embeddings[rows] @ array
+    ids, firsts = np.unique(images, return_index=True)
+    return ids, np.maximum.reduceat(row_scores, firsts), cost
@@ -0,0 +1,390 @@
+"""Delta segments of images added to the index after the store was built.
+
+Building the store walks the whole corpus, so images added later are
+written to small delta segments instead (see :mod: ``rubrix.index.ingest``).
+Each segment is a store directory of its own, in the same format as the main
+store (catalog, caption embeddings, image descriptors, caption bounds and
+lexical index), along with the text of its captions, ``captions.json``.
+
+Segments live in ``assets/store/segments``, and are listed in order in the
+manifest, ``segments.json``. The manifest is replaced atomically, and
+:class: ``SegmentedStore`` checks it before every search, so that images
+ingested by any process are searched by running servers right away. Image
+IDs of segments follow those of the main store, in manifest order.
+
+Every ingestion adds a segment, so segments are merged once there are
+``MERGE_THRESHOLD`` of them. Merging concatenates consecutive segments into
+one, in order, hence image IDs do not change.
+"""
+import json
+import fcntl
+import shutil
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+import numpy as np
+
+from rubrix import deadline, pathfinder
+from rubrix.index.bounds import build_bounds
+from rubrix.index.catalog import build_sections, write_catalog
+from rubrix.index.lexical import build_lexicon, read_captions
+from rubrix.index.store import (CATALOG_FILE, DESCRIPTORS_FILE,
+                                EMBEDDINGS_FILE, IndexStore, rank_postings)
+from rubrix.sharding import merge_top_k
+
+
+# Files within the segments directory.
+MANIFEST_FILE = 'segments.json'
+LOCK_FILE = '.lock'
+MERGE_LOCK_FILE = '.merge.lock'
+
+# Captions of the images of a segment, within the segment directory.
+CAPTIONS_FILE = 'captions.json'
+
+# Segments are merged once there are this many.
+MERGE_THRESHOLD = 4
+
+# Number of times the manifest is re-read when a segment it lists was
+# removed by a merge before it could be loaded.
+LOAD_ATTEMPTS = 3
+
+
+class SegmentedStore:
+    """Searches the main store and its delta segments as one index.
+
+    Exposes the same search interface as :class:
+    ``rubrix.index.store.IndexStore``, so it can be passed to the query
+    functions in :mod: ``rubrix.query`` in place of the store. Each segment
+    applies ``budget`` and ``terms`` to its own images.
+    """
+    def __init__(self, base, segments_path=None):
+        """Initializes :class: ``SegmentedStore``.
+
+        Arguments:
+        ----------
+            base (rubrix.index.store.IndexStore or
+                  rubrix.sharding.ShardedScorer):
+                Index over the main store.
+            segments_path (pathlib.Path):
+                Path to segments directory. Defaults to :method:
+                ``default_path``.
+        """
+        self.base = base
+        self.segments_path = Path(segments_path or default_path())
+        self._segments = []
+        self._stamp = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def __len__(self):
+        return len(self.base) + sum(len(segment)
+                                    for _, segment in self._segments)
+
+    @property
+    def segments(self):
+        return [name for name, _ in self._segments]
+
+    def refresh(self):
+        """Loads the segments added (or merged) since the manifest was last
+        read. Segments already loaded are kept.
+        """
+        stamp = _stamp(self.segments_path / MANIFEST_FILE)
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            loaded = dict(self._segments)
+            for attempt in range(LOAD_ATTEMPTS):
+                stamp = _stamp(self.segments_path / MANIFEST_FILE)
+                try:
+                    segments = [(name, loaded[name] if name in loaded
+                                 else _load(self.segments_path / name))
+                                for name in read_manifest(self.segments_path)]
+                    break
+                except FileNotFoundError:
+                    # A merge removed a segment after the manifest was read.
+                    if attempt == LOAD_ATTEMPTS - 1:
+                        raise
+            # Searches in progress keep the list they started with.
+            self._segments = segments
+            self._stamp = stamp
+
+    def path(self, image_id):
+        index, image_id = self._locate(image_id)
+        return index.path(image_id)
+
+    def _locate(self, image_id):
+        if image_id < len(self.base):
+            return self.base, image_id
+        image_id -= len(self.base)
+        for _, segment in self._segments:
+            if image_id < len(segment):
+                return segment, image_id
+            image_id -= len(segment)
+        raise IndexError('Image ID out of range.')
+
+    def search_captions(self, array, labels, k, mode='or', budget=None,
+                        terms=None):
+        """Retrieves the ``k`` images among those containing ``labels``,
+        whose captions best match sentence embedding ``array``.
+
+        See :method: ``rubrix.index.store.IndexStore.search_captions``.
+        """
+        return self._search('captions', array, labels, k, mode, budget,
+                            terms)
+
+    def search_descriptors(self, array, labels, k, mode='or', budget=None,
+                           terms=None):
+        """Retrieves the ``k`` images among those containing ``labels``,
+        whose image descriptors best match ``array``.
+
+        See :method: ``rubrix.index.store.IndexStore.search_descriptors``.
+        """
+        return self._search('descriptors', array, labels, k, mode, budget,
+                            terms)
+
+    def _search(self, kind, array, labels, k, mode, budget, terms):
+        self.refresh()
+        segments = self._segments
+        method = f'search_{kind}'
+        local_results = [getattr(self.base, method)(
+            array, labels, k, mode=mode, budget=budget, terms=terms)]
+        offset = len(self.base)
+        active = deadline.current()
+        for _, segment in segments:
+            # Segments not searched before the deadline are left out.
+            if active is not None and active.expired():
+                active.degrade(deadline.PARTIAL)
+                break
+            results = getattr(segment, method)(array, labels, k, mode=mode,
+                                               budget=budget, terms=terms)
+            local_results.append([(offset + image_id, score)
+                                  for image_id, score in results])
+            offset += len(segment)
+        return merge_top_k(local_results, k)
+
+
+def default_path():
+    """Returns default location of the segments directory.
+    """
+    return pathfinder.get('assets', 'store', 'segments')
+
+
+def read_manifest(segments_path):
+    """Returns the names of the segments in ``segments_path``, in order.
+    """
+    manifest_path = Path(segments_path) / MANIFEST_FILE
+    if not manifest_path.is_file():
+        return []
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)['segments']
+
+
+def write_segment(segment_path, image_paths, offsets, embeddings,
+                  descriptors, objects, captions, labels):
+    """Writes a segment holding ``image_paths``.
+
+    Arguments:
+    ----------
+        segment_path (pathlib.Path):
+            Path to segment directory.
+        image_paths (list):
+            Paths to images, relative to the main directory.
+        offsets (array_like):
+            Start row of the caption embeddings of each image, followed by
+            the total number of caption embeddings.
+        embeddings (numpy.ndarray):
+            Caption embeddings, one row per caption.
+        descriptors (numpy.ndarray):
+            Image descriptors, one row per image.
+        objects (list):
+            For each image, mapping from object label to the confidence and
+            box area of its most confident detection.
+        captions (dict):
+            Mapping from relative image path to its list of captions.
+        labels (list):
+            All object labels, so that searches for labels no image of the
+            segment contains find no candidates, rather than failing.
+    """
+    segment_path = Path(segment_path)
+    segment_path.mkdir(parents=True, exist_ok=True)
+
+    postings, rankings = {}, {}
+    for label in labels:
+        ids = [image_id for image_id, found in enumerate(objects)
+               if label in found]
+        postings[label] = ids
+        rankings[label] = rank_postings(ids, [objects[image_id][label]
+                                              for image_id in ids])
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    np.save(segment_path / EMBEDDINGS_FILE, embeddings)
+    np.save(segment_path / DESCRIPTORS_FILE,
+            np.asarray(descriptors, dtype=np.float32))
+    build_bounds(embeddings, offsets).save(segment_path)
+    if any(captions.values()):
+        build_lexicon(image_paths, captions).save(segment_path)
+    with open(segment_path / CAPTIONS_FILE, 'w') as captions_file:
+        json.dump({'contents': [{'image_id': path, 'caption': caption}
+                                for path in image_paths
+                                for caption in captions.get(path, [])]},
+                  captions_file)
+    # The catalog is written last, as a segment without one is incomplete.
+    write_catalog(segment_path / CATALOG_FILE, build_sections(
+        image_paths, offsets, postings, rankings))
+
+
+def add_segment(segments_path, write):
+    """Creates a new segment, and appends it to the manifest once written.
+
+    Arguments:
+    ----------
+        segments_path (pathlib.Path):
+            Path to segments directory.
+        write (callable):
+            Function which writes the segment, given the path to its
+            directory (e.g. :method: ``write_segment``).
+
+    Returns:
+    --------
+        name (str):
+            Name of the new segment.
+    """
+    segments_path = Path(segments_path)
+    segments_path.mkdir(parents=True, exist_ok=True)
+    with _locked(segments_path / LOCK_FILE):
+        name = _next_name(segments_path)
+        # The directory is reserved while the lock is held, and the segment
+        # is only listed once complete.
+        (segments_path / name).mkdir()
+    write(segments_path / name)
+    with _locked(segments_path / LOCK_FILE):
+        _write_manifest(segments_path, read_manifest(segments_path) + [name])
+    return name
+
+
+def merge_segments(segments_path, threshold=MERGE_THRESHOLD):
+    """Merges all segments into one, if there are at least ``threshold`` of
+    them.
+
+    Segments are ingested while a merge runs, and are listed after the
+    merged segment. Only one merge runs at a time.
+
+    Arguments:
+    ----------
+        segments_path (pathlib.Path):
+            Path to segments directory.
+        threshold (int):
+            Minimum number of segments to merge.
+
+    Returns:
+    --------
+        name (str or None):
+            Name of the merged segment, or None if segments were not merged.
+    """
+    segments_path = Path(segments_path)
+    if len(read_manifest(segments_path)) < max(2, threshold):
+        return None
+    with _locked(segments_path / MERGE_LOCK_FILE):
+        names = read_manifest(segments_path)
+        if len(names) < max(2, threshold):
+            return None
+
+        stores = [IndexStore.load(segments_path / name) for name in names]
+        image_paths, objects, offsets = [], [], [0]
+        labels = {}
+        for store in stores:
+            first = len(image_paths)
+            image_paths += [store.relative_path(image_id)
+                            for image_id in range(len(store))]
+            objects += [{} for _ in range(len(store))]
+            offsets += list(offsets[-1] + store.offsets[1:])
+            for label, (ids, confidences, areas) in store.rankings.items():
+                labels[label] = None
+                for image_id, confidence, area in zip(ids, confidences,
+                                                      areas):
+                    objects[first + image_id][label] = (float(confidence),
+                                                        float(area))
+        captions = read_captions([segments_path / name / CAPTIONS_FILE
+                                  for name in names])
+
+        def write(segment_path):
+            write_segment(
+                segment_path, image_paths, offsets,
+                np.concatenate([store.embeddings for store in stores]),
+                np.concatenate([store.descriptors for store in stores]),
+                objects, captions, list(labels))
+
+        with _locked(segments_path / LOCK_FILE):
+            name = _next_name(segments_path)
+            (segments_path / name).mkdir()
+        write(segments_path / name)
+        with _locked(segments_path / LOCK_FILE):
+            # Segments ingested meanwhile were appended after ``names``.
+            current = read_manifest(segments_path)
+            _write_manifest(segments_path, [name] + current[len(names):])
+
+    # Searches which loaded the merged segments keep them memory-mapped,
+    # hence removing their files does not affect them.
+    for old_name in names:
+        shutil.rmtree(segments_path / old_name, ignore_errors=True)
+    print(f'[INFO] Merged {len(names)} segments into {name}.')
+    return name
+
+
+def merge_in_background(segments_path=None, threshold=MERGE_THRESHOLD):
+    """Merges segments (see :method: ``merge_segments``) in a daemon thread.
+
+    Returns:
+    --------
+        thread (threading.Thread):
+            Thread merging the segments.
+    """
+    thread = threading.Thread(
+        target=merge_segments,
+        args=(Path(segments_path or default_path()), threshold),
+        name='rubrix-merge', daemon=True)
+    thread.start()
+    return thread
+
+
+def _load(segment_path):
+    if not (segment_path / CATALOG_FILE).is_file():
+        raise FileNotFoundError(f'Segment {segment_path} is incomplete.')
+    return IndexStore.load(segment_path)
+
+
+def _next_name(segments_path):
+    # Names are increasing, and never reused.
+    numbers = [int(path.name.split('-')[1])
+               for path in segments_path.glob('segment-*')]
+    return f'segment-{max(numbers, default=0) + 1:06d}'
+
+
+def _write_manifest(segments_path, names):
+    temporary_path = segments_path / (MANIFEST_FILE + '.tmp')
+    with open(temporary_path, 'w') as manifest_file:
+        json.dump({'segments': names}, manifest_file, indent=4)
+    temporary_path.replace(segments_path / MANIFEST_FILE)
+
+
+def _stamp(path):
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_ino
+
+
+@contextmanager
+def _locked(path):
+    # Locks are held across processes, e.g. an ingestion from the command
+    # line while the web server merges segments.
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
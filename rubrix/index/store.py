@@ -0,0 +1,1007 @@
+"""Consolidates the inverse-image index, the caption embeddings and the image
+descriptors into a read-only store, which is shared by all the queries made
+to a process.
+
+The per-caption and per-image .npy files are stacked into two matrices,
+``embeddings.npy`` and ``descriptors.npy``, which are memory-mapped when the
+store is loaded. Image paths, object postings and the embedding rows of each
+image are kept in a binary catalog, ``catalog.bin`` (see
+:mod: ``rubrix.index.catalog``). When the store is loaded before the web server forks its
+workers, all workers share the same physical pages, instead of each parsing
+the JSON indexes and loading the .npy files by itself.
+
+Each build writes a new, immutable snapshot of the store, in
+``assets/store/snapshots/<version>``, along with a manifest of its files.
+The snapshot is then published by atomically replacing the ``CURRENT``
+file, which names the snapshot to load. A server never sees a half-written
+store: it keeps serving the snapshot it loaded, and :method:
+``watch_snapshots`` loads and warms a newly published snapshot in the
+background before swapping it in. Queries in flight finish on the previous
+snapshot, whose memory mappings are released once no query uses them.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from rubrix import metrics, pathfinder
+from rubrix.index import bitmap, planner
+from rubrix.index.ann import IVFIndex, build_ivf
+from rubrix.index.bounds import CaptionBounds, build_bounds
+from rubrix.index.aggregate import (CaptionAggregates, build_aggregates,
+                                    evaluate_aggregates)
+from rubrix.index.catalog import (Catalog, ImageTable, build_sections,
+                                  relative_path, write_catalog)
+from rubrix.index.download import captions_paths as default_captions_paths
+from rubrix.index.lexical import LexicalIndex, build_lexicon, read_captions
+
+
+logger = logging.getLogger('rubrix.store')
+
+# Files making up the store, within a snapshot directory.
+CATALOG_FILE = 'catalog.bin'
+EMBEDDINGS_FILE = 'embeddings.npy'
+DESCRIPTORS_FILE = 'descriptors.npy'
+MANIFEST_FILE = 'manifest.json'
+
+# Snapshots directory, and file naming the current snapshot, within
+# ``assets/store``.
+SNAPSHOTS_DIR = 'snapshots'
+CURRENT_FILE = 'CURRENT'
+
+# Number of snapshots kept on disk, including the current one.
+KEEP_SNAPSHOTS = int(os.environ.get('RUBRIX_KEEP_SNAPSHOTS', 3))
+
+# Interval (in seconds) at which servers check for a new snapshot.
+SNAPSHOT_POLL_SECONDS = float(os.environ.get('RUBRIX_SNAPSHOT_POLL', 5.0))
+
+# Number of snapshots swapped in by running servers.
+SNAPSHOT_SWAPS = metrics.register(metrics.Counter(
+    'rubrix_snapshot_swaps_total',
+    'Number of store snapshots swapped in by a running server.'))
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class IndexStore:
+    """Read-only view over the consolidated index.
+
+    Images are identified by integer IDs, which are positions in
+    :attr: ``images``. The caption embeddings of image ``i`` are the rows
+    ``offsets[i]:offsets[i + 1]`` of :attr: ``embeddings``, and its image
+    descriptor is row ``i`` of :attr: ``descriptors``.
+    """
+    def __init__(self, images, offsets, postings, embeddings, descriptors,
+                 cardinalities=None, rankings=None, ivf=None, bounds=None,
+                 aggregates=None, lexicon=None):
+        """Initializes :class: ``IndexStore``.
+
+        Arguments:
+        ----------
+            images (rubrix.index.catalog.ImageTable):
+                Paths to images, indexed by image ID.
+            offsets (numpy.ndarray):
+                Start row of the caption embeddings of each image, followed
+                by the total number of caption embeddings.
+            postings (dict):
+                Mapping from object label to the set of images containing
+                the object (:class: ``rubrix.index.bitmap.Bitmap``).
+            embeddings (numpy.ndarray):
+                Caption embeddings, one row per caption.
+            descriptors (numpy.ndarray):
+                Image descriptors, one row per image.
+            cardinalities (dict):
+                Mapping from object label to size of its posting list.
+                Computed from ``postings`` if not given.
+            rankings (dict):
+                Mapping from object label to a tuple of image IDs in
+                decreasing order of detection confidence, and the confidence
+                and area of each detection. Labels without a ranking are
+                ranked by image ID.
+            ivf (rubrix.index.ann.IVFIndex):
+                IVF index over the caption embeddings, for approximate
+                searches. If None, searches are always exact.
+            bounds (rubrix.index.bounds.CaptionBounds):
+                Upper bounds on the caption scores of each image, for
+                searches which stop early. If None, every candidate is
+                scored.
+            aggregates (rubrix.index.aggregate.CaptionAggregates):
+                Aggregated caption embeddings of each image. If given, text
+                searches score these instead of the caption embeddings.
+            lexicon (rubrix.index.lexical.LexicalIndex):
+                BM25 index over the caption text of each image, for finding
+                candidates by query terms. If None, query terms are ignored.
+        """
+        self.images = images
+        self.offsets = offsets
+        self.postings = postings
+        self.cardinalities = cardinalities if cardinalities is not None else \
+            {label: posting.cardinality()
+             for label, posting in postings.items()}
+        self.rankings = rankings or {}
+        self.embeddings = embeddings
+        self.descriptors = descriptors
+        self.ivf = ivf
+        self.bounds = bounds
+        self.aggregates = aggregates
+        self.lexicon = lexicon
+        # Directory the store was loaded from, if any.
+        self.directory = None
+
+    def __len__(self):
+        return len(self.images)
+
+    @classmethod
+    def load(cls, store_path, mmap=True):
+        """Loads the store from ``store_path``.
+
+        Arguments:
+        ----------
+            store_path (pathlib.Path):
+                Path to store directory, i.e., a snapshot directory, or a
+                directory with a ``CURRENT`` file, whose current snapshot
+                is loaded.
+            mmap (bool):
+                If True, the embeddings and descriptors are memory-mapped
+                read-only, rather than read into memory.
+
+        Returns:
+        --------
+            store (IndexStore):
+                Loaded store.
+        """
+        mmap_mode = 'r' if mmap else None
+        store_path = snapshot_path(store_path)
+        verify_snapshot(store_path)
+
+        catalog = Catalog.load(store_path / CATALOG_FILE)
+        store = cls(
+            images=ImageTable(catalog),
+            offsets=catalog.offsets,
+            postings={label: catalog.postings(label)
+                      for label in catalog.labels},
+            cardinalities={label: catalog.cardinality(label)
+                           for label in catalog.labels},
+            rankings={label: catalog.ranked(label)
+                      for label in catalog.labels},
+            embeddings=np.load(store_path / EMBEDDINGS_FILE,
+                               mmap_mode=mmap_mode),
+            descriptors=np.load(store_path / DESCRIPTORS_FILE,
+                                mmap_mode=mmap_mode),
+            ivf=IVFIndex.load(store_path, mmap),
+            bounds=CaptionBounds.load(store_path, mmap),
+            aggregates=CaptionAggregates.load(store_path, mmap),
+            lexicon=LexicalIndex.load(store_path),
+        )
+        store.directory = store_path
+        return store
+
+    def path(self, image_id):
+        return self.images[image_id]
+
+    def relative_path(self, image_id):
+        return self.images.relative(image_id)
+
+    def cardinality(self, label):
+        """Returns the number of images containing object ``label``.
+        """
+        return self.cardinalities[label]
+
+    def ranked(self, label):
+        """Returns the IDs of images containing object ``label``, in
+        decreasing order of detection confidence.
+        """
+        if label in self.rankings:
+            return self.rankings[label][0]
+        return self.postings[label].to_ids()
+
+    def posting(self, label, budget=None):
+        """Returns the set of images containing object ``label``, limited to
+        the ``budget`` images in which it was detected most confidently.
+
+        Arguments:
+        ----------
+            label (str):
+                Object label.
+            budget (int or None):
+                Maximum number of images. If None, all images containing
+                the object are returned.
+
+        Returns:
+        --------
+            (rubrix.index.bitmap.Bitmap):
+                Posting list of the object.
+        """
+        if budget is None or self.cardinality(label) <= budget:
+            return self.postings[label]
+        return bitmap.Bitmap.from_ids(self.ranked(label)[:budget], len(self))
+
+    def estimate_candidates(self, labels, mode='or', budget=None,
+                            terms=None):
+        """Estimates the number of candidate images for ``labels`` from the
+        cardinalities of their posting lists, without combining them.
+
+        Arguments:
+        ----------
+            labels (list):
+                Object labels, or groups of labels (see :method:
+                ``candidates``).
+            mode (str):
+                Either 'or' or 'and'.
+            budget (int or None):
+                Maximum number of images per label (see :method:
+                ``candidates``).
+            terms (list or None):
+                Query terms (see :method: ``candidates``).
+
+        Returns:
+        --------
+            (int):
+                Upper bound on the number of candidate images.
+        """
+        matches = 0
+        if self.lexicon is not None and terms:
+            matches = self.lexicon.estimate_candidates(terms)
+            if labels is None:
+                return matches
+        if labels is None:
+            return len(self)
+        limit = len(self) if budget is None else budget
+        groups = [min(len(self), sum(min(limit, self.cardinality(label))
+                                     for label in _as_group(group)))
+                  for group in labels]
+        if not groups:
+            estimate = 0 if mode == 'or' else len(self)
+        elif mode == 'and':
+            estimate = min(groups)
+        else:
+            estimate = sum(groups)
+        return min(len(self), estimate + matches)
+
+    def candidates(self, labels, start=0, stop=None, mode='or',
+                   budget=None, terms=None):
+        """Returns the IDs of images containing the objects in ``labels``,
+        restricted to image IDs in ``[start, stop)``.
+
+        Arguments:
+        ----------
+            labels (list or None):
+                Object labels, or groups of alternative labels (e.g. the
+                labels similar to a query noun). If None, all images are
+                candidates.
+            start (int):
+                Smallest image ID to consider.
+            stop (int):
+                Image IDs to consider are smaller than this. Defaults to
+                number of images in the store.
+            mode (str):
+                If 'or', images containing any of the labels are candidates.
+                If 'and', only images containing a label of every group are
+                candidates.
+            budget (int or None):
+                If given, only the ``budget`` images in which each label was
+                detected most confidently are candidates, which bounds the
+                number of images to score for common objects. The budget
+                applies to the whole store, before restricting image IDs to
+                ``[start, stop)``.
+            terms (list or None):
+                Query terms, as returned by :method:
+                ``rubrix.index.lexical.tokenize``. If given, the images whose
+                captions best match the terms (by BM25 score over the whole
+                store) are candidates too, or the only candidates if
+                ``labels`` is None. Ignored if the store has no lexicon.
+
+        Returns:
+        --------
+            ids (numpy.ndarray):
+                Sorted array of image IDs.
+        """
+        stop = len(self) if stop is None else stop
+        if self.is_unfiltered(labels, terms):
+            return np.arange(start, stop, dtype=np.int32)
+        return self._combine(labels, mode, budget, terms).to_ids(start, stop)
+
+    def candidate_mask(self, labels, start=0, stop=None, mode='or',
+                       budget=None, terms=None):
+        """Returns a boolean mask over image IDs in ``[start, stop)``, which
+        is True for the candidate images (see :method: ``candidates``).
+        """
+        stop = len(self) if stop is None else stop
+        if self.is_unfiltered(labels, terms):
+            return np.ones(stop - start, dtype=bool)
+        return self._combine(labels, mode, budget, terms).to_mask(start, stop)
+
+    def is_unfiltered(self, labels, terms=None):
+        """Returns True if all images are candidates for ``labels`` and
+        ``terms``.
+        """
+        return labels is None and (self.lexicon is None or not terms)
+
+    def _combine(self, labels, mode, budget, terms=None):
+        combined = bitmap.Bitmap.empty(len(self))
+        if labels is not None:
+            groups = [bitmap.union([self.posting(label, budget)
+                                    for label in _as_group(group)], len(self))
+                      for group in labels]
+            if mode == 'and':
+                combined = bitmap.intersection(groups, len(self))
+            else:
+                combined = bitmap.union(groups, len(self))
+        if self.lexicon is not None and terms:
+            combined = combined | bitmap.Bitmap.from_ids(
+                self.lexicon.candidates(terms), len(self))
+        return combined
+
+    def search_captions(self, array, labels, k, start=0, stop=None,
+                        mode='or', budget=None, terms=None):
+        """Retrieves the ``k`` images among those containing ``labels``,
+        whose captions best match sentence embedding ``array``.
+
+        The search strategy is chosen by :method:
+        ``rubrix.index.planner.plan_search``. With ``RUBRIX_APPROXIMATE=1``,
+        large candidate sets may be searched approximately, over the IVF
+        index of the store.
+
+        Arguments:
+        ----------
+            array (numpy.ndarray):
+                Sentence embedding of the query.
+            labels (list or None):
+                Object labels, or groups of labels (see :method:
+                ``candidates``). If None, all images are candidates.
+            k (int):
+                Number of images to retrieve.
+            start, stop (int):
+                Range of image IDs to search.
+            mode (str):
+                Either 'or' or 'and' (see :method: ``candidates``).
+            budget (int or None):
+                Maximum number of images to score per label (see :method:
+                ``candidates``).
+            terms (list or None):
+                Query terms, whose best matching images by BM25 score are
+                candidates too (see :method: ``candidates``).
+
+        Returns:
+        --------
+            (list of tuples):
+                (image ID, score) pairs, in decreasing order of score.
+        """
+        plan = planner.plan_search(self, 'captions', labels, k, start, stop,
+                                   mode, budget, terms)
+        return top_k(*planner.execute(self, plan, array), k)
+
+    def search_descriptors(self, array, labels, k, start=0, stop=None,
+                           mode='or', budget=None, terms=None):
+        """Retrieves the ``k`` images among those containing ``labels``,
+        whose image descriptors best match ``array``.
+
+        The search strategy is chosen by :method:
+        ``rubrix.index.planner.plan_search``.
+
+        Arguments:
+        ----------
+            array (numpy.ndarray):
+                Image descriptor of the query image.
+            labels (list or None):
+                Object labels, or groups of labels (see :method:
+                ``candidates``). If None, all images are candidates.
+            k (int):
+                Number of images to retrieve.
+            start, stop (int):
+                Range of image IDs to search.
+            mode (str):
+                Either 'or' or 'and' (see :method: ``candidates``).
+            budget (int or None):
+                Maximum number of images to score per label (see :method:
+                ``candidates``).
+            terms (list or None):
+                Query terms, whose best matching images by BM25 score are
+                candidates too (see :method: ``candidates``).
+
+        Returns:
+        --------
+            (list of tuples):
+                (image ID, score) pairs, in decreasing order of score.
+        """
+        plan = planner.plan_search(self, 'descriptors', labels, k, start,
+                                   stop, mode, budget, terms)
+        return top_k(*planner.execute(self, plan, array), k)
+
+    def score_captions(self, array, ids):
+        """Scores images ``ids`` by the maximum dot product of ``array`` with
+        the embeddings of their captions.
+
+        Arguments:
+        ----------
+            array (numpy.ndarray):
+                Sentence embedding of the query.
+            ids (numpy.ndarray):
+                Sorted image IDs.
+
+        Returns:
+        --------
+            scores (numpy.ndarray):
+                Score of each image in ``ids``.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.float32)
+
+        starts, stops = self.offsets[ids], self.offsets[ids + 1]
+        counts = stops - starts
+        # Images without captions can never be retrieved by text.
+        scores = np.full(len(ids), -np.inf, dtype=np.float32)
+        captioned = counts > 0
+        starts, counts = starts[captioned], counts[captioned]
+        if len(counts) == 0:
+            return scores
+
+        positions = np.cumsum(counts) - counts
+        if starts[-1] - starts[0] == positions[-1]:
+            # Captions of the candidate images are contiguous (e.g. a scan
+            # over a shard), and slicing avoids copying them.
+            rows = slice(starts[0], starts[0] + counts.sum())
+        else:
+            # Row numbers of all caption embeddings of the candidate
+            # images, laid out image after image.
+            rows = np.repeat(starts - positions, counts) + \
+                np.arange(counts.sum())
+        caption_scores = self.embeddings[rows] @ array
+        scores[captioned] = np.maximum.reduceat(caption_scores, positions)
+        return scores
+
+    def score_descriptors(self, array, ids):
+        """Scores images ``ids`` by the dot product of ``array`` with their
+        image descriptors.
+
+        Arguments:
+        ----------
+            array (numpy.ndarray):
+                Image descriptor of the query image.
+            ids (numpy.ndarray):
+                Sorted image IDs.
+
+        Returns:
+        --------
+            scores (numpy.ndarray):
+                Score of each image in ``ids``.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.float32)
+        if ids[-1] - ids[0] == len(ids) - 1:
+            # Slicing contiguous rows avoids copying them.
+            return self.descriptors[ids[0]:ids[-1] + 1] @ array
+        return self.descriptors[ids] @ array
+
+
+def _as_group(group):
+    return [group] if isinstance(group, str) else group
+
+
+def top_k(ids, scores, k):
+    """Selects the ``k`` highest scoring images.
+
+    Arguments:
+    ----------
+        ids (numpy.ndarray):
+            Image IDs.
+        scores (numpy.ndarray):
+            Score of each image in ``ids``.
+        k (int):
+            Number of images to select.
+
+    Returns:
+    --------
+        (list of tuples):
+            (image ID, score) pairs, in decreasing order of score.
+    """
+    if len(ids) > k:
+        # Partial sort is O(n), as opposed to O(n * log(n)) for a full sort.
+        selected = np.argpartition(-scores, k - 1)[:k]
+    else:
+        selected = np.arange(len(ids))
+    selected = selected[np.argsort(-scores[selected], kind='stable')]
+    return [(int(ids[i]), float(scores[i])) for i in selected]
+
+
+def build_store(index_path, embeddings_path, descriptors_path, store_path,
+                scores_path=None, aggregate=None, n_prototypes=1, rerank=0,
+                captions_paths=None):
+    """Consolidates the JSON indexes and .npy files into a store.
+
+    Arguments:
+    ----------
+        index_path (pathlib.Path):
+            Path to inverse image index file (``index.json``).
+        embeddings_path (pathlib.Path):
+            Path to image embeddings index file
+            (``imageEmbeddingLocations.json``).
+        descriptors_path (pathlib.Path):
+            Path to directory containing image descriptor .npy files.
+        store_path (pathlib.Path):
+            Path to store directory. The store is written to a new snapshot
+            within it, which is then published as the current snapshot.
+        scores_path (pathlib.Path):
+            Path to object detection scores file (``objectScores.json``).
+            Defaults to the file next to ``index_path``. If the file does
+            not exist, posting lists are ranked by image ID.
+        aggregate (str):
+            If given, either 'mean' or 'normalized', and text searches score
+            one aggregated vector per image (see :mod:
+            ``rubrix.index.aggregate``) instead of every caption.
+        n_prototypes (int):
+            Number of aggregated vectors per image.
+        rerank (int):
+            Number of best images by aggregated score to rescore against
+            their captions.
+        captions_paths (list of pathlib.Path):
+            Paths to captions files (as written by :method:
+            ``rubrix.index.download.txt_to_json`` or :method:
+            ``rubrix.index.download.prepare_streaming``), to build the
+            lexical index from. Defaults to the train and validation
+            captions. If
+            none of the files exist, the store has no lexical index.
+
+    Returns:
+    --------
+        snapshot_path (pathlib.Path):
+            Path to the new snapshot directory.
+
+    Raises:
+    -------
+        ValueError:
+            If there are no images, caption embeddings or image descriptors
+            to build the store from. No snapshot is created then.
+    """
+    with open(index_path, 'r') as index_file:
+        index = json.load(index_file)
+    if scores_path is None:
+        scores_path = Path(index_path).with_name('objectScores.json')
+    scores = {}
+    if Path(scores_path).is_file():
+        with open(scores_path, 'r') as scores_file:
+            scores = json.load(scores_file)
+    with open(embeddings_path, 'r') as embeddings_file:
+        embeddings = json.load(embeddings_file)
+
+    # Images are ordered by name, so that the store is deterministic.
+    paths = {Path(path).name: path for paths in index.values()
+             for path in paths}
+    for name in embeddings:
+        if name not in paths:
+            for split in ['train', 'val']:
+                path = pathfinder.get('assets', 'data', split, name)
+                if path.is_file():
+                    paths[name] = str(path)
+    images = sorted(paths, key=lambda name: name)
+    ids = {name: _id for _id, name in enumerate(images)}
+    if not images:
+        raise ValueError(f'No images to build a store from in {index_path} '
+                         f'and {embeddings_path}.')
+
+    print('[INFO] Consolidating caption embeddings.')
+    offsets, rows = [0], []
+    root = pathfinder.get_root()
+    for name in images:
+        # Paths may be from another machine, hence they are resolved
+        # relative to the local main directory.
+        arrays = [np.load(root / relative_path(path))
+                  for path in embeddings.get(name, [])]
+        rows += arrays
+        offsets.append(offsets[-1] + len(arrays))
+    if not rows:
+        raise ValueError(f'No caption embeddings in {embeddings_path}.')
+    embeddings_matrix = np.stack(rows).astype(np.float32)
+
+    print('[INFO] Consolidating image descriptors.')
+    descriptors = []
+    for name in images:
+        path = Path(descriptors_path) / f'{Path(name).stem}.npy'
+        if path.is_file():
+            descriptors.append(np.load(path).reshape(-1))
+        else:
+            print(f'[WARNING] Missing image descriptor for {name}.')
+            descriptors.append(None)
+    if all(array is None for array in descriptors):
+        raise ValueError(f'No image descriptors in {descriptors_path}.')
+    dim = next(array.shape[0] for array in descriptors if array is not None)
+    descriptors_matrix = np.stack([
+        array if array is not None else np.zeros(dim)
+        for array in descriptors]).astype(np.float32)
+
+    objects = {label: sorted(ids[Path(path).name] for path in set(paths_))
+               for label, paths_ in index.items()}
+    rankings = {label: rank_postings([ids[Path(path).name] for path in paths_],
+                                     scores[label])
+                for label, paths_ in index.items() if label in scores}
+
+    # The snapshot is only published once complete, hence servers never
+    # load a partially written store.
+    root_path = Path(store_path)
+    store_path = new_snapshot(root_path)
+    np.save(store_path / EMBEDDINGS_FILE, embeddings_matrix)
+    np.save(store_path / DESCRIPTORS_FILE, descriptors_matrix)
+    print('[INFO] Clustering caption embeddings.')
+    build_ivf(embeddings_matrix).save(store_path)
+    build_bounds(embeddings_matrix, offsets).save(store_path)
+    # Paths are stored relative to the main directory, which makes the
+    # store independent of where ``rubrix`` is installed.
+    write_catalog(store_path / CATALOG_FILE, build_sections(
+        [relative_path(paths[name]) for name in images], offsets, objects,
+        rankings))
+
+    if captions_paths is None:
+        captions_paths = default_captions_paths()
+    captions = read_captions(captions_paths)
+    if captions:
+        print('[INFO] Indexing caption text.')
+        build_lexicon(images, captions).save(store_path)
+
+    if aggregate is not None:
+        print('[INFO] Aggregating caption embeddings.')
+        aggregates = build_aggregates(embeddings_matrix, offsets, aggregate,
+                                      n_prototypes, rerank)
+        aggregates.report = evaluate_aggregates(
+            IndexStore.load(store_path), aggregates)
+        aggregates.save(store_path)
+        print(f'[INFO] Aggregated caption accuracy: {aggregates.report}')
+
+    write_manifest(store_path, n_images=len(images),
+                   n_captions=int(offsets[-1]))
+    publish_snapshot(root_path, store_path.name)
+    print(f'[INFO] Store creation successful, published snapshot '
+          f'{store_path.name}.')
+    return store_path
+
+
+def snapshot_path(store_path):
+    """Returns the directory of the current snapshot of the store at
+    ``store_path``. Stores written before snapshots were introduced (or
+    snapshot directories themselves) have no ``CURRENT`` file, and are
+    their own snapshot.
+    """
+    store_path = Path(store_path)
+    current_path = store_path / CURRENT_FILE
+    if not current_path.is_file():
+        return store_path
+    with open(current_path, 'r') as current_file:
+        return store_path / SNAPSHOTS_DIR / current_file.read().strip()
+
+
+def has_store(store_path):
+    """Checks if a store was built at ``store_path``.
+    """
+    return (snapshot_path(store_path) / CATALOG_FILE).is_file()
+
+
+def new_snapshot(store_path):
+    """Creates an empty snapshot directory within ``store_path``. Snapshot
+    names sort in creation order.
+
+    Returns:
+    --------
+        snapshot_path (pathlib.Path):
+            Path to the new snapshot directory.
+    """
+    snapshots_path = Path(store_path) / SNAPSHOTS_DIR
+    snapshots_path.mkdir(parents=True, exist_ok=True)
+    name = time.strftime('%Y%m%d-%H%M%S')
+    attempt = 0
+    while True:
+        # Builds started within the same second are numbered.
+        snapshot = snapshots_path / (f'{name}-{attempt}' if attempt
+                                     else name)
+        try:
+            snapshot.mkdir()
+            return snapshot
+        except FileExistsError:
+            attempt += 1
+
+
+def write_manifest(snapshot, **info):
+    """Writes the manifest of ``snapshot``, listing the size of each of its
+    files, along with ``info``.
+    """
+    files = {path.name: path.stat().st_size
+             for path in sorted(Path(snapshot).iterdir())
+             if path.is_file() and path.name != MANIFEST_FILE}
+    with open(Path(snapshot) / MANIFEST_FILE, 'w') as manifest_file:
+        json.dump({'version': Path(snapshot).name, 'created': time.time(),
+                   'files': files, **info}, manifest_file, indent=2)
+
+
+def verify_snapshot(snapshot):
+    """Checks that the files of ``snapshot`` are those listed in its
+    manifest, if it has one.
+
+    Raises:
+    -------
+        ValueError:
+            If a file is missing, or its size differs from the manifest.
+    """
+    manifest_path = Path(snapshot) / MANIFEST_FILE
+    if not manifest_path.is_file():
+        return
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    for name, size in manifest['files'].items():
+        path = Path(snapshot) / name
+        if not path.is_file() or path.stat().st_size != size:
+            raise ValueError(f'Snapshot {snapshot} is incomplete: {name} '
+                             f'does not match its manifest.')
+
+
+def publish_snapshot(store_path, name, keep=KEEP_SNAPSHOTS):
+    """Atomically makes snapshot ``name`` the current snapshot of the store
+    at ``store_path``, and removes all but the ``keep`` latest snapshots.
+    Servers which still map a removed snapshot keep reading it until they
+    release it.
+    """
+    store_path = Path(store_path)
+    temporary_path = store_path / (CURRENT_FILE + '.tmp')
+    with open(temporary_path, 'w') as current_file:
+        current_file.write(name)
+        current_file.flush()
+        os.fsync(current_file.fileno())
+    temporary_path.replace(store_path / CURRENT_FILE)
+
+    snapshots = sorted(path for path in (store_path / SNAPSHOTS_DIR).iterdir()
+                       if path.is_dir() and path.name != name)
+    for path in snapshots[:max(0, len(snapshots) - (keep - 1))]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def rank_postings(ids, scores):
+    """Ranks the images of an object by decreasing detection confidence,
+    and then by decreasing bounding box area.
+
+    Arguments:
+    ----------
+        ids (list):
+            Image IDs, possibly repeated.
+        scores (list):
+            (confidence, area) pair for each image ID in ``ids``.
+
+    Returns:
+    --------
+        ids, confidences, areas (tuple of numpy.ndarray):
+            Distinct image IDs in ranked order, and the highest confidence
+            and largest area of the object in each image.
+    """
+    best = {}
+    for _id, (confidence, area) in zip(ids, scores):
+        previous_confidence, previous_area = best.get(_id, (-1.0, -1.0))
+        best[_id] = (max(confidence, previous_confidence),
+                     max(area, previous_area))
+    ranked = sorted(best, key=lambda _id: (-best[_id][0], -best[_id][1], _id))
+    return (np.asarray(ranked, dtype=np.int32),
+            np.asarray([best[_id][0] for _id in ranked], dtype=np.float32),
+            np.asarray([best[_id][1] for _id in ranked], dtype=np.float32))
+
+
+def partition_store(store_path, partitions_path, n_shards):
+    """Partitions the store at ``store_path`` into ``n_shards`` stores, each
+    holding a contiguous range of images, their captions embeddings,
+    descriptors and postings. Shard ``i`` is written to
+    ``partitions_path/shard-i``, and can be served by a shard server on a
+    separate machine (see :mod: ``rubrix.web.shard``).
+
+    Arguments:
+    ----------
+        store_path (pathlib.Path):
+            Path to store directory.
+        partitions_path (pathlib.Path):
+            Path to directory to write shard stores to.
+        n_shards (int):
+            Number of shards.
+
+    Returns:
+    --------
+        shard_paths (list):
+            Paths to shard store directories.
+    """
+    store = IndexStore.load(Path(store_path))
+    bounds = np.linspace(0, len(store), n_shards + 1).astype(int)
+
+    shard_paths = []
+    for shard, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        shard_path = Path(partitions_path) / f'shard-{shard}'
+        shard_path.mkdir(parents=True, exist_ok=True)
+
+        offsets = store.offsets[start:stop + 1]
+        embeddings = store.embeddings[offsets[0]:offsets[-1]]
+        np.save(shard_path / EMBEDDINGS_FILE, embeddings)
+        build_ivf(embeddings).save(shard_path)
+        if store.bounds is not None:
+            store.bounds.slice(start, stop).save(shard_path)
+        if store.aggregates is not None:
+            store.aggregates.slice(start, stop).save(shard_path)
+        if store.lexicon is not None:
+            store.lexicon.slice(start, stop).save(shard_path)
+        np.save(shard_path / DESCRIPTORS_FILE, store.descriptors[start:stop])
+        write_catalog(shard_path / CATALOG_FILE, build_sections(
+            [store.relative_path(image_id) for image_id in range(start, stop)],
+            offsets - offsets[0],
+            {label: store.candidates([label], start, stop) - start
+             for label in store.postings},
+            {label: _restrict(ranking, start, stop)
+             for label, ranking in store.rankings.items()}))
+        shard_paths.append(shard_path)
+
+    print(f'[INFO] Partitioned store into {n_shards} shards.')
+    return shard_paths
+
+
+def _restrict(ranking, start, stop):
+    # Rankings of a shard hold its own images, with shard-local IDs.
+    ids, confidences, areas = ranking
+    inside = (ids >= start) & (ids < stop)
+    return ids[inside] - start, confidences[inside], areas[inside]
+
+
+def default_paths():
+    """Returns default locations of the JSON indexes, descriptors and store.
+    """
+    return (pathfinder.get('assets', 'index.json'),
+            pathfinder.get('assets', 'imageEmbeddingLocations.json'),
+            pathfinder.get('assets', 'data', 'descriptors'),
+            pathfinder.get('assets', 'store'))
+
+
+def get_store():
+    """Returns the store shared by all queries made to this process. The
+    store is loaded on first use, and built from the JSON indexes if it does
+    not exist yet.
+
+    Returns:
+    --------
+        store (IndexStore):
+            Shared store.
+    """
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                *sources, store_path = default_paths()
+                if not has_store(store_path):
+                    build_store(*sources, store_path)
+                with metrics.span('load_store'):
+                    _store = IndexStore.load(store_path)
+    return _store
+
+
+def warm(store):
+    """Reads the memory-mapped matrices of ``store`` once, so that their
+    pages are in the page cache before the store serves queries.
+    """
+    for matrix in [store.embeddings, store.descriptors]:
+        # Touching one value per page faults in the whole matrix.
+        step = max(1, 4096 // matrix.itemsize)
+        matrix.reshape(-1)[::step].sum()
+
+
+def preload():
+    """Loads the shared store, and warms it before workers are forked.
+
+    Returns:
+    --------
+        store (IndexStore):
+            Shared store.
+    """
+    store = get_store()
+    warm(store)
+    return store
+
+
+def reload_store():
+    """Swaps in the current snapshot of the store shared by this process,
+    if another snapshot was published since it was loaded. The snapshot is
+    loaded and warmed before it is swapped in, and queries holding the
+    previous store finish on it.
+
+    Returns:
+    --------
+        store (IndexStore or None):
+            Newly loaded store, or None if the store is current (or was not
+            loaded yet).
+    """
+    global _store
+
+    store_path = default_paths()[-1]
+    if _store is None or \
+            _store.directory == snapshot_path(store_path):
+        return None
+    with metrics.span('load_store'):
+        store = IndexStore.load(store_path)
+    warm(store)
+    with _store_lock:
+        _store = store
+    SNAPSHOT_SWAPS.inc()
+    logger.info(f'Swapped in store snapshot {store.directory.name}.')
+    return store
+
+
+def watch_snapshots(callback=None, interval=SNAPSHOT_POLL_SECONDS):
+    """Starts a background thread, which checks for a new snapshot every
+    ``interval`` seconds, and swaps it in with :method: ``reload_store``.
+
+    Arguments:
+    ----------
+        callback (callable):
+            Function called with each store swapped in, e.g. to rebuild
+            the indexes wrapping the store.
+        interval (float):
+            Time (in seconds) between checks.
+
+    Returns:
+    --------
+        thread (threading.Thread):
+            Watcher thread.
+    """
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                store = reload_store()
+            except Exception as e:
+                # The previous snapshot is served until a valid one is
+                # published.
+                logger.warning(f'Unable to load store snapshot: {e}')
+                continue
+            if store is not None and callback is not None:
+                callback(store)
+
+    thread = threading.Thread(target=watch, name='rubrix-snapshots',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Consolidate indexes into '
+                                                 'a memory-mapped store.')
+    parser.add_argument('--index', dest='index_path', type=str,
+                        help='Path to inverse image index file.')
+    parser.add_argument('--embeddings', dest='embeddings_path', type=str,
+                        help='Path to image embeddings index file.')
+    parser.add_argument('--descriptors', dest='descriptors_path', type=str,
+                        help='Path to image descriptors directory.')
+    parser.add_argument('--store', dest='store_path', type=str,
+                        help='Path to store directory.')
+    parser.add_argument('--aggregate', dest='aggregate', type=str,
+                        choices=['mean', 'normalized'],
+                        help='Score one aggregated vector per image, rather '
+                             'than every caption, in text searches.')
+    parser.add_argument('--prototypes', dest='n_prototypes', type=int,
+                        default=1, help='Number of aggregated vectors per '
+                                        'image.')
+    parser.add_argument('--rerank', dest='rerank', type=int, default=0,
+                        help='Number of best images by aggregated score to '
+                             'rescore against their captions.')
+    parser.add_argument('--partition', dest='n_shards', type=int,
+                        help='Partition the store into this many shards, '
+                             'written to the ``shards`` directory next to '
+                             'the store.')
+    args = parser.parse_args()
+
+    defaults = default_paths()
+    paths = [Path(arg) if arg is not None else default
+             for arg, default in zip([args.index_path, args.embeddings_path,
+                                      args.descriptors_path, args.store_path],
+                                     defaults)]
+    # Partitioning reuses an existing store, rather than rebuilding it.
+    if not args.n_shards or not has_store(paths[-1]):
+        build_store(*paths, aggregate=args.aggregate,
+                    n_prototypes=args.n_prototypes, rerank=args.rerank)
+    if args.n_shards:
+        partition_store(paths[-1], paths[-1].parent / 'shards', args.n_shards)
@@ -0,0 +1,368 @@
+"""Lightweight instrumentation for the query processing pipeline.
+
+Stages of the pipeline are wrapped in timing spans, which feed Prometheus
+style histograms. These are rendered in the Prometheus text exposition
+format by :method: ``render`` and served at the ``/metrics`` endpoint of the
+web application.
+
+Every query runs within a trace, which records the per-stage breakdown of
+the query. Queries taking longer than ``SLOW_QUERY_SECONDS`` are written to
+the ``rubrix.slowquery`` logger along with this breakdown.
+"""
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+
+# Queries slower than this (in seconds) are written to the slow-query log.
+SLOW_QUERY_SECONDS = float(os.environ.get('RUBRIX_SLOW_QUERY_SECONDS', 2.0))
+
+# Upper bounds (in seconds) of the histogram buckets. Spans range from
+# sub-millisecond lookups to multi-second model loads.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+slow_query_logger = logging.getLogger('rubrix.slowquery')
+
+_local = threading.local()
+
+
+class Histogram:
+    """Cumulative histogram of observed values, rendered as a Prometheus
+    histogram. Observations are guarded by a lock, so that a histogram can
+    be shared by all the threads serving requests.
+    """
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        """Initializes :class: ``Histogram``.
+
+        Arguments:
+        ----------
+            name (str):
+                Metric name.
+            help_text (str):
+                Description of the metric.
+            buckets (tuple):
+                Sorted upper bounds of the histogram buckets.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Records ``value`` in the series identified by ``labels``.
+
+        Arguments:
+        ----------
+            value (float):
+                Observed value.
+            **labels:
+                Label names and values of the series.
+        """
+        key = tuple(sorted(labels.items()))
+        position = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[key] = series
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def quantile(self, q, **labels):
+        """Estimates quantile ``q`` of the series identified by ``labels``,
+        as the upper bound of the bucket holding it.
+
+        Arguments:
+        ----------
+            q (float):
+                Quantile, between 0 and 1.
+            **labels:
+                Label names and values of the series.
+
+        Returns:
+        --------
+            (float or None):
+                Estimated quantile, or None if nothing was observed.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return None
+            counts, _, count = list(series[0]), series[1], series[2]
+
+        rank, cumulative = q * count, 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                       counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        """Renders the histogram in Prometheus text exposition format.
+
+        Returns:
+        --------
+            lines (list):
+                Lines of the exposition.
+        """
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} histogram']
+
+        with self._lock:
+            series = [(key, list(counts), total, count)
+                      for key, (counts, total, count) in self._series.items()]
+
+        for key, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = _format_labels(key + (('le', str(bound)),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+
+        return lines
+
+
+class Counter:
+    """Monotonically increasing counter, rendered as a Prometheus counter.
+    """
+    def __init__(self, name, help_text):
+        """Initializes :class: ``Counter``.
+
+        Arguments:
+        ----------
+            name (str):
+                Metric name.
+            help_text (str):
+                Description of the metric.
+        """
+        self.name = name
+        self.help_text = help_text
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Increments the series identified by ``labels`` by ``amount``.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self):
+        """Renders the counter in Prometheus text exposition format.
+        """
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} counter']
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Gauge:
+    """Value which can go up and down, rendered as a Prometheus gauge.
+    """
+    def __init__(self, name, help_text):
+        """Initializes :class: ``Gauge``.
+
+        Arguments:
+        ----------
+            name (str):
+                Metric name.
+            help_text (str):
+                Description of the metric.
+        """
+        self.name = name
+        self.help_text = help_text
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        """Sets the series identified by ``labels`` to ``value``.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = value
+
+    def inc(self, amount=1, **labels):
+        """Increments the series identified by ``labels`` by ``amount``.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Decrements the series identified by ``labels`` by ``amount``.
+        """
+        self.inc(-amount, **labels)
+
+    def render(self):
+        """Renders the gauge in Prometheus text exposition format.
+        """
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} gauge']
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class QueryTrace:
+    """Per-stage breakdown of a single query.
+    """
+    def __init__(self, kind, query=None):
+        """Initializes :class: ``QueryTrace``.
+
+        Arguments:
+        ----------
+            kind (str):
+                Type of query, i.e., 'text' or 'image'.
+            query (str):
+                Description of the query, written to the slow-query log.
+        """
+        self.kind = kind
+        self.query = query
+        self.stages = []
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def add(self, stage, duration):
+        self.stages.append((stage, duration))
+
+    def breakdown(self):
+        """Returns the time spent per stage, summed over repeated stages.
+        """
+        breakdown = {}
+        for stage, duration in self.stages:
+            breakdown[stage] = breakdown.get(stage, 0.0) + duration
+        return breakdown
+
+
+# Time spent in each stage of the query pipeline.
+STAGE_SECONDS = Histogram('rubrix_stage_seconds',
+                          'Time spent in each stage of the query pipeline.')
+
+# End-to-end time spent on each query.
+QUERY_SECONDS = Histogram('rubrix_query_seconds',
+                          'End-to-end query latency.')
+
+# Number of queries which exceeded ``SLOW_QUERY_SECONDS``.
+SLOW_QUERIES = Counter('rubrix_slow_queries_total',
+                       'Number of queries slower than the slow-query '
+                       'threshold.')
+
+REGISTRY = [STAGE_SECONDS, QUERY_SECONDS, SLOW_QUERIES]
+
+
+def register(metric):
+    """Adds ``metric`` to the metrics rendered at the ``/metrics`` endpoint.
+
+    Arguments:
+    ----------
+        metric (Histogram, Counter or Gauge):
+            Metric to expose.
+
+    Returns:
+    --------
+        metric (Histogram, Counter or Gauge):
+            The registered metric.
+    """
+    REGISTRY.append(metric)
+    return metric
+
+
+def current_trace():
+    """Returns the trace of the query running in this thread, if any.
+    """
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def span(stage):
+    """Times the enclosed block as stage ``stage`` of the pipeline.
+
+    Arguments:
+    ----------
+        stage (str):
+            Name of pipeline stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=stage)
+        trace = current_trace()
+        if trace is not None:
+            trace.add(stage, duration)
+
+
+@contextmanager
+def trace(kind, query=None):
+    """Traces the enclosed query. Nested traces are folded into the
+    outermost trace running in this thread.
+
+    Arguments:
+    ----------
+        kind (str):
+            Type of query, i.e., 'text' or 'image'.
+        query (str):
+            Description of the query, written to the slow-query log.
+    """
+    if current_trace() is not None:
+        yield current_trace()
+        return
+
+    _trace = QueryTrace(kind, query)
+    _local.trace = _trace
+    try:
+        yield _trace
+    finally:
+        _local.trace = None
+        _trace.duration = time.perf_counter() - _trace.start
+        QUERY_SECONDS.observe(_trace.duration, kind=kind)
+
+        if _trace.duration > SLOW_QUERY_SECONDS:
+            SLOW_QUERIES.inc(kind=kind)
+            slow_query_logger.warning(json.dumps({
+                'kind': kind,
+                'query': query,
+                'seconds': round(_trace.duration, 6),
+                'stages': {stage: round(duration, 6) for stage, duration
+                           in _trace.breakdown().items()},
+            }))
+
+
+def render():
+    """Renders all registered metrics in Prometheus text exposition format.
+
+    Returns:
+    --------
+        (str):
+            Metrics exposition.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    labels = ','.join(f'{name}="{value}"' for name, value in key)
+    return '{' + labels + '}'
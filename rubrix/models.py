@@ -0,0 +1,216 @@
+"""Registry of the models used by the query processing pipeline.
+
+Importing TensorFlow, spaCy and OpenCV, and loading the models built on top
+of them, takes a long time. Models are therefore loaded lazily, either on
+first use or ahead of time by a background warm-up thread, so that the web
+application can start serving requests (and report its readiness) while
+the models are still loading.
+"""
+import time
+import threading
+
+from rubrix import metrics, pathfinder
+
+
+# Loading states of a model.
+PENDING, LOADING, READY, FAILED = 'pending', 'loading', 'ready', 'failed'
+
+
+class ModelRegistry:
+    """Loads each registered model at most once, and tracks its state.
+    """
+    def __init__(self):
+        """Initializes :class: ``ModelRegistry``.
+        """
+        self._loaders = {}
+        self._models = {}
+        self._states = {}
+        self._errors = {}
+        self._durations = {}
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        """Registers ``loader`` as the function which loads model ``name``.
+
+        Arguments:
+        ----------
+            name (str):
+                Key to the model.
+            loader (callable):
+                Function with no arguments, returning the loaded model.
+        """
+        with self._lock:
+            self._loaders[name] = loader
+            self._states[name] = PENDING
+            self._events[name] = threading.Event()
+
+    def names(self):
+        return list(self._loaders)
+
+    def loader(self, name):
+        """Returns the function which loads model ``name``.
+        """
+        return self._loaders[name]
+
+    def get(self, name, timeout=None):
+        """Returns model ``name``, loading it in this thread if no other
+        thread has started loading it, or waiting for that thread otherwise.
+
+        Arguments:
+        ----------
+            name (str):
+                Key to the model.
+            timeout (float):
+                Maximum time (in seconds) to wait for another thread to
+                finish loading the model.
+
+        Returns:
+        --------
+            model (object):
+                Loaded model.
+        """
+        with self._lock:
+            state = self._states[name]
+            if state == PENDING:
+                self._states[name] = LOADING
+        if state == PENDING:
+            self._load(name)
+
+        if not self._events[name].wait(timeout):
+            raise TimeoutError(f'Timed out waiting for model "{name}".')
+        if self._states[name] == FAILED:
+            raise RuntimeError(f'Model "{name}" failed to load: '
+                               f'{self._errors[name]}')
+        return self._models[name]
+
+    def _load(self, name):
+        start = time.perf_counter()
+        try:
+            with metrics.span(f'load_{name}'):
+                model = self._loaders[name]()
+        except Exception as e:
+            with self._lock:
+                self._errors[name] = repr(e)
+                self._states[name] = FAILED
+            print(f'[ERROR] Loading model "{name}" failed: {e!r}')
+        else:
+            with self._lock:
+                self._models[name] = model
+                self._states[name] = READY
+        finally:
+            self._durations[name] = time.perf_counter() - start
+            self._events[name].set()
+
+    def warm_up(self, names=None, background=True):
+        """Loads models ``names`` (all registered models by default).
+
+        Arguments:
+        ----------
+            names (list):
+                Keys to the models to load.
+            background (bool):
+                If True, models are loaded in a daemon thread.
+
+        Returns:
+        --------
+            thread (threading.Thread or None):
+                Warm-up thread, if ``background`` is True.
+        """
+        names = self.names() if names is None else list(names)
+
+        def _warm_up():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception:
+                    # Failures are recorded in the status of the model.
+                    pass
+
+        if not background:
+            _warm_up()
+            return None
+
+        thread = threading.Thread(target=_warm_up, name='rubrix-warm-up',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def is_ready(self, names=None):
+        names = self.names() if names is None else names
+        return all(self._states[name] == READY for name in names)
+
+    def status(self):
+        """Returns the loading state of every registered model.
+
+        Returns:
+        --------
+            status (dict):
+                Mapping from model key to a dictionary containing its
+                state, load time (in seconds) and error, if any.
+        """
+        with self._lock:
+            status = {}
+            for name in self._loaders:
+                status[name] = {'state': self._states[name]}
+                if name in self._durations:
+                    status[name]['seconds'] = round(self._durations[name], 3)
+                if name in self._errors:
+                    status[name]['error'] = self._errors[name]
+        return status
+
+
+def load_sentence_encoder():
+    """Loads Universal Sentence Encoder (large) from Tensorflow hub.
+    """
+    import tensorflow_hub as hub
+    from rubrix.index.encodings import MODULE_URL
+
+    return hub.load(MODULE_URL)
+
+
+def load_spacy_model(lang):
+    """Returns function which loads trained SpaCy language pipeline ``lang``.
+    """
+    def _load():
+        from rubrix.utils import retrieve_spacy_model
+        return retrieve_spacy_model(lang)
+    return _load
+
+
+def load_yolo_net():
+    """Loads YOLOv4 model from the default darknet paths.
+    """
+    from rubrix.image.detect import get_yolo_net
+
+    weights_path = pathfinder.get('assets', 'models', 'yolov4.weights')
+    cfg_path = pathfinder.get('rubrix', 'index', 'darknet', 'cfg',
+                              'yolov4.cfg')
+    return get_yolo_net(cfg_path, weights_path)
+
+
+def load_inception():
+    """Loads InceptionV3 model used to extract image descriptors.
+    """
+    from tensorflow.keras.applications.inception_v3 import InceptionV3
+
+    return InceptionV3(include_top=False, pooling='avg')
+
+
+def default_registry():
+    """Creates a registry with the models used by the web application.
+
+    Returns:
+    --------
+        registry (ModelRegistry):
+            Registry of the models.
+    """
+    from rubrix.utils import SPACY_MODEL_SMALL, SPACY_MODEL_MEDIUM
+
+    registry = ModelRegistry()
+    registry.register('sentence_encoder', load_sentence_encoder)
+    registry.register('spacy_small', load_spacy_model(SPACY_MODEL_SMALL))
+    registry.register('spacy_medium', load_spacy_model(SPACY_MODEL_MEDIUM))
+    registry.register('yolo', load_yolo_net)
+    registry.register('inception', load_inception)
+    return registry
@@ -0,0 +1,177 @@
+"""Bounded pools of model instances, shared by the threads of a process.
+
+An OpenCV ``cv2.dnn.Net``, a Keras model or a SpaCy pipeline cannot be used
+by several threads at once. Rather than loading a model for every request,
+each thread checks out an instance from the pool of the model, and returns
+it once done. A pool creates instances on demand, up to its size; beyond
+that, threads wait for an instance to be returned. The time spent waiting
+is recorded per pool, in ``rubrix_pool_wait_seconds``.
+
+The size of every pool is ``RUBRIX_POOL_SIZE`` (the number of cores, up to
+4, by default), and the size of the pool of model ``name`` can be set with
+``RUBRIX_POOL_SIZE_<NAME>``, e.g. ``RUBRIX_POOL_SIZE_YOLO=2``.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from rubrix import metrics
+
+
+# Default number of instances of each model.
+POOL_SIZE = int(os.environ.get('RUBRIX_POOL_SIZE',
+                               min(4, os.cpu_count() or 1)))
+
+# Time spent waiting for a model instance.
+WAIT_SECONDS = metrics.register(metrics.Histogram(
+    'rubrix_pool_wait_seconds',
+    'Time spent waiting for a model instance, per pool.'))
+
+# Checkouts which timed out.
+TIMEOUTS = metrics.register(metrics.Counter(
+    'rubrix_pool_timeouts_total',
+    'Number of checkouts which timed out, per pool.'))
+
+
+class ModelPool:
+    """Instances of a model, each used by at most one thread at a time.
+    """
+    def __init__(self, name, loader, size=None, first=None):
+        """Initializes :class: ``ModelPool``.
+
+        Arguments:
+        ----------
+            name (str):
+                Key to the model.
+            loader (callable):
+                Function with no arguments, returning a new instance of the
+                model.
+            size (int):
+                Maximum number of instances. Defaults to
+                ``RUBRIX_POOL_SIZE_<NAME>``, or else ``POOL_SIZE``.
+            first (callable):
+                Function returning the first instance, e.g. the model loaded
+                by :class: ``rubrix.models.ModelRegistry``. Defaults to
+                ``loader``.
+        """
+        self.name = name
+        self.loader = loader
+        self.size = max(1, size or int(os.environ.get(
+            f'RUBRIX_POOL_SIZE_{name.upper()}', POOL_SIZE)))
+        self.first = first or loader
+        self._idle = []
+        self._created = 0
+        self._in_use = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """Checks out an instance of the model, for the enclosed block.
+
+        Arguments:
+        ----------
+            timeout (float):
+                Maximum time (in seconds) to wait for an instance.
+
+        Returns:
+        --------
+            model (object):
+                Instance of the model, used by no other thread until the
+                block exits.
+        """
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        with self._condition:
+            while not self._idle and self._created >= self.size:
+                remaining = None if deadline is None else \
+                    deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    TIMEOUTS.inc(pool=self.name)
+                    raise TimeoutError(f'Timed out waiting for model '
+                                       f'"{self.name}".')
+                self._condition.wait(remaining)
+            if self._idle:
+                model, loader = self._idle.pop(), None
+            else:
+                loader = self.first if self._created == 0 else self.loader
+                self._created += 1
+            self._in_use += 1
+        WAIT_SECONDS.observe(time.perf_counter() - start, pool=self.name)
+
+        if loader is not None:
+            try:
+                model = loader()
+            except BaseException:
+                with self._condition:
+                    self._created -= 1
+                    self._in_use -= 1
+                    self._condition.notify()
+                raise
+
+        try:
+            yield model
+        finally:
+            with self._condition:
+                self._idle.append(model)
+                self._in_use -= 1
+                self._condition.notify()
+
+    def status(self):
+        """Returns the size of the pool, and the number of instances created
+        and in use.
+        """
+        with self._condition:
+            return {'size': self.size, 'created': self._created,
+                    'in_use': self._in_use}
+
+
+@contextmanager
+def checkout(pools, name, loader, timeout=None):
+    """Checks out an instance of model ``name`` from ``pools``, or loads a
+    new instance with ``loader`` if there is no such pool.
+
+    Arguments:
+    ----------
+        pools (dict):
+            Mapping from model key to :class: ``ModelPool``, or None.
+        name (str):
+            Key to the model.
+        loader (callable):
+            Function with no arguments, returning a new instance of the
+            model.
+        timeout (float):
+            Maximum time (in seconds) to wait for an instance.
+
+    Returns:
+    --------
+        model (object):
+            Instance of the model.
+    """
+    if pools is not None and name in pools:
+        with pools[name].checkout(timeout) as model:
+            yield model
+    else:
+        yield loader()
+
+
+def default_pools(registry):
+    """Creates pools of the models of ``registry`` which cannot be shared
+    by threads, i.e., YOLOv4, InceptionV3 and the SpaCy pipelines. The
+    first instance of each is the one loaded by the registry.
+
+    Arguments:
+    ----------
+        registry (rubrix.models.ModelRegistry):
+            Registry created by :method: ``rubrix.models.default_registry``.
+
+    Returns:
+    --------
+        pools (dict):
+            Mapping from model key to :class: ``ModelPool``.
+    """
+    pools = {}
+    for name in ['yolo', 'inception', 'spacy_small', 'spacy_medium']:
+        pools[name] = ModelPool(name, registry.loader(name),
+                                first=lambda name=name: registry.get(name))
+    return pools
@@ -1,25 +1,20 @@
 """Processes user query, either by text or image to retrieve relevant
 images from the image database.
 """
-import json
-import heapq
 import shutil
-import pickle
-import operator
 from pathlib import Path
 
 import numpy as np
 
-import matplotlib.pyplot as plt
-
-import cv2
-
-from rubrix import pathfinder
+from rubrix import metrics, pathfinder
+from rubrix.deadline import EXACT_LABELS, cap_budget, scope
 from rubrix.index.descriptors import TARGET_SIZE
-from rubrix.index.encodings import MODULE_URL
-from rubrix.image.extract import extract_image_descriptors
-from rubrix.image.detect import get_yolo_net, get_labels, detect_objects
-from rubrix.utils import extract_features, get_similar_words, cosine_distance, dot_product
+from rubrix.index.lexical import tokenize
+from rubrix.index.store import get_store
+from rubrix.models import load_inception, load_spacy_model
+from rubrix.pool import checkout
+from rubrix.utils import extract_features, get_similar_words, read_names
+from rubrix.utils import SPACY_MODEL_MEDIUM, SPACY_MODEL_SMALL
 
 
 class SearchResultObject:
@@ -101,7 +96,9 @@ class ReverseSearchResultObject(SearchResultObject):
         self.score = score
 
 
-def query_by_text(text, model, save=False):
+def query_by_text(text, model, save=False, store=None, mode='or',
+                  budget=None, retriever='objects', pools=None,
+                  deadline=None, k=5):
     """Processes text queries to retrieve relevant images from database.
 
     Arguments:
@@ -112,68 +109,91 @@ def query_by_text(text, model, save=False):
             Universal sentence encoder (large) tensorflow saved model.
         save (bool):
             If True, save predictions to /assets/predictions.
+        store (rubrix.index.store.IndexStore or rubrix.sharding.ShardedScorer
+               or rubrix.index.segments.SegmentedStore):
+            Index to search. Defaults to the store shared by this process.
+        mode (str):
+            If 'or', images containing an object similar to any of the
+            nouns in ``text`` are scored. If 'and', only images containing
+            objects similar to all of the nouns are scored, which shrinks
+            the set of images to score.
+        budget (int):
+            If given, only the ``budget`` images in which each object label
+            was detected most confidently are scored, which bounds the
+            latency of queries for common objects.
+        retriever (str):
+            How candidate images are found before they are scored:
+                - 'objects': images containing objects similar to the nouns
+                  in ``text``,
+                - 'lexical': images whose captions best match the words in
+                  ``text``, by BM25 score (see :mod:
+                  ``rubrix.index.lexical``), which skips noun extraction,
+                - 'hybrid': both.
+        pools (dict):
+            Mapping from model key to :class: ``rubrix.pool.ModelPool``,
+            from which the SpaCy pipelines are checked out. Without a pool,
+            a pipeline is loaded for the query.
+        deadline (rubrix.deadline.Deadline or float):
+            Deadline, or latency budget (in seconds) of the query. Stages
+            are skipped or cut short when the deadline is close (see :mod:
+            ``rubrix.deadline``), and the degradations applied are recorded
+            in the deadline.
+        k (int):
+            Number of images to retrieve.
 
     Returns:
     --------
         results (list of pathlib.Path objects):
             List of paths to images retrieved for user query.
     """
-    features = extract_features(text)
-
-    keys = [get_similar_words(feature, 'coco.names', n=2) \
-            for feature in features]
-
-    keys = [word for similar_words in keys for word in similar_words]
-
-    index_path = pathfinder.get('assets', 'index.json')
-
-    with open(index_path, 'r') as index_file:
-        index = json.load(index_file)       
-
-    # We need to perform membership test to check if a given image
-    # identifier is already a part of ``image_ids``. 
-    # Membership tests in sets is O(1) as opposed to that in lists,
-    # which is O(n). Hence, the former is the preferred data structure
-    # for ``image_ids``.
-    image_paths = set([])
-
-    for key in keys:
-        items = set(index[key])
-        image_paths |= items
-        
-    embeddings_path = pathfinder.get('assets', 'imageEmbeddingLocations.json')
-
-    with open(embeddings_path, 'r') as embeddings_file:
-        embeddings = json.load(embeddings_file)
-
-    array = model([text]).numpy()[0]
-
-    results = []
-
-    for index, path in enumerate(image_paths):
-        iid = Path(path).name
-        embeddings_paths = embeddings[iid]
-
-        similarity_scores = []
-        for embedding_path in embeddings_paths:
-            other_array = np.load(embedding_path)
-            similarity_scores.append(dot_product(array, other_array))
-        max_idx = similarity_scores.index(max(similarity_scores))
-
-        results.append(SearchResultObject(
-                        name=iid,
-                        index=index,
-                        path_to_image=path,
-                        path_to_embed=embeddings_paths[max_idx],
-                        score=similarity_scores[max_idx],
-                      )
-        )
-
-    # Using heaps to extract N largest results from a list of n elements
-    # is recommended, as the time complexity to do so is O(n * logN), which
-    # is approximately O(n) if N is relatively small.
-    results = heapq.nlargest(5, results)
-    results = [result.path_to_image for result in results]
+    with metrics.trace('text', query=text), scope(deadline) as deadline:
+        keys, terms = None, None
+        if retriever in ('objects', 'hybrid'):
+            with metrics.span('extract_features'), \
+                    checkout(pools, 'spacy_small',
+                             load_spacy_model(SPACY_MODEL_SMALL)) as nlp:
+                features = extract_features(text, nlp)
+
+            if deadline is None or deadline.allows('similar_words'):
+                # Each feature is expanded to a group of similar object
+                # labels.
+                with metrics.span('similar_words'), \
+                        checkout(pools, 'spacy_medium',
+                                 load_spacy_model(SPACY_MODEL_MEDIUM)) as nlp:
+                    keys = [get_similar_words(feature, 'coco.names', n=2,
+                                              model=nlp)
+                            for feature in features]
+            else:
+                # Features only match the object labels they are equal to.
+                deadline.degrade(EXACT_LABELS)
+                names = read_names('coco.names')
+                keys = [[feature] for feature in features
+                        if feature in names]
+            # Without nouns, there are no objects to filter images by, and
+            # all images are scored.
+            keys = keys or None
+        if retriever in ('lexical', 'hybrid'):
+            terms = tokenize(text)
+
+        if store is None:
+            with metrics.span('load_index'):
+                store = get_store()
+
+        with metrics.span('encode'):
+            array = model([text]).numpy()[0]
+
+        budget = cap_budget(budget)
+        with metrics.span('rank'):
+            results = [SearchResultObject(
+                        name=Path(store.path(image_id)).name,
+                        index=image_id,
+                        path_to_image=store.path(image_id),
+                        path_to_embed=None,
+                        score=score,
+                       ) for image_id, score
+                       in store.search_captions(array, keys, k, mode=mode,
+                                                budget=budget, terms=terms)]
+            results = [result.path_to_image for result in results]
 
     if save:
         # Save predictions to /assets/predictions.
@@ -207,18 +227,22 @@ def query_by_image_captions(image_path, model, save=True):
 
 
 def query_by_image_objects(image_path, weights_path, cfg_path, names_path, 
-                           confidence_threshold=0.5, save=False):
+                           confidence_threshold=0.5, save=False, store=None,
+                           budget=None, pools=None, deadline=None, k=5):
     """Processes user-uploaded image to retrieve similar images from database.
 
     First, all the objects in the image are detected using the :method:
     ``rubrix.images.detect.detect_objects``. Next, the image descriptor array
     for the user-uploaded image is compared with that of all pruned images so
-    as to retrieve the top-5 results.
+    as to retrieve the top-``k`` results.
 
     Arguments:
     ----------
-        image_path (numpy.ndarray):
-            Path for user-uploaded image, for reverse-image search.
+        image_path (pathlib.Path or numpy.ndarray):
+            Path for user-uploaded image, for reverse-image search, or the
+            image already decoded by OpenCV (BGR channel order). The image
+            is decoded once, and both the YOLOv4 and InceptionV3 inputs are
+            derived from the decoded pixels.
         weights_path (pathlib.Path):
             Path to YOLOv4 pretrained weights file.
         cfg_path (pathlib.Path):
@@ -227,49 +251,72 @@ def query_by_image_objects(image_path, weights_path, cfg_path, names_path,
             Path to darknet names file.
         save (bool):
             If True, save predictions to /assets/predictions.
+        store (rubrix.index.store.IndexStore or rubrix.sharding.ShardedScorer
+               or rubrix.index.segments.SegmentedStore):
+            Index to search. Defaults to the store shared by this process.
+        budget (int):
+            If given, only the ``budget`` images in which each detected
+            object was detected most confidently are scored.
+        pools (dict):
+            Mapping from model key to :class: ``rubrix.pool.ModelPool``,
+            from which YOLOv4 and InceptionV3 are checked out. Without a
+            pool, the model is loaded for the query.
+        deadline (rubrix.deadline.Deadline or float):
+            Deadline, or latency budget (in seconds) of the query (see
+            :method: ``query_by_text``).
+        k (int):
+            Number of images to retrieve.
 
     Returns:
     --------
         results (list of pathlib.Path objects):
             List of paths to images retrieved for user query.
     """
-    # Retrieve image descriptor vector for user-uploaded image.
-    array = extract_image_descriptors(image_path, 'inception', TARGET_SIZE)
-    array = array.reshape(-1)
-
-    # Retrieve YOLOv4 model related variables to detect objects in an image.
-    net = get_yolo_net(cfg_path, weights_path)
-    labels = get_labels(names_path)
-    image = cv2.imread(str(image_path))
-    objects = detect_objects(net, labels, image, confidence_threshold)    
-
-    index_path = pathfinder.get('assets', 'index.json')
-    with open(index_path, 'r') as json_file:
-        index = json.load(json_file)
-
-    paths_to_images = set([])
-    for object in objects:
-        paths_to_images |= set(index[object])
-
-    descriptors_path = pathfinder.get('assets', 'data', 'descriptors')
-
-    results = []
-    for path in paths_to_images:
-        path = Path(path)
-        other_array = np.load(descriptors_path / f'{path.stem}.npy')
-        score = dot_product(array, other_array)
-        results.append(ReverseSearchResultObject(
-                        name=path.name,
-                        path_to_image=path,
+    # OpenCV and Tensorflow are only imported once an image query is made,
+    # which keeps importing this module (and text queries) fast.
+    import cv2
+    from rubrix.image.extract import extract_batch_descriptors
+    from rubrix.image.detect import get_yolo_net, get_labels, detect_objects
+
+    decoded = isinstance(image_path, np.ndarray)
+    with metrics.trace('image',
+                       query='upload' if decoded else str(image_path)), \
+            scope(deadline):
+        if decoded:
+            image = image_path
+        else:
+            with metrics.span('decode_image'):
+                image = cv2.imread(str(image_path))
+        if image is None:
+            raise ValueError(f'Unable to decode image {image_path}.')
+
+        # Retrieve image descriptor vector for user-uploaded image.
+        with checkout(pools, 'inception', load_inception) as model:
+            array = extract_batch_descriptors(model, [image], TARGET_SIZE)
+        array = array.reshape(-1)
+
+        # Retrieve YOLOv4 model related variables to detect objects in
+        # an image.
+        labels = get_labels(names_path)
+        with checkout(pools, 'yolo',
+                      lambda: get_yolo_net(cfg_path, weights_path)) as net:
+            objects = detect_objects(net, labels, image,
+                                     confidence_threshold)
+
+        if store is None:
+            with metrics.span('load_index'):
+                store = get_store()
+
+        budget = cap_budget(budget)
+        with metrics.span('rank'):
+            results = [ReverseSearchResultObject(
+                        name=Path(store.path(image_id)).name,
+                        path_to_image=Path(store.path(image_id)),
                         score=score,
-                      )
-        )
-
-    # Using heaps to extract N largest results from a list of n elements
-    # is recommended, as the time complexity to do so is O(n * logN), which
-    # is approximately O(n) if N is relatively small.
-    results = heapq.nlargest(5, results)
-    results = [result.path_to_image for result in results]
+                       ) for image_id, score
+                       in store.search_descriptors(array, list(objects), k,
+                                                   budget=budget)]
+            results = [result.path_to_image for result in results]
 
     if save:
         # Save predictions to /assets/predictions.
@@ -0,0 +1,136 @@
+"""Fans queries out to shard servers over HTTP, and merges their results.
+
+A router exposes the same search interface as
+:class: ``rubrix.index.store.IndexStore``, so it can be passed to the query
+functions in :mod: ``rubrix.query`` in place of a local store. Shards are
+queried in parallel, each with its own timeout. Shards which time out or
+fail are left out of the merged results, so that a slow or missing shard
+degrades the results of a query rather than failing it.
+"""
+import json
+import time
+import logging
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from rubrix import deadline, metrics, pathfinder
+from rubrix.sharding import merge_top_k
+
+
+logger = logging.getLogger('rubrix.router')
+
+# Number of shard requests which timed out or failed.
+SHARD_FAILURES = metrics.register(metrics.Counter(
+    'rubrix_shard_failures_total',
+    'Number of shard requests which timed out or failed.'))
+
+# Latency of each shard server.
+SHARD_SECONDS = metrics.register(metrics.Histogram(
+    'rubrix_shard_seconds', 'Latency of shard server requests.'))
+
+
+class ShardRouter:
+    """Scatter-gather searches over shard servers.
+
+    Images are identified by their paths relative to the main directory in
+    the results of a router, as the image IDs of a shard are local to that
+    shard. These are resolved against the local main directory by
+    :method: ``path``.
+    """
+    def __init__(self, urls, timeout=2.0):
+        """Initializes :class: ``ShardRouter``.
+
+        Arguments:
+        ----------
+            urls (list):
+                Base URLs of the shard servers, e.g. 'http://10.0.0.2:9000'.
+            timeout (float):
+                Time (in seconds) to wait for each shard server.
+        """
+        self.urls = [url.rstrip('/') for url in urls]
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=len(self.urls),
+                                            thread_name_prefix='rubrix-router')
+
+    def path(self, image_id):
+        return str(pathfinder.get_root() / image_id)
+
+    def search_captions(self, array, labels, k, mode='or', budget=None,
+                        terms=None):
+        """Retrieves the ``k`` images among those containing ``labels``,
+        whose captions best match sentence embedding ``array``.
+
+        See :method: ``rubrix.index.store.IndexStore.search_captions``.
+        Each shard server applies ``budget`` and ``terms`` to its own
+        images.
+        """
+        return self._scatter('captions', array, labels, k, mode, budget,
+                             terms)
+
+    def search_descriptors(self, array, labels, k, mode='or', budget=None,
+                           terms=None):
+        """Retrieves the ``k`` images among those containing ``labels``,
+        whose image descriptors best match ``array``.
+
+        See :method: ``rubrix.index.store.IndexStore.search_descriptors``.
+        Each shard server applies ``budget`` and ``terms`` to its own
+        images.
+        """
+        return self._scatter('descriptors', array, labels, k, mode, budget,
+                             terms)
+
+    def _scatter(self, kind, array, labels, k, mode, budget, terms):
+        body = json.dumps({
+            'kind': kind,
+            'vector': np.asarray(array, dtype=np.float32).tolist(),
+            'labels': None if labels is None else list(labels),
+            'k': k,
+            'mode': mode,
+            'budget': budget,
+            'terms': None if terms is None else list(terms),
+        }).encode('utf-8')
+
+        futures = {self._executor.submit(self._request, url, body): url
+                   for url in self.urls}
+        # Shard requests time out individually, and this bounds the wait
+        # for shard servers which accepted the connection but stalled. A
+        # query with a deadline waits until its deadline at most.
+        timeout = self.timeout
+        active = deadline.current()
+        if active is not None:
+            timeout = max(0, min(timeout, active.remaining()))
+        done, not_done = wait(futures, timeout=timeout)
+
+        local_results = []
+        for future in done:
+            try:
+                local_results.append(future.result())
+            except Exception as e:
+                self._failed(futures[future], e)
+        for future in not_done:
+            future.cancel()
+            self._failed(futures[future], 'timed out')
+        if not_done and active is not None and timeout < self.timeout:
+            active.degrade(deadline.PARTIAL)
+
+        return merge_top_k(local_results, k)
+
+    def _request(self, url, body):
+        start = time.perf_counter()
+        request = urllib.request.Request(
+            f'{url}/shard/search', data=body,
+            headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request,
+                                    timeout=self.timeout) as response:
+            results = json.load(response)['results']
+        SHARD_SECONDS.observe(time.perf_counter() - start, shard=url)
+        return [(path, score) for path, score in results]
+
+    def _failed(self, url, reason):
+        SHARD_FAILURES.inc(shard=url)
+        logger.warning(f'Shard {url} left out of results: {reason}')
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,193 @@
+"""Scores queries on multiple cores, by partitioning the index store across
+worker processes.
+
+Each worker process memory-maps the same store files, so the embeddings and
+descriptors live once in the (shared) page cache, and each worker only
+touches the rows of its own shard. For a query, the coordinator scatters the
+query vector and object labels to every worker, each worker computes a local
+top-k over its shard, and the coordinator merges the local top-k lists into
+the global top-k.
+"""
+import os
+import heapq
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+import numpy as np
+
+from rubrix.index.store import IndexStore, snapshot_path
+
+
+# Environment variables limiting the number of threads used by BLAS within
+# each worker. Every worker scores its shard with one core, which avoids
+# oversubscribing the cores when all workers are busy.
+THREAD_LIMITS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+class ShardedScorer:
+    """Scatter-gather scorer over ``n_shards`` worker processes.
+
+    Exposes the same search interface as :class: ``IndexStore``, so it can
+    be passed to :method: ``rubrix.query.query_by_text`` and :method:
+    ``rubrix.query.query_by_image_objects`` in place of the store.
+    """
+    def __init__(self, store_path, n_shards=None):
+        """Initializes :class: ``ShardedScorer``, and starts the workers.
+
+        Arguments:
+        ----------
+            store_path (pathlib.Path):
+                Path to store directory.
+            n_shards (int):
+                Number of worker processes. Defaults to number of CPUs.
+        """
+        # Workers load the same snapshot, even if another one is published
+        # while they start.
+        store_path = snapshot_path(store_path)
+        self.store = IndexStore.load(store_path)
+        self.n_shards = n_shards or os.cpu_count()
+
+        # Shards are contiguous ranges of image IDs, with postings being
+        # sorted by image ID.
+        self.bounds = np.linspace(0, len(self.store),
+                                  self.n_shards + 1).astype(int)
+
+        context = multiprocessing.get_context('spawn')
+        self._connections, self._processes = [], []
+        with _limit_threads():
+            for start, stop in zip(self.bounds[:-1], self.bounds[1:]):
+                connection, child_connection = context.Pipe()
+                process = context.Process(
+                    target=_serve_shard,
+                    args=(store_path, int(start), int(stop), child_connection),
+                    daemon=True)
+                process.start()
+                self._connections.append(connection)
+                self._processes.append(process)
+
+        for connection in self._connections:
+            _unwrap(connection.recv())
+
+        # A query occupies all workers, hence queries are scattered one at
+        # a time.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.store)
+
+    def path(self, image_id):
+        return self.store.path(image_id)
+
+    def search_captions(self, array, labels, k, mode='or', budget=None,
+                        terms=None):
+        """Retrieves the ``k`` images among those containing ``labels``,
+        whose captions best match sentence embedding ``array``.
+
+        See :method: ``rubrix.index.store.IndexStore.search_captions``.
+        """
+        return self._scatter('captions', array, labels, k, mode, budget,
+                             terms)
+
+    def search_descriptors(self, array, labels, k, mode='or', budget=None,
+                           terms=None):
+        """Retrieves the ``k`` images among those containing ``labels``,
+        whose image descriptors best match ``array``.
+
+        See :method: ``rubrix.index.store.IndexStore.search_descriptors``.
+        """
+        return self._scatter('descriptors', array, labels, k, mode, budget,
+                             terms)
+
+    def _scatter(self, kind, array, labels, k, mode, budget, terms):
+        request = (kind, np.asarray(array, dtype=np.float32),
+                   None if labels is None else list(labels), k, mode, budget,
+                   None if terms is None else list(terms))
+
+        with self._lock:
+            for connection in self._connections:
+                connection.send(request)
+            local_results = [_unwrap(connection.recv())
+                             for connection in self._connections]
+
+        return merge_top_k(local_results, k)
+
+    def close(self):
+        """Stops the workers.
+        """
+        for connection in self._connections:
+            connection.send(None)
+        for process in self._processes:
+            process.join()
+
+
+def merge_top_k(local_results, k):
+    """Merges local top-k lists into the global top-k list.
+
+    Arguments:
+    ----------
+        local_results (list of lists):
+            (image ID, score) pairs, each list in decreasing order of score.
+        k (int):
+            Number of images to retrieve.
+
+    Returns:
+    --------
+        (list of tuples):
+            (image ID, score) pairs, in decreasing order of score.
+    """
+    merged = heapq.merge(*local_results, key=lambda result: -result[1])
+    return [result for _, result in zip(range(k), merged)]
+
+
+def _serve_shard(store_path, start, stop, connection):
+    """Body of a worker process, which serves queries over image IDs in
+    ``[start, stop)`` until it receives None.
+    """
+    try:
+        store = IndexStore.load(store_path)
+    except Exception as e:
+        connection.send(e)
+        return
+    connection.send(None)
+
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+
+        kind, array, labels, k, mode, budget, terms = request
+        try:
+            # Workers share the whole store, hence the budget selects the
+            # most confident images (and best lexical matches) of the whole
+            # store, as a single process would.
+            if kind == 'captions':
+                results = store.search_captions(array, labels, k, start, stop,
+                                                mode, budget, terms)
+            else:
+                results = store.search_descriptors(array, labels, k, start,
+                                                   stop, mode, budget, terms)
+        except Exception as e:
+            results = e
+        connection.send(results)
+
+
+def _unwrap(response):
+    if isinstance(response, Exception):
+        raise response
+    return response
+
+
+@contextmanager
+def _limit_threads():
+    # Spawned processes inherit the environment at the time they start.
+    previous = {name: os.environ.get(name) for name in THREAD_LIMITS}
+    os.environ.update({name: '1' for name in THREAD_LIMITS})
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
@@ -8,14 +8,12 @@ from pathlib import Path
 
 import numpy as np
 
-import scipy
-from scipy.spatial.distance import cosine, euclidean
-
-import spacy
-
-import dotproduct
 from rubrix import pathfinder
 
+# SpaCy, SciPy and the ``dotproduct`` extension are imported within the
+# utilities using them, as importing them at module load slows down the
+# start-up of every process importing this module.
+
 
 # Small-size (12MB) trained English language Spacy pipeline
 # No trained word2vec embeddings
@@ -52,6 +50,8 @@ def retrieve_spacy_model(lang):
         model (spacy.lang)
             Trained SpaCy language pipeline.
     """
+    import spacy
+
     if not spacy.util.is_package(lang):
         subprocess.call(f'python -m spacy download {lang}', shell=True)
 
@@ -129,8 +129,8 @@ def extract_features(text, model=SPACY_MODEL_SMALL):
     ----------
         text (str):
             Word/Phrase/Sentence
-        model (spacy.lang)
-            Trained SpaCy language pipeline.
+        model (spacy.lang or str)
+            Trained SpaCy language pipeline, or key to it.
             By default, 'en-core-web-sm' is recommended for this utility.
 
     Returns:
@@ -138,7 +138,8 @@ def extract_features(text, model=SPACY_MODEL_SMALL):
         features (list):
             List of extracted features.
     """
-    model = retrieve_spacy_model(model)
+    if isinstance(model, str):
+        model = retrieve_spacy_model(model)
     text = model(text)
 
     features = []
@@ -182,6 +183,8 @@ def cdot_product(array, other_array):
 
     Check rubrix/source/dotproduct.c for more details.
     """
+    import dotproduct
+
     data = [array.tolist(), other_array.tolist()]
     return dotproduct.dot_product_optimized(*data)
 
@@ -201,6 +204,8 @@ def cosine_distance(array, other_array):
         (float):
             Cosine distance.
     """
+    from scipy.spatial.distance import cosine
+
     return cosine(array, other_array)
 
 
@@ -219,10 +224,36 @@ def euclidean_distance(array, other_array):
         (float):
             Euclidean distance.
     """
+    from scipy.spatial.distance import euclidean
+
     return euclidean(array, other_array)
 
 
-def get_similar_words(word, names_file, n=3):
+def read_names(names_file):
+    """Utility to read the list of objects YOLO is trained on.
+
+    Arguments:
+    ----------
+        names_file (pathlib.Path):
+            Name of darknet names file, in ``rubrix/index/darknet/data``.
+
+    Returns:
+    --------
+        names (list):
+            List of object labels.
+    """
+    names_path = pathfinder.get('rubrix', 'index', 'darknet',
+                                'data', names_file)
+
+    try:
+        names = [name.rstrip() for name in open(names_path).readlines()]
+    except:
+        print('PathError: Path to names file is incorrect.')
+        sys.exit()
+    return names
+
+
+def get_similar_words(word, names_file, n=3, model=SPACY_MODEL_MEDIUM):
     """Utility to retrieve `n` similar words based on word2vec feature
     similarity.
 
@@ -234,27 +265,27 @@ def get_similar_words(word, names_file, n=3):
             Path to file containing list of objects YOLO is trained on.
         n (int):
             Number of similar words to extract.
+        model (spacy.lang or str)
+            Trained SpaCy language pipeline with word vectors, or key to it.
 
     Returns:
     --------
         most_similar_words (list):
             List of top-N similar words.
     """
-    names_path = pathfinder.get('rubrix', 'index', 'darknet',
-                                'data', names_file)
+    names = read_names(names_file)
 
-    try:
-        names = [name.rstrip() for name in open(names_path).readlines()]
-    except:
-        print('PathError: Path to names file is incorrect.')
-        sys.exit()
-
-    model = retrieve_spacy_model(SPACY_MODEL_MEDIUM)
+    if isinstance(model, str):
+        model = retrieve_spacy_model(model)
     # Disabling pipeline components computing linguistic features saves
     # time, as these components are not necessary for word2vec similarity
-    # score computation.
-    model.disable_pipes(['tok2vec', 'tagger', 'parser', 'attribute_ruler',
-                         'lemmatizer', 'ner'])
+    # score computation. A pipeline reused across calls has them disabled
+    # already.
+    enabled = [name for name in ['tok2vec', 'tagger', 'parser',
+                                 'attribute_ruler', 'lemmatizer', 'ner']
+               if name in model.pipe_names]
+    if enabled:
+        model.disable_pipes(enabled)
 
     word = model(word)
     word_similarities = [word.similarity(model(name)) for name in names]
@@ -278,6 +309,12 @@ def fix_paths_in_index(index_path, emb_path):
     Given both the index files, this is an alternative to simply fix the
     paths in, thus enabling faster code reproducibility.
 
+    Note that queries do not read these files directly, but the index store
+    built from them (see :mod: ``rubrix.index.store``), whose catalog keeps
+    image paths relative to the main directory. Building the store from
+    index files with paths from another machine does not require fixing
+    the paths first.
+
     Arguments:
     ----------
         index_path (pathlib.Path):
@@ -0,0 +1,242 @@
+"""Admission control for the search endpoints.
+
+Each search endpoint runs at most ``RUBRIX_ADMISSION_CONCURRENCY`` queries
+at once (the size of the model pools, by default), and queues at most
+``RUBRIX_ADMISSION_QUEUE`` more. A request is rejected, with a ``503`` and a
+``Retry-After`` header, when the queue is full, or when it waited longer
+than ``RUBRIX_ADMISSION_TIMEOUT`` seconds for its turn. Under overload,
+latency is hence bounded by the queue wait plus the service time, rather
+than growing with the backlog of requests. Limits of endpoint ``name`` can
+be set with ``RUBRIX_ADMISSION_CONCURRENCY_<NAME>`` and
+``RUBRIX_ADMISSION_QUEUE_<NAME>``.
+
+Results of recent text queries are kept in a :class: ``ResultCache``, and
+cache hits are served without going through admission, as they need no
+model.
+"""
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from rubrix import metrics
+from rubrix.pool import POOL_SIZE
+
+
+# Default number of queries running at once, per endpoint.
+CONCURRENCY = int(os.environ.get('RUBRIX_ADMISSION_CONCURRENCY', POOL_SIZE))
+
+# Default number of queries waiting for their turn, per endpoint.
+QUEUE_SIZE = int(os.environ.get('RUBRIX_ADMISSION_QUEUE', 2 * CONCURRENCY))
+
+# Maximum time (in seconds) a query waits for its turn.
+TIMEOUT = float(os.environ.get('RUBRIX_ADMISSION_TIMEOUT', 2.0))
+
+# Number of text queries whose results are cached.
+RESULT_CACHE_SIZE = int(os.environ.get('RUBRIX_RESULT_CACHE_SIZE', 256))
+
+# Number of queries waiting for their turn.
+QUEUE_DEPTH = metrics.register(metrics.Gauge(
+    'rubrix_admission_queue_depth',
+    'Number of queries waiting for their turn, per endpoint.'))
+
+# Number of queries running.
+IN_FLIGHT = metrics.register(metrics.Gauge(
+    'rubrix_admission_in_flight',
+    'Number of queries running, per endpoint.'))
+
+# Time spent waiting for a turn, by admitted queries.
+WAIT_SECONDS = metrics.register(metrics.Histogram(
+    'rubrix_admission_wait_seconds',
+    'Time spent by admitted queries waiting for their turn, per endpoint.'))
+
+# Queries rejected, because the queue was full or the wait timed out.
+REJECTIONS = metrics.register(metrics.Counter(
+    'rubrix_admission_rejections_total',
+    'Number of rejected queries, per endpoint and reason.'))
+
+# Queries served from the result cache.
+CACHE_HITS = metrics.register(metrics.Counter(
+    'rubrix_result_cache_hits_total',
+    'Number of queries served from the result cache, per endpoint.'))
+
+
+class Overloaded(Exception):
+    """Raised when a query is not admitted.
+    """
+    def __init__(self, endpoint, reason, retry_after):
+        """Initializes :class: ``Overloaded``.
+
+        Arguments:
+        ----------
+            endpoint (str):
+                Name of the endpoint.
+            reason (str):
+                Either 'queue_full' or 'timeout'.
+            retry_after (int):
+                Number of seconds after which the client should retry.
+        """
+        super().__init__(f'Endpoint "{endpoint}" is overloaded ({reason}).')
+        self.endpoint = endpoint
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """Bounds the number of queries running at once on an endpoint, with a
+    bounded, first-come first-served wait queue.
+    """
+    def __init__(self, name, concurrency=None, queue_size=None,
+                 timeout=TIMEOUT):
+        """Initializes :class: ``Limiter``.
+
+        Arguments:
+        ----------
+            name (str):
+                Name of the endpoint.
+            concurrency (int):
+                Maximum number of queries running at once. Defaults to
+                ``RUBRIX_ADMISSION_CONCURRENCY_<NAME>``, or else
+                ``CONCURRENCY``.
+            queue_size (int):
+                Maximum number of queries waiting for their turn. Defaults
+                to ``RUBRIX_ADMISSION_QUEUE_<NAME>``, or else ``QUEUE_SIZE``.
+            timeout (float):
+                Maximum time (in seconds) a query waits for its turn.
+        """
+        self.name = name
+        self.concurrency = max(1, concurrency or int(os.environ.get(
+            f'RUBRIX_ADMISSION_CONCURRENCY_{name.upper()}', CONCURRENCY)))
+        if queue_size is None:
+            queue_size = int(os.environ.get(
+                f'RUBRIX_ADMISSION_QUEUE_{name.upper()}', QUEUE_SIZE))
+        self.queue_size = max(0, queue_size)
+        self.timeout = timeout
+        self._running = 0
+        # Tickets of waiting queries, served in order.
+        self._next_ticket = 0
+        self._queue = []
+        # Moving average of the time (in seconds) spent running a query.
+        self._service_seconds = 1.0
+        self._condition = threading.Condition()
+
+    def retry_after(self):
+        """Estimates the number of seconds until the queue has room.
+        """
+        seconds = (len(self._queue) + 1) * self._service_seconds / \
+            self.concurrency
+        return max(1, math.ceil(seconds))
+
+    @contextmanager
+    def admit(self):
+        """Runs the enclosed block once it is this query's turn.
+
+        Raises:
+        -------
+            Overloaded:
+                If the queue is full, or the query waited longer than
+                ``timeout`` seconds.
+        """
+        start = time.perf_counter()
+        with self._condition:
+            if self._running >= self.concurrency or self._queue:
+                if len(self._queue) >= self.queue_size:
+                    self._reject('queue_full')
+                ticket = self._next_ticket
+                self._next_ticket += 1
+                self._queue.append(ticket)
+                QUEUE_DEPTH.inc(endpoint=self.name)
+                try:
+                    deadline = start + self.timeout
+                    while self._running >= self.concurrency or \
+                            self._queue[0] != ticket:
+                        remaining = deadline - time.perf_counter()
+                        if remaining <= 0:
+                            self._queue.remove(ticket)
+                            # The next query in line may be able to run.
+                            self._condition.notify_all()
+                            self._reject('timeout')
+                        self._condition.wait(remaining)
+                    self._queue.pop(0)
+                    # Queries behind this one may run too, if there is room.
+                    self._condition.notify_all()
+                finally:
+                    QUEUE_DEPTH.dec(endpoint=self.name)
+            self._running += 1
+            IN_FLIGHT.inc(endpoint=self.name)
+        WAIT_SECONDS.observe(time.perf_counter() - start, endpoint=self.name)
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            with self._condition:
+                self._running -= 1
+                IN_FLIGHT.dec(endpoint=self.name)
+                self._service_seconds = 0.8 * self._service_seconds + \
+                    0.2 * duration
+                self._condition.notify_all()
+
+    def status(self):
+        """Returns the limits of the endpoint, and the number of queries
+        running and waiting.
+        """
+        with self._condition:
+            return {'concurrency': self.concurrency,
+                    'queue_size': self.queue_size,
+                    'running': self._running, 'waiting': len(self._queue)}
+
+    def _reject(self, reason):
+        # Called with the condition held.
+        REJECTIONS.inc(endpoint=self.name, reason=reason)
+        raise Overloaded(self.name, reason, self.retry_after())
+
+
+class ResultCache:
+    """Least-recently used cache of query results.
+    """
+    def __init__(self, name, size=RESULT_CACHE_SIZE):
+        """Initializes :class: ``ResultCache``.
+
+        Arguments:
+        ----------
+            name (str):
+                Name of the endpoint.
+            size (int):
+                Maximum number of cached results.
+        """
+        self.name = name
+        self.size = size
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached results of query ``key``, or None.
+        """
+        with self._lock:
+            results = self._results.get(key)
+            if results is None:
+                return None
+            self._results.move_to_end(key)
+        CACHE_HITS.inc(endpoint=self.name)
+        return results
+
+    def put(self, key, results):
+        """Caches ``results`` of query ``key``.
+        """
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._results[key] = results
+            self._results.move_to_end(key)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        """Drops all cached results, e.g. once new images are indexed.
+        """
+        with self._lock:
+            self._results.clear()
@@ -6,27 +6,136 @@ Launch web application by typing ``python3 app.py`` in a terminal.
 import os
 # Forcing web application to run on CPU.
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+import gc
 import sys
 import json
 import shutil
+import tempfile
 import threading
 import webbrowser
 from pathlib import Path
 
 from werkzeug.utils import secure_filename
-from flask import (Flask, flash, request, redirect, url_for, render_template,
-                   make_response, send_from_directory)
+from flask import (Flask, Response, flash, request, redirect, url_for,
+                   render_template, make_response, send_from_directory)
 
-import tensorflow_hub as hub
-
-from rubrix import pathfinder
-from rubrix.index.encodings import MODULE_URL
+from rubrix import metrics, models, pathfinder, pool
+from rubrix.deadline import Deadline
+from rubrix.index import segments, store
 from rubrix.query import query_by_text, query_by_image_objects
+from rubrix.web.admission import Limiter, Overloaded, ResultCache
+from rubrix.web.sessions import PAGE_SIZE, RANKED_LIST_SIZE, SessionCache
+from rubrix.web.uploads import UploadRequest, decode_upload
+
+
+# Models are loaded by a background warm-up thread, so that workers can
+# start accepting connections (and report readiness at ``/readyz``) while
+# the Universal Sentence Encoder, SpaCy pipelines and CNN models load.
+# Requests which need a model that has not been loaded yet wait for it.
+MODELS = models.default_registry()
+
+# Models which cannot be shared by threads are checked out of bounded pools
+# (see :mod: ``rubrix.pool``), whose first instances are those loaded by the
+# registry.
+POOLS = pool.default_pools(MODELS)
 
+# With ``RUBRIX_PRELOAD=1``, the index store and the models which are safe
+# to fork (SpaCy pipelines hold no threads or device handles) are loaded
+# when the app is imported. Under uWSGI without ``--lazy-apps``, this
+# happens in the master, and the workers share these pages copy-on-write.
+# Tensorflow and OpenCV models are always loaded after the fork.
+PRELOAD = os.environ.get('RUBRIX_PRELOAD', '0') == '1'
 
-# Load Universal Sentence Encoder. Building the TF graph takes time
-# and this operation on the first run is time intensive.
-MODEL = hub.load(MODULE_URL)
+# Models which can safely be loaded before the web server forks.
+FORK_SAFE_MODELS = ['spacy_small', 'spacy_medium']
+
+
+def in_uwsgi_master():
+    """Checks if this module is being imported by the uWSGI master process,
+    i.e., before workers are forked.
+
+    Returns:
+    --------
+        (bool):
+            True, if running within the uWSGI master.
+            False, otherwise.
+    """
+    try:
+        import uwsgi
+    except ImportError:
+        return False
+    return uwsgi.worker_id() == 0
+
+
+def start_warm_up():
+    # Set ``RUBRIX_WARM_UP=0`` to load models on first use instead.
+    if os.environ.get('RUBRIX_WARM_UP', '1') != '0':
+        MODELS.warm_up()
+
+
+if PRELOAD:
+    store.preload()
+    MODELS.warm_up(FORK_SAFE_MODELS, background=False)
+    # Objects allocated so far are moved to a permanent generation, which
+    # the garbage collector does not touch, so that collections in the
+    # workers do not copy the shared pages.
+    gc.freeze()
+
+if in_uwsgi_master():
+    # Threads do not survive a fork, so the warm-up thread is started in
+    # each worker instead.
+    from uwsgidecorators import postfork
+    postfork(start_warm_up)
+else:
+    start_warm_up()
+
+# With ``RUBRIX_SHARDS=N``, queries are scored by N worker processes, each
+# searching a shard of the index store. Workers are started on first use,
+# once per web server worker, so N times the number of web server workers
+# should not exceed the number of cores.
+SHARDS = int(os.environ.get('RUBRIX_SHARDS', '0'))
+
+# With ``RUBRIX_SHARD_URLS`` set to a comma-separated list of shard server
+# URLs, queries are fanned out to those shard servers instead (see
+# ``rubrix/web/shard.py``). Each shard is given ``RUBRIX_SHARD_TIMEOUT``
+# seconds to respond, or is left out of the results.
+SHARD_URLS = [url for url in os.environ.get('RUBRIX_SHARD_URLS',
+                                            '').split(',') if url]
+SHARD_TIMEOUT = float(os.environ.get('RUBRIX_SHARD_TIMEOUT', 2.0))
+
+# With ``RUBRIX_CANDIDATE_BUDGET=N``, queries score at most the N images in
+# which each object was detected most confidently, which bounds the latency
+# of queries for common objects (e.g. 'person').
+CANDIDATE_BUDGET = int(os.environ.get('RUBRIX_CANDIDATE_BUDGET', 0)) or None
+
+# ``RUBRIX_RETRIEVER`` selects how text queries find candidate images:
+# 'objects' (by the objects named in the query), 'lexical' (by the words of
+# the query in captions, see ``rubrix/index/lexical.py``) or 'hybrid'.
+RETRIEVER = os.environ.get('RUBRIX_RETRIEVER', 'objects')
+
+# Each search endpoint runs a bounded number of queries at once, and rejects
+# queries beyond a bounded wait queue with a ``503`` (see
+# ``rubrix/web/admission.py``). Cached text query results are served
+# without waiting.
+LIMITERS = {'search': Limiter('search'),
+            'reverse_search': Limiter('reverse_search')}
+RESULTS = ResultCache('search')
+
+# Searches retrieve a ranked list of results, which is kept in a session
+# and served a page at a time (see ``rubrix/web/sessions.py``).
+SESSIONS = SessionCache()
+
+# With ``RUBRIX_QUERY_DEADLINE`` set, each query has this many seconds,
+# from the arrival of the request, before it degrades its results (see
+# ``rubrix/deadline.py``) rather than running late.
+QUERY_DEADLINE = float(os.environ.get('RUBRIX_QUERY_DEADLINE', 0)) or None
+
+_scorer = None
+_scorer_lock = threading.Lock()
+
+# Images are ingested one request at a time, so that ingestion holds at most
+# one model of each pool, and segments are written one after the other.
+_ingest_lock = threading.Lock()
 
 # Port number to run Flask app on
 PORT = 8000
@@ -39,6 +148,7 @@ ALLOWED_EXTENSIONS=set(['.png', '.jpg', '.jpeg'])
 
 # Flask app set-up configuration
 app = Flask(__name__, static_url_path='/static')
+app.request_class = UploadRequest
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024
 
@@ -92,6 +202,70 @@ def copy_results(images):
     return image_names
 
 
+def degradations(deadline):
+    """Returns the degradations applied to a query to meet ``deadline``, as
+    a comma-separated list, or None if there were none.
+    """
+    if deadline is None or not deadline.degradations:
+        return None
+    return ','.join(deadline.degradations)
+
+
+def get_index():
+    """Returns the index searched by queries: the shard router if
+    ``RUBRIX_SHARD_URLS`` is set, or else the sharded scorer if
+    ``RUBRIX_SHARDS`` is set, or the store shared by this process, along
+    with the segments of ingested images.
+    """
+    global _scorer
+
+    if SHARD_URLS and _scorer is None:
+        with _scorer_lock:
+            if _scorer is None:
+                from rubrix.router import ShardRouter
+                _scorer = ShardRouter(SHARD_URLS, SHARD_TIMEOUT)
+    elif _scorer is None:
+        with _scorer_lock:
+            if _scorer is None:
+                # Builds the store, if it does not exist yet.
+                base = store.get_store()
+                if SHARDS:
+                    from rubrix.sharding import ShardedScorer
+                    base = ShardedScorer(store.default_paths()[-1], SHARDS)
+                _scorer = segments.SegmentedStore(base)
+    return _scorer
+
+
+def swap_index(base):
+    """Swaps in ``base``, a newly published snapshot of the store, as the
+    index searched by queries.
+    """
+    global _scorer
+
+    # Requests in flight keep searching the index they started with, and
+    # the previous snapshot is released once they complete.
+    with _scorer_lock:
+        _scorer = segments.SegmentedStore(base)
+    # Cached results are those of the previous snapshot.
+    RESULTS.clear()
+
+
+def start_snapshot_watcher():
+    # Shard workers and shard servers load their snapshot once, on start.
+    if store.SNAPSHOT_POLL_SECONDS > 0 and not SHARD_URLS and not SHARDS:
+        store.watch_snapshots(swap_index)
+
+
+# Newly published snapshots of the store are loaded, warmed and swapped in
+# by a background thread, every ``RUBRIX_SNAPSHOT_POLL`` seconds (0 to
+# disable). Like the warm-up thread, it is started in each worker.
+if in_uwsgi_master():
+    from uwsgidecorators import postfork
+    postfork(start_snapshot_watcher)
+else:
+    start_snapshot_watcher()
+
+
 def get_yolo_paths():
     """Extracts paths of darknet YOLOv4 objects, needed for object detection.
 
@@ -118,20 +292,25 @@ def search():
 
 @app.route('/', methods=['POST'])
 def search_post():
+    deadline = Deadline(QUERY_DEADLINE) if QUERY_DEADLINE else None
     prompt = request.json['prompt']
-    retrieved_images = query_by_text(prompt, MODEL)
+    key = (prompt, RETRIEVER, CANDIDATE_BUDGET)
+    retrieved_images = RESULTS.get(key)
+    if retrieved_images is None:
+        with LIMITERS['search'].admit():
+            retrieved_images = query_by_text(
+                prompt, MODELS.get('sentence_encoder'), store=get_index(),
+                budget=CANDIDATE_BUDGET, retriever=RETRIEVER, pools=POOLS,
+                deadline=deadline, k=RANKED_LIST_SIZE)
+        # Degraded results are not cached.
+        if deadline is None or not deadline.degradations:
+            RESULTS.put(key, retrieved_images)
     if retrieved_images != []:
-        image_names = copy_results(retrieved_images)
         message = f"Image search results for \"{prompt}\":"
-        return redirect(url_for('results',
-                                message=message,
-                                result1='predictions/' + image_names[0],
-                                result2='predictions/' + image_names[1],
-                                result3='predictions/' + image_names[2],
-                                result4='predictions/' + image_names[3],
-                                result5='predictions/' + image_names[4],
-                                _external=True, _scheme='https'
-                                ))
+        cursor = SESSIONS.create(retrieved_images, message,
+                                 degradations(deadline))
+        return redirect(url_for('results', cursor=cursor,
+                                _external=True, _scheme='https'))
     else:
         return redirect(url_for('search'))
 
@@ -143,6 +322,7 @@ def reverse_search():
 
 @app.route('/reverse-search', methods=['POST'])
 def reverse_search_post():
+    deadline = Deadline(QUERY_DEADLINE) if QUERY_DEADLINE else None
     # Check if the post request has the file part
     if 'file' not in request.files:
         flash('No file part')
@@ -155,45 +335,147 @@ def reverse_search_post():
         flash('No selected file')
         return redirect(request.url)
 
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        uploads_dir = pathfinder.get('rubrix', 'web') / UPLOAD_FOLDER
-        # Create ``UPLOAD_FOLDER`` if not already exists.
-        if not uploads_dir.is_dir():
-            uploads_dir.mkdir(parents=True)
-        # Save uploaded file to ``UPLOAD_FOLDER``.
-        file.save(str(uploads_dir / filename))
+    if not allowed_file(file.filename):
+        flash('Unsupported file type')
+        return redirect(request.url)
 
-    image_path = uploads_dir / filename
+    # The upload is decoded from memory, rather than saved and read back.
+    image = decode_upload(file)
+    if image is None:
+        flash('Invalid image')
+        return redirect(request.url)
     _paths = get_yolo_paths()
 
-    retrieved_images = query_by_image_objects(image_path, *_paths)
+    with LIMITERS['reverse_search'].admit():
+        retrieved_images = query_by_image_objects(image, *_paths,
+                                                  store=get_index(),
+                                                  budget=CANDIDATE_BUDGET,
+                                                  pools=POOLS,
+                                                  deadline=deadline,
+                                                  k=RANKED_LIST_SIZE)
 
     if retrieved_images != []:
-        image_names = copy_results(retrieved_images)
-        return redirect(url_for('results',
-                                message='Reverse-image-search results:',
-                                result1='predictions/' + image_names[0],
-                                result2='predictions/' + image_names[1],
-                                result3='predictions/' + image_names[2],
-                                result4='predictions/' + image_names[3],
-                                result5='predictions/' + image_names[4],
-                                _external=True, _scheme='https'
-                                ))
+        cursor = SESSIONS.create(retrieved_images,
+                                 'Reverse-image-search results:',
+                                 degradations(deadline))
+        return redirect(url_for('results', cursor=cursor,
+                                _external=True, _scheme='https'))
     else:
         return redirect(url_for('search', _external=True, _scheme='https'))
 
 
+@app.route('/ingest', methods=['POST'])
+def ingest_post():
+    # Request body (multipart form):
+    #     files: new images.
+    #     captions: JSON object mapping file names of new images to lists
+    #               of captions (optional).
+    from rubrix.index.ingest import ingest
+
+    files = [file for file in request.files.getlist('files')
+             if file.filename and allowed_file(file.filename)]
+    if not files:
+        return {'error': 'No images to ingest.'}, 400
+    try:
+        captions = json.loads(request.form.get('captions') or '{}')
+    except json.JSONDecodeError:
+        return {'error': 'Captions are not valid JSON.'}, 400
+    if not isinstance(captions, dict):
+        return {'error': 'Captions must map file names to lists.'}, 400
+    unknown = set(captions) - {file.filename for file in files}
+    if unknown:
+        return {'error': f'Captions of files not uploaded: '
+                         f'{", ".join(sorted(unknown))}'}, 400
+
+    images = []
+    for file in files:
+        images.append(decode_upload(file))
+        if images[-1] is None:
+            return {'error': f'Invalid image: {file.filename}'}, 400
+
+    # Uploads are saved outside the main directory, so that ingestion copies
+    # them to ``assets/data/ingested`` under names no other image has, and
+    # are deleted once ingested. Saved names are made safe and unique within
+    # the request, and captions are keyed by them, as ingestion looks
+    # captions up by file name.
+    with tempfile.TemporaryDirectory() as uploads_dir:
+        image_paths, saved_captions = [], {}
+        for file in files:
+            path = Path(secure_filename(file.filename) or
+                        f'image{Path(file.filename).suffix}')
+            filename, copy = path.name, 1
+            while filename in saved_captions:
+                filename = f'{path.stem}-{copy}{path.suffix}'
+                copy += 1
+            saved_captions[filename] = captions.get(file.filename, [])
+            image_paths.append(Path(uploads_dir) / filename)
+            file.stream.seek(0)
+            file.save(str(image_paths[-1]))
+
+        with _ingest_lock, POOLS['yolo'].checkout() as net, \
+                POOLS['inception'].checkout() as cnn:
+            name = ingest(image_paths, saved_captions, *get_yolo_paths(),
+                          model=MODELS.get('sentence_encoder'), net=net,
+                          cnn=cnn, images=images)
+    index = get_index()
+    if isinstance(index, segments.SegmentedStore):
+        index.refresh()
+        # Segments are merged off the request path.
+        segments.merge_in_background(index.segments_path)
+    # Cached results do not include the ingested images.
+    RESULTS.clear()
+    return {'segment': name, 'images': len(image_paths)}
+
+
+@app.route('/healthz')
+def healthz():
+    return {'status': 'ok', 'models': MODELS.status(),
+            'pools': {name: model_pool.status()
+                      for name, model_pool in POOLS.items()},
+            'admission': {name: limiter.status()
+                          for name, limiter in LIMITERS.items()}}
+
+
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    return ({'error': 'The server is busy, please retry later.',
+             'retry_after': error.retry_after},
+            503, {'Retry-After': str(error.retry_after)})
+
+
+@app.route('/readyz')
+def readyz():
+    status = 200 if MODELS.is_ready() else 503
+    return {'ready': status == 200, 'models': MODELS.status()}, status
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/results')
-def results(message=None, result1=None, result2=None, result3=None,
-            result4=None, result5=None):
+def results():
+    # Query string:
+    #     cursor: key to the ranked list of a search.
+    #     page: page of results, numbered from 0.
+    session = SESSIONS.get(request.args.get('cursor'))
+    if session is None:
+        # The session expired, and the search has to be made again.
+        return redirect(url_for('search', _external=True, _scheme='https'))
+
+    n_pages = session.n_pages(PAGE_SIZE)
+    page = min(max(0, request.args.get('page', 0, type=int)), n_pages - 1)
+    # Only the images of the page are copied to the static directory.
+    image_names = copy_results(session.page(page, PAGE_SIZE))
     return render_template('Results.html',
-                            message=request.args.get('message'),
-                            result1=request.args.get('result1'),
-                            result2=request.args.get('result2'),
-                            result3=request.args.get('result3'),
-                            result4=request.args.get('result4'),
-                            result5=request.args.get('result5'))
+                            message=session.message,
+                            degraded=session.degraded,
+                            results=['predictions/' + name
+                                     for name in image_names],
+                            cursor=request.args.get('cursor'),
+                            page=page, n_pages=n_pages)
 
 
 def launch():
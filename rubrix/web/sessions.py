@@ -0,0 +1,143 @@
+"""Ranked lists of recent queries, from which results are served a page at
+a time.
+
+A search retrieves the ``RANKED_LIST_SIZE`` best images at once, rather
+than a single page of them, and keeps them in a :class: ``SessionCache``
+under a random cursor. Later pages are sliced from the ranked list, without
+running the SpaCy pipelines, the encoders or the scoring again. Sessions
+expire ``RUBRIX_SESSION_TTL`` seconds after they were last read, and at most
+``RUBRIX_MAX_SESSIONS`` are kept, the least recently read being dropped
+first. Sessions are kept in the memory of the web server process which ran
+the query.
+"""
+import os
+import time
+import secrets
+import threading
+from collections import OrderedDict
+
+from rubrix import metrics
+
+
+# Number of images retrieved by a search, across all of its pages.
+RANKED_LIST_SIZE = int(os.environ.get('RUBRIX_RANKED_LIST_SIZE', 200))
+
+# Number of images per page of results.
+PAGE_SIZE = int(os.environ.get('RUBRIX_PAGE_SIZE', 5))
+
+# Time (in seconds) after which a session which was not read expires.
+SESSION_TTL = float(os.environ.get('RUBRIX_SESSION_TTL', 600))
+
+# Maximum number of sessions kept.
+MAX_SESSIONS = int(os.environ.get('RUBRIX_MAX_SESSIONS', 1024))
+
+# Pages of results served from sessions, and cursors of expired sessions.
+PAGES = metrics.register(metrics.Counter(
+    'rubrix_result_pages_total',
+    'Number of pages of results served from ranked-list sessions.'))
+EXPIRED = metrics.register(metrics.Counter(
+    'rubrix_session_misses_total',
+    'Number of cursors of expired or unknown ranked-list sessions.'))
+
+
+class RankedSession:
+    """Ranked list of results of a query.
+    """
+    def __init__(self, results, message, degraded=None):
+        """Initializes :class: ``RankedSession``.
+
+        Arguments:
+        ----------
+            results (list of pathlib.Path objects):
+                Paths to retrieved images, best first.
+            message (str):
+                Message displayed above the results.
+            degraded (str):
+                Degradations applied to the query to meet its deadline, if
+                any (see :mod: ``rubrix.deadline``).
+        """
+        self.results = results
+        self.message = message
+        self.degraded = degraded
+        # Set by :class: ``SessionCache``.
+        self.expires = None
+
+    def n_pages(self, page_size=PAGE_SIZE):
+        return max(1, -(-len(self.results) // page_size))
+
+    def page(self, page, page_size=PAGE_SIZE):
+        """Returns the results on page ``page``, numbered from 0.
+        """
+        return self.results[page * page_size:(page + 1) * page_size]
+
+
+class SessionCache:
+    """Sessions of recent queries, by cursor.
+    """
+    def __init__(self, ttl=SESSION_TTL, size=MAX_SESSIONS):
+        """Initializes :class: ``SessionCache``.
+
+        Arguments:
+        ----------
+            ttl (float):
+                Time (in seconds) after which a session which was not read
+                expires.
+            size (int):
+                Maximum number of sessions.
+        """
+        self.ttl = ttl
+        self.size = size
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, results, message, degraded=None):
+        """Keeps the ranked list ``results`` of a query.
+
+        Arguments:
+        ----------
+            results (list of pathlib.Path objects):
+                Paths to retrieved images, best first.
+            message (str):
+                Message displayed above the results.
+            degraded (str):
+                Degradations applied to the query, if any.
+
+        Returns:
+        --------
+            cursor (str):
+                Random, unguessable key to the session.
+        """
+        cursor = secrets.token_urlsafe(16)
+        session = RankedSession(results, message, degraded)
+        session.expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._expire()
+            self._sessions[cursor] = session
+            while len(self._sessions) > self.size:
+                self._sessions.popitem(last=False)
+        return cursor
+
+    def get(self, cursor):
+        """Returns the session of ``cursor``, or None if it expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(cursor)
+            if session is None or session.expires <= now:
+                self._sessions.pop(cursor, None)
+                EXPIRED.inc()
+                return None
+            session.expires = now + self.ttl
+            self._sessions.move_to_end(cursor)
+        PAGES.inc()
+        return session
+
+    def _expire(self):
+        # Sessions are ordered by last read, hence expired ones come first.
+        # Called with the lock held.
+        now = time.monotonic()
+        while self._sessions:
+            cursor, session = next(iter(self._sessions.items()))
+            if session.expires > now:
+                break
+            del self._sessions[cursor]
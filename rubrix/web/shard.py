@@ -0,0 +1,102 @@
+"""Shard server, serving searches over one partition of the index store.
+
+Partitions are created with ``python rubrix/index/store.py --partition N``,
+and each is served by a shard server, possibly on a separate machine. The
+web application fans queries out to all shard servers through
+:class: ``rubrix.router.ShardRouter``.
+
+Launch a shard server by typing the following in a terminal:
+
+    $ python -m rubrix.web.shard --store <path/to/shard-0> --port 9000
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from flask import Flask, request
+
+from rubrix.index.store import IndexStore
+
+
+def create_app(store_path):
+    """Creates the Flask application serving the shard at ``store_path``.
+
+    Arguments:
+    ----------
+        store_path (pathlib.Path):
+            Path to shard store directory.
+
+    Returns:
+    --------
+        app (flask.Flask):
+            Shard server application.
+    """
+    store = IndexStore.load(Path(store_path))
+    app = Flask(__name__)
+
+    @app.route('/shard/info')
+    def info():
+        return {'store': str(store_path), 'images': len(store),
+                'captions': int(store.offsets[-1])}
+
+    @app.route('/shard/search', methods=['POST'])
+    def search():
+        # Request body:
+        #     kind: 'captions' or 'descriptors'.
+        #     vector: query sentence embedding / image descriptor.
+        #     labels: object labels (or groups of labels), or null to scan
+        #             the whole shard.
+        #     k: number of results.
+        #     mode: 'or' or 'and', to combine labels.
+        #     budget: maximum number of images of the shard to score per
+        #             label, or null to score all of them.
+        #     terms: query terms, whose best matching images of the shard
+        #            by BM25 score are candidates too, or null.
+        body = request.json
+        array = np.asarray(body['vector'], dtype=np.float32)
+        labels = body.get('labels')
+        mode = body.get('mode', 'or')
+        if labels is not None:
+            # Labels absent from the shard match none of its images. They
+            # are dropped from groups of alternatives, and a group left
+            # empty matches no image, as required of every group in 'and'
+            # mode.
+            labels = [[label for label in
+                       ([group] if isinstance(group, str) else group)
+                       if label in store.postings] for group in labels]
+            if mode != 'and':
+                labels = [group for group in labels if group]
+        budget = body.get('budget')
+        terms = body.get('terms')
+
+        if body['kind'] == 'captions':
+            results = store.search_captions(array, labels, body['k'],
+                                            mode=mode, budget=budget,
+                                            terms=terms)
+        else:
+            results = store.search_descriptors(array, labels, body['k'],
+                                               mode=mode, budget=budget,
+                                               terms=terms)
+
+        # Image IDs are local to the shard, hence images are identified by
+        # their paths (relative to the main directory) in responses.
+        return {'results': [[store.relative_path(image_id), score]
+                            for image_id, score in results]}
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a shard of the '
+                                                 'index store.')
+    parser.add_argument('--store', dest='store_path', type=str, required=True,
+                        help='Path to shard store directory.')
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+                        help='Host to listen on.')
+    parser.add_argument('--port', dest='port', type=int, default=9000,
+                        help='Port to listen on.')
+    args = parser.parse_args()
+
+    create_app(args.store_path).run(host=args.host, port=args.port,
+                                    threaded=True)
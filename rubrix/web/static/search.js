@@ -30,6 +30,13 @@ $(document).ready(function() {
                 'prompt': prompt
             })
         })
+        if (data.status == 503) {
+            // The server is overloaded: the query can be retried later.
+            const seconds = data.headers.get('Retry-After');
+            $('#search_button').prop("disabled", false)
+            $('#search_button').html("Busy, retry in " + seconds + "s")
+            return;
+        }
         let waiting_for_result = true;
         while (waiting_for_result) {
             redirect_url = data['url'];
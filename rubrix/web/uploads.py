@@ -0,0 +1,52 @@
+"""Handling of user-uploaded images, without writing them to disk.
+
+Uploaded files are buffered in memory, and only spooled to an anonymous
+temporary file when larger than ``SPOOL_SIZE`` bytes. Either way, nothing is
+left behind once the request completes. Reverse-image searches decode the
+buffered upload once, and derive all model inputs from the decoded image.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from flask import Request
+
+from rubrix import metrics
+
+
+# Uploads larger than this many bytes are spooled to a temporary file.
+SPOOL_SIZE = int(os.environ.get('RUBRIX_UPLOAD_SPOOL_SIZE', 4 * 1024 * 1024))
+
+
+class UploadRequest(Request):
+    """Request buffering uploaded files in spooled temporary files.
+    """
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        # Spooled files are closed, hence deleted, along with the request.
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+
+def decode_upload(file):
+    """Decodes an uploaded image from its buffered stream.
+
+    Arguments:
+    ----------
+        file (werkzeug.datastructures.FileStorage):
+            Uploaded file.
+
+    Returns:
+    --------
+        image (numpy.ndarray):
+            Image in BGR channel order, as returned by ``cv2.imread``, or
+            None if the file is not a valid image.
+    """
+    import cv2
+
+    with metrics.span('decode_image'):
+        file.stream.seek(0)
+        data = np.frombuffer(file.stream.read(), dtype=np.uint8)
+        if len(data) == 0:
+            return None
+        return cv2.imdecode(data, cv2.IMREAD_COLOR)
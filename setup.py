@@ -24,7 +24,10 @@ setup(
       # Packages can be manually mentioned, or `setuptools.find_packages`
       # can be used for this purpose.
       packages=find_packages(),
-      entry_points={'console_scripts': ['rubrix = rubrix.web.main:launch']},
+      entry_points={'console_scripts': [
+            'rubrix = rubrix.web.main:launch',
+            'rubrix-build = rubrix.index.build:main',
+      ]},
       ext_modules=[
             Extension(
                   'dotproduct',